@@ -18,6 +18,7 @@
 
 from sunau import AUDIO_UNKNOWN_SIZE
 import sys
+import argparse
 import os
 import time
 import threading
@@ -28,6 +29,22 @@ from kortex_api.autogen.client_stubs.BaseCyclicClientRpc import BaseCyclicClient
 
 from kortex_api.autogen.messages import Base_pb2, BaseCyclic_pb2, Common_pb2
 
+import kortex_sim
+from action_notifications import ActionDispatcher, ActionAborted, \
+    abort_reason
+from feedback_sampler import FeedbackSampler
+from sequence_upload import run_sequence
+from telemetry_recorder import TelemetryRecorder
+from tactile_capture import TactileCapture, OpenCVSource, SyntheticSource
+from experiment_store import ExperimentStore
+from protocol_file import load_plan
+from contact_detection import run_with_contact
+from ik_cache import IKCache
+from clearance import Obstacle, table_height, clearance
+from grid_scan import grid_points, visit_order, path_length, scan_protocol
+from indentation_steps import IndentationStep, compile_steps, run_steps, \
+    execute_action, build_current_pose_action
+
 # DEFINITIONS:
 
 # Index Variables
@@ -76,581 +93,351 @@ P2 = [47, 10, -3.5]; #Top Right
 P3 = [30, -14, -3.5]; #Bottom Right
 P4 = [30, 10, -3.5]; #Bottom Left
 
-# Maximum allowed waiting time during actions (in seconds)
-TIMEOUT_DURATION = 1000
-
-# Create closure to set an event after an END or an ABORT
-# Takes an input of "e" to see if the progam has finished or aborted.
-# Returns the notification of the event that occured.
-
-def check_for_end_or_abort(e):
-    """Return a closure checking for END or ABORT notifications
-    Arguments:
-    e -- event to signal when the action is completed
-        (will be set when an END or ABORT occurs)
+# Cyclic feedback sampling rate (Hz) and maximum wait for the first
+# sample (in seconds)
+SAMPLE_RATE = 500
+SAMPLE_TIMEOUT = 5
+
+# Maximum allowed waiting time during actions (in seconds). None lets
+# the step engine predict each move's deadline from its length.
+TIMEOUT_DURATION = None
+
+# Indentation Depths - Unit: cm
+# Offsets below the hover height at which a reading is taken.
+depths = [0, -0.2, -0.4, -0.6, -0.8, -2];
+
+# Height above the hover point used to approach the first phantom and
+# leave the last one - Unit: cm
+retract = 15;
+
+# Phantom Footprint - Unit: cm
+# Diameter of each inclusion phantom, used for the clearance planner.
+phantom_diameter = 5;
+
+# Minimum Safe Clearance
+# Between the phantoms the arm only lifts as far as the sensor tube needs
+# to clear both phantoms and the Pyrex table, instead of the full retract.
+obstacles = [
+    Obstacle("soft", soft[x], soft[y], phantom_diameter/2, soft[z]),
+    Obstacle("hard", hard[x], hard[y], phantom_diameter/2, hard[z]),
+]
+soft_lift, hard_lift = clearance((softx, softy, softz), (hardx, hardy, hardz),
+                                 obstacles, table_height([P1, P2, P3, P4]),
+                                 height, radius, radius)
+
+# Segment Speeds - Unit: cm/s
+# Transit moves (approach, retract, transition) run fast down to
+# approach_height cm above the hover point; the rest of the approach and
+# the indentation run slowly so every reading is taken the same way.
+transit_speed = 10;
+contact_speed = 0.5;
+approach_height = 1;
+
+# Transit Blending Radius - Unit: cm
+# Consecutive transit moves go out as one waypoint trajectory that
+# rounds each corner within this radius instead of stopping there.
+blending_radius = 0.5;
+
+def transit_offsets(lift):
+    """Offsets of a transit row: up to `lift`, then down to approach_height
     """
-    def check(notification, e = e):
-        print("EVENT : " + \
-              Base_pb2.ActionEvent.Name(notification.action_event))
-        if notification.action_event == Base_pb2.ACTION_END \
-        or notification.action_event == Base_pb2.ACTION_ABORT:
-            e.set()
-    return check
-
-def example_test_movement(base, base_cyclic):
-    
-    print("Starting Cartesian action movement ...")
-    action = Base_pb2.Action()
-    action.name = "Example Cartesian action movement"
-    action.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action.reach_pose.target_pose
-
-    cartesian_pose.x = feedback.base.tool_pose_x          # (meters)
-    cartesian_pose.y = feedback.base.tool_pose_y     # (meters)
-    cartesian_pose.z = feedback.base.tool_pose_z     # (meters)
-    cartesian_pose.theta_x = feedback.base.tool_pose_theta_x # (degrees)
-    cartesian_pose.theta_y = feedback.base.tool_pose_theta_y # (degrees)
-    cartesian_pose.theta_z = feedback.base.tool_pose_theta_z # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-    
-
-    # Soft Movement 1
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = softx/100        # (meters)
-    cartesian_pose.y = softy/100       # (meters)
-    cartesian_pose.z = softz/100 + 15/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-	
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-    # Soft Movement 2
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = softx/100        # (meters)
-    cartesian_pose.y = softy/100       # (meters)
-    cartesian_pose.z = softz/100         # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-	
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Soft Movement 3
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = softx/100       # (meters)
-    cartesian_pose.y = softy/100             # (meters)
-    cartesian_pose.z = softz/100 - 0.2/100       # (meters)
-    cartesian_pose.theta_x = adx     # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Soft Movement 4
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = softx/100        # (meters)
-    cartesian_pose.y = softy/100       # (meters)
-    cartesian_pose.z = softz/100 - 0.4/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Soft Movement 5
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = softx/100        # (meters)
-    cartesian_pose.y = softy/100       # (meters)
-    cartesian_pose.z = softz/100 - 0.6/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Soft Movement 6
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = softx/100        # (meters)
-    cartesian_pose.y = softy/100       # (meters)
-    cartesian_pose.z = softz/100 - 0.8/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Soft Movement 7
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = softx/100        # (meters)
-    cartesian_pose.y = softy/100       # (meters)
-    cartesian_pose.z = softz/100 - 2/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Retracting Arm
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = softx/100        # (meters)
-    cartesian_pose.y = softy/100       # (meters)
-    cartesian_pose.z = softz/100 + 15/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Transition to Hard Inclusion
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = hardx/100        # (meters)
-    cartesian_pose.y = hardy/100       # (meters)
-    cartesian_pose.z = hardz/100 + 15/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Hard Movement 1
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = hardx/100        # (meters)
-    cartesian_pose.y = hardy/100       # (meters)
-    cartesian_pose.z = hardz/100         # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-	
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Hard Movement 2
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = hardx/100       # (meters)
-    cartesian_pose.y = hardy/100             # (meters)
-    cartesian_pose.z = hardz/100 - 0.2/100       # (meters)
-    cartesian_pose.theta_x = adx     # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Soft Movement 3
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = hardx/100        # (meters)
-    cartesian_pose.y = hardy/100       # (meters)
-    cartesian_pose.z = hardz/100 - 0.4/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Hard Movement 4
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
+    if lift > approach_height:
+        return [lift, approach_height]
+    return [approach_height]
+
+# Protocol Table
+# One row per segment of the run. Each offset in a row becomes one move,
+# so each series is six readings, preceded by its transit moves.
+soft_series = IndentationStep("Soft Indentation", (softx, softy, softz),
+                              depths, (adx, ady, adz), "soft", contact_speed)
+hard_series = IndentationStep("Hard Indentation", (hardx, hardy, hardz),
+                              depths, (adx, ady, adz), "hard", contact_speed)
+
+protocol = [
+    IndentationStep("Soft Approach", (softx, softy, softz),
+                    transit_offsets(retract), (adx, ady, adz), "soft",
+                    transit_speed, blend = blending_radius),
+    soft_series,
+    IndentationStep("Retracting Arm", (softx, softy, softz), [soft_lift],
+                    (adx, ady, adz), "soft", transit_speed,
+                    blend = blending_radius),
+    IndentationStep("Transition to Hard Inclusion", (hardx, hardy, hardz),
+                    transit_offsets(hard_lift), (adx, ady, adz), "hard",
+                    transit_speed, blend = blending_radius),
+    hard_series,
+    IndentationStep("Retracting Arm", (hardx, hardy, hardz), [retract],
+                    (adx, ady, adz), "hard", transit_speed),
+]
+
+# Contact Detection
+# With --contact the soft and hard series start from the measured
+# phantom surface instead of softz/hardz. The search starts 1 cm above
+# the estimate and descends at 0.5 cm/s until the tool force rises by
+# 1 N, giving up after 3 cm.
+contact_rows = [soft_series, hard_series]
+CONTACT_FORCE = 1.0      # (N)
+SEARCH_HEIGHT = 0.01     # (meters)
+SEARCH_SPEED = 0.005     # (meters/second)
+SEARCH_TRAVEL = 0.03     # (meters)
+
+# Grid Scan
+# With --scan PITCH the Pyrex region P1-P4 is indented on a grid with
+# PITCH cm between points, running the depth series from the surface
+# under every point. Between neighbours the arm lifts just enough to
+# clear the phantoms, like the transition between the two series.
+
+def camera_sources(cameras, sampler):
+    """Frame sources for the --camera arguments"""
+    sources = []
+    for camera in cameras:
+        if camera == "synthetic":
+            sources.append(SyntheticSource(sampler = sampler))
+        elif camera.isdigit():
+            sources.append(OpenCVSource(int(camera)))
+        else:
+            sources.append(OpenCVSource(camera))
+    return sources
+
+def start_tagging(sampler, recorder, capture):
+    """Attach the telemetry recorder and frame capture (either may be
+    None) and return the on_step callback that tags both
+    """
+    taggers = [tagger for tagger in (recorder, capture) if tagger is not None]
+    if recorder is not None:
+        sampler.add_listener(recorder.record_feedback)
+    if not taggers:
+        return None
+    def on_step(index, compiled_step):
+        for tagger in taggers:
+            tagger.begin_step(index, compiled_step)
+    return on_step
+
+def stop_tagging(sampler, recorder, capture):
+    if recorder is not None:
+        sampler.remove_listener(recorder.record_feedback)
+        recorder.end_steps()
+    if capture is not None:
+        capture.end_steps()
+
+def example_test_movement(dispatcher, sampler, sequence = False,
+                          recorder = None, contact = False, ik_cache = None,
+                          capture = None, plan = None):
+
+    # Compile the whole run up front so the loop below only sends
+    # ready-made actions. A protocol file's plan replaces the table above.
+    compiled = compile_steps(protocol if plan is None else plan)
 
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = hardx/100        # (meters)
-    cartesian_pose.y = hardy/100       # (meters)
-    cartesian_pose.z = hardz/100 - 0.6/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Hard Movement 5
     print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
+    snapshot = sampler.wait_for_sample(SAMPLE_TIMEOUT)
+    if snapshot is None:
+        print("No cyclic feedback received")
+        return False
+    action = build_current_pose_action(snapshot.tool_pose)
+
+    # Send cached joint solutions instead of Cartesian poses
+    if ik_cache is not None:
+        compiled = ik_cache.joint_steps(dispatcher.base, compiled,
+                                        snapshot.tool_pose,
+                                        snapshot.joint_positions)
+        ik_cache.save()
+
+    # Tag recorded feedback and frames with the step that is running
+    on_step = start_tagging(sampler, recorder, capture)
+
+    aborted = None
+    try:
+        print("Executing action")
+        execute_action(dispatcher, action, TIMEOUT_DURATION,
+                       snapshot.tool_pose)
+
+        print("Waiting for movement to finish ...")
+        if contact:
+            # Find each phantom surface, then indent relative to it
+            finished, contacts = run_with_contact(
+                dispatcher, sampler, protocol, contact_rows,
+                TIMEOUT_DURATION, on_step, CONTACT_FORCE, SEARCH_SPEED,
+                SEARCH_TRAVEL, SEARCH_HEIGHT)
+        elif sequence:
+            # Upload the whole run and let the controller step through it
+            finished = run_sequence(dispatcher.base, compiled,
+                                    TIMEOUT_DURATION, on_step,
+                                    snapshot.tool_pose)
+        else:
+            finished = run_steps(dispatcher, compiled, TIMEOUT_DURATION,
+                                 on_step, snapshot.tool_pose)
+    except ActionAborted as error:
+        aborted = error
+        finished = False
+    finally:
+        stop_tagging(sampler, recorder, capture)
 
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = hardx/100        # (meters)
-    cartesian_pose.y = hardy/100       # (meters)
-    cartesian_pose.z = hardz/100 - 0.8/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# hard Movement 6
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
+    if finished:
+        print("Cartesian movement completed")
+    elif aborted is not None:
+        print("{} aborted: {}".format(aborted.name,
+                                      abort_reason(aborted.notification)))
+    else:
+        print("Timeout on action notification wait")
+    return finished
 
-    feedback = base_cyclic.RefreshFeedback()
+def example_scan_movement(dispatcher, sampler, pitch, recorder = None,
+                          capture = None):
+
+    # Lay out the grid and order it to keep air travel short
+    grid = grid_points([P1, P2, P3, P4], pitch)
+    order = visit_order(grid)
+    naive = [point for row in grid for point in row]
+    print("Scanning {} points, {:.1f} cm of travel ({:.1f} cm row by "
+          "row)".format(len(order), path_length(order), path_length(naive)))
+    compiled = compile_steps(scan_protocol(order, depths, (adx, ady, adz),
+                                           obstacles, radius, height,
+                                           radius, retract, transit_speed,
+                                           contact_speed, blending_radius,
+                                           approach_height))
 
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = hardx/100        # (meters)
-    cartesian_pose.y = hardy/100       # (meters)
-    cartesian_pose.z = hardz/100 -2/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Retracting Arm
     print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = hardx/100        # (meters)
-    cartesian_pose.y = hardy/100       # (meters)
-    cartesian_pose.z = hardz/100 + 15/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
+    snapshot = sampler.wait_for_sample(SAMPLE_TIMEOUT)
+    if snapshot is None:
+        print("No cyclic feedback received")
+        return False
+    on_step = start_tagging(sampler, recorder, capture)
+
+    aborted = None
+    try:
+        execute_action(dispatcher,
+                       build_current_pose_action(snapshot.tool_pose),
+                       TIMEOUT_DURATION, snapshot.tool_pose)
+
+        print("Waiting for movement to finish ...")
+        finished = run_steps(dispatcher, compiled, TIMEOUT_DURATION, on_step,
+                             snapshot.tool_pose)
+    except ActionAborted as error:
+        aborted = error
+        finished = False
+    finally:
+        stop_tagging(sampler, recorder, capture)
 
     if finished:
-        print("Cartesian movement completed")
+        print("Grid scan completed")
+    elif aborted is not None:
+        print("{} aborted: {}".format(aborted.name,
+                                      abort_reason(aborted.notification)))
     else:
         print("Timeout on action notification wait")
     return finished
 
 def main():
     
-    # Import the utilities helper module
+    # Import the utilities helper module, or the offline simulator when
+    # run with --simulate
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
+    utilities, BaseClient, BaseCyclicClient = kortex_sim.select_backend()
 
     # Parse arguments
-    args = utilities.parseConnectionArguments()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sequence", action = "store_true",
+                        help = "upload the protocol as one controller-side "
+                               "sequence")
+    parser.add_argument("--contact", action = "store_true",
+                        help = "start each series at the detected phantom "
+                               "surface")
+    parser.add_argument("--scan", metavar = "PITCH", type = float,
+                        help = "indent a grid over the Pyrex region with "
+                               "PITCH cm between points")
+    parser.add_argument("--protocol", metavar = "PATH",
+                        help = "run the protocol in a JSON or TOML file "
+                               "instead of the table in this script")
+    parser.add_argument("--record", metavar = "PATH",
+                        help = "record cyclic feedback to a telemetry file")
+    parser.add_argument("--capture", metavar = "PREFIX",
+                        help = "capture tactile frames to PREFIX.cam<N>.tis")
+    parser.add_argument("--camera", action = "append", default = [],
+                        metavar = "DEVICE",
+                        help = "camera to capture from: a device index or "
+                               "path, or \"synthetic\" (default 0)")
+    parser.add_argument("--store", metavar = "ROOT",
+                        help = "record telemetry, and frames from any "
+                               "--camera, to a new session in the "
+                               "experiment store ROOT")
+    parser.add_argument("--ik_cache", metavar = "PATH",
+                        help = "send moves as joint angles, cached in PATH")
+    args = utilities.parseConnectionArguments(parser)
+    if args.store and (args.record or args.capture):
+        parser.error("--store records the session itself; leave out "
+                     "--record and --capture")
+    if args.protocol and (args.contact or args.scan):
+        parser.error("--protocol cannot be combined with --contact or "
+                     "--scan")
+    if args.ik_cache and (args.contact or args.scan):
+        parser.error("--ik_cache cannot be combined with --contact or "
+                     "--scan")
+    if args.scan and (args.contact or args.sequence):
+        parser.error("--scan cannot be combined with --contact or "
+                     "--sequence")
+    plan = load_plan(args.protocol) if args.protocol else None
     
     # Create connection to the device and get the router
     with utilities.DeviceConnection.createTcpConnection(args) as router:
 
         # Create required services
         base = BaseClient(router)
-        base_cyclic = BaseCyclicClient(router)
 
-        # Example core
-        success = True
-        success &= example_test_movement(base, base_cyclic)
-        #success &= example_test_movement(base, base_cyclic)
+        # Cyclic feedback is polled over UDP by a background sampler, and
+        # one action notification subscription serves the whole session
+        with utilities.DeviceConnection.createUdpConnection(args) \
+                as router_real_time, \
+             FeedbackSampler(BaseCyclicClient(router_real_time),
+                             SAMPLE_RATE) as sampler, \
+             ActionDispatcher(base) as dispatcher:
+
+            # Flush and close the recorder and camera files however the
+            # run ends
+            recorder = None
+            capture = None
+            try:
+                if args.record:
+                    recorder = TelemetryRecorder(args.record)
+
+                if args.capture:
+                    capture = TactileCapture(
+                        args.capture, camera_sources(args.camera or ["0"],
+                                                     sampler))
+
+                # The session stands in for the recorder and tags the frames
+                # and step index itself
+                if args.store:
+                    recorder = ExperimentStore(args.store).create_session(
+                        camera_sources(args.camera, sampler),
+                        {"script": os.path.basename(__file__),
+                         "arguments": sys.argv[1:]})
+                    print("Recording to {}".format(recorder.directory))
+
+                ik_cache = None
+                if args.ik_cache:
+                    control_config = kortex_sim.control_config_client(
+                        utilities, router)
+                    ik_cache = IKCache(args.ik_cache,
+                                       control_config.GetToolConfiguration())
+
+                # Example core
+                success = True
+                if args.scan:
+                    success &= example_scan_movement(dispatcher, sampler,
+                                                     args.scan, recorder,
+                                                     capture)
+                else:
+                    success &= example_test_movement(dispatcher, sampler,
+                                                     args.sequence, recorder,
+                                                     args.contact, ik_cache,
+                                                     capture, plan)
+                #success &= example_test_movement(dispatcher, sampler,
+                #                                 args.sequence, recorder,
+                #                                 args.contact)
+            finally:
+                if recorder is not None:
+                    recorder.close()
+                if capture is not None:
+                    capture.close()
 
         return 0 if success else 1
 
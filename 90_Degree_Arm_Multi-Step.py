@@ -16,6 +16,7 @@
 ###
 
 import sys
+import argparse
 import os
 import time
 import threading
@@ -25,8 +26,23 @@ from kortex_api.autogen.client_stubs.BaseCyclicClientRpc import BaseCyclicClient
 
 from kortex_api.autogen.messages import Base_pb2, BaseCyclic_pb2, Common_pb2
 
+import kortex_sim
+from action_notifications import ActionDispatcher, ActionAborted
+from feedback_sampler import FeedbackSampler
+from telemetry_recorder import TelemetryRecorder
+from sequence_upload import run_sequence
+from servo_streaming import staircase, run_depth_ramp
+from indentation_steps import IndentationStep, compile_steps, run_steps, \
+    execute_action, build_current_pose_action
 
-# Maximum allowed waiting time during actions (in seconds)
+
+# Cyclic feedback sampling rate (Hz) and maximum wait for the first
+# sample (in seconds)
+SAMPLE_RATE = 500
+SAMPLE_TIMEOUT = 5
+
+# Maximum allowed waiting time during the angular examples (in seconds).
+# Protocol moves get a deadline predicted from their length instead.
 TIMEOUT_DURATION = 360
 
 # Create closure to set an event after an END or an ABORT
@@ -78,466 +94,130 @@ def example_angular_action_movement(base):
         print("Timeout on action notification wait")
     return finished
 
-def example_test_movement(base, base_cyclic):
-    
-    print("Starting Cartesian action movement ...")
-    action = Base_pb2.Action()
-    action.name = "Example Cartesian action movement"
-    action.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action.reach_pose.target_pose
-    cartesian_pose.x = feedback.base.tool_pose_x          # (meters)
-    cartesian_pose.y = feedback.base.tool_pose_y     # (meters)
-    cartesian_pose.z = feedback.base.tool_pose_z     # (meters)
-    cartesian_pose.theta_x = feedback.base.tool_pose_theta_x # (degrees)
-    cartesian_pose.theta_y = feedback.base.tool_pose_theta_y # (degrees)
-    cartesian_pose.theta_z = feedback.base.tool_pose_theta_z # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-    
-    # Movement 1
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100        # (meters)
-    cartesian_pose.y = 0/100        # (meters)
-    cartesian_pose.z = 20/100        # (meters)
-    cartesian_pose.theta_x = 90   # (degrees)
-    cartesian_pose.theta_y = 0      # (degrees)
-    cartesian_pose.theta_z = 90     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-        # Movement 2
-    print("Starting Cartesian action movement ...")
-    action2 = Base_pb2.Action()
-    action2.name = "Movement 2- Top Right"
-    action2.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action2.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100      # (meters)
-    cartesian_pose.y = 6/100     # (meters)
-    cartesian_pose.z = 20/100      # (meters)
-    cartesian_pose.theta_x = 90 # (degrees)
-    cartesian_pose.theta_y = 0 # (degrees)
-    cartesian_pose.theta_z = 90 # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action2)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-    
-    
-    # Movement 3
-    print("Starting Cartesian action movement ...")
-    action3 = Base_pb2.Action()
-    action3.name = "Movement 3- Bottom Right"
-    action3.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action3.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100      # (meters)
-    cartesian_pose.y = 6/100     # (meters)
-    cartesian_pose.z = 15/100      # (meters)
-    cartesian_pose.theta_x = 90 # (degrees)
-    cartesian_pose.theta_y = 0 # (degrees)
-    cartesian_pose.theta_z = 90 # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action3)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
- # Movement 4
-    print("Starting Cartesian action movement ...")
-    action3 = Base_pb2.Action()
-    action3.name = "Movement 3- Bottom Right"
-    action3.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action3.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100      # (meters)
-    cartesian_pose.y = 6/100     # (meters)
-    cartesian_pose.z = 13/100      # (meters)
-    cartesian_pose.theta_x = 90 # (degrees)
-    cartesian_pose.theta_y = 0  # (degrees)
-    cartesian_pose.theta_z = 90  # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action3)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Movement 5
-    print("Starting Cartesian action movement ...")
-    action3 = Base_pb2.Action()
-    action3.name = "Movement 3- Bottom Right"
-    action3.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action3.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100      # (meters)
-    cartesian_pose.y = 6/100     # (meters)
-    cartesian_pose.z = 12.9/100      # (meters)
-    cartesian_pose.theta_x = 90  # (degrees)
-    cartesian_pose.theta_y = 0 # (degrees)
-    cartesian_pose.theta_z = 90  # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action3)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Movement 6
-    print("Starting Cartesian action movement ...")
-    action3 = Base_pb2.Action()
-    action3.name = "Movement 3- Bottom Right"
-    action3.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action3.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100      # (meters)
-    cartesian_pose.y = 6/100     # (meters)
-    cartesian_pose.z = 12.8/100      # (meters)
-    cartesian_pose.theta_x = 90 # (degrees)
-    cartesian_pose.theta_y = 0 # (degrees)
-    cartesian_pose.theta_z = 90  # (degrees)
+# End Effector Angle - Unit: degrees
+adx = 90;
+ady = 0;
+adz = 90;
+
+# Multi-Step Depths - Unit: cm
+# Relative to z = 13 cm: one 2 cm drop, then 0.1 cm steps down to 12.1 cm.
+steps = [2, 0] + [-i/10 for i in range(1, 10)];
+
+# Protocol Table
+protocol = [
+    IndentationStep("Movement 1", (40, 0, 20), [0], (adx, ady, adz)),
+    IndentationStep("Movement 2", (40, 6, 20), [0], (adx, ady, adz)),
+    IndentationStep("Multi-Step Indentation", (40, 6, 13), steps,
+                    (adx, ady, adz)),
+    IndentationStep("Retracting Arm", (40, 6, 20), [0], (adx, ady, adz)),
+]
+
+# Low-Level Servoing Ramp
+# With --ramp the 0.1 cm steps below z = 13 cm are streamed as one
+# staircase (0.5 cm/s between stairs, 1 s dwell on each) instead of
+# separate moves, with feedback captured at every setpoint and written
+# to the --record file.
+RAMP_SPEED = 0.5     # (cm/s)
+RAMP_DWELL = 1       # (seconds)
+RAMP_RATE = 1000     # (Hz)
+ramp = staircase([-i/10 for i in range(1, 10)], RAMP_SPEED, RAMP_DWELL)
+ramp_approach = protocol[:2] + [protocol[2]._replace(offsets = [2, 0])]
+ramp_retract = protocol[3:]
+
+def example_ramp_movement(dispatcher, sampler, recorder = None):
+
+    approach = compile_steps(ramp_approach)
+    on_step = on_feedback = None
+    if recorder is not None:
+        sampler.add_listener(recorder.record_feedback)
+        on_step = recorder.begin_step
+        on_feedback = recorder.record_feedback
+
+    try:
+        print("Moving to ramp start ...")
+        snapshot = sampler.wait_for_sample(SAMPLE_TIMEOUT)
+        if snapshot is None:
+            print("No cyclic feedback received")
+            return False
+        if not run_steps(dispatcher, approach, on_step = on_step,
+                         start_pose = snapshot.tool_pose):
+            return False
+
+        # The servo loop refreshes the same cyclic client the sampler
+        # polls, so the sampler is stopped for the ramp and the recorder
+        # is fed from the loop instead
+        if recorder is not None:
+            recorder.begin_step(len(approach), approach[-1])
+        sampler.stop()
+        try:
+            samples = run_depth_ramp(dispatcher.base, sampler.base_cyclic,
+                                     ramp, RAMP_RATE, on_feedback)
+        finally:
+            resumed = time.perf_counter()
+            sampler.start()
+        if samples:
+            print("Captured {} ramp samples, peak force {:.2f} N".format(
+                len(samples),
+                max(abs(sample.force_z) for sample in samples)))
+        else:
+            print("No ramp samples captured")
+
+        print("Retracting ...")
+        snapshot = sampler.wait_for_sample(SAMPLE_TIMEOUT, resumed)
+        if snapshot is None:
+            print("No cyclic feedback received")
+            return False
+        if recorder is not None:
+            on_step = lambda index, compiled_step: recorder.begin_step(
+                len(approach) + 1 + index, compiled_step)
+        return run_steps(dispatcher, compile_steps(ramp_retract),
+                         on_step = on_step, start_pose = snapshot.tool_pose)
+    except ActionAborted as error:
+        print(error)
+        return False
+    finally:
+        if recorder is not None:
+            sampler.remove_listener(recorder.record_feedback)
+            recorder.end_steps()
+
+def example_test_movement(dispatcher, sampler, sequence = False,
+                          recorder = None):
+
+    compiled = compile_steps(protocol)
 
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action3)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Movement 7
     print("Starting Cartesian action movement ...")
-    action3 = Base_pb2.Action()
-    action3.name = "Movement 3- Bottom Right"
-    action3.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action3.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100      # (meters)
-    cartesian_pose.y = 6/100     # (meters)
-    cartesian_pose.z = 12.7/100      # (meters)
-    cartesian_pose.theta_x = 90  # (degrees)
-    cartesian_pose.theta_y = 0  # (degrees)
-    cartesian_pose.theta_z = 90  # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action3)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-    # Movement 8
-    print("Starting Cartesian action movement ...")
-    action3 = Base_pb2.Action()
-    action3.name = "Movement 3- Bottom Right"
-    action3.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action3.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100      # (meters)
-    cartesian_pose.y = 6/100     # (meters)
-    cartesian_pose.z = 12.6/100      # (meters)
-    cartesian_pose.theta_x = 90  # (degrees)
-    cartesian_pose.theta_y = 0  # (degrees)
-    cartesian_pose.theta_z = 90  # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action3)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Movement 8
-    print("Starting Cartesian action movement ...")
-    action3 = Base_pb2.Action()
-    action3.name = "Movement 3- Bottom Right"
-    action3.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action3.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100      # (meters)
-    cartesian_pose.y = 6/100     # (meters)
-    cartesian_pose.z = 12.5/100      # (meters)
-    cartesian_pose.theta_x = 90  # (degrees)
-    cartesian_pose.theta_y = 0  # (degrees)
-    cartesian_pose.theta_z = 90  # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-    print("Executing action")
-    base.ExecuteAction(action3)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-    
-    # Movement 9
-    print("Starting Cartesian action movement ...")
-    action3 = Base_pb2.Action()
-    action3.name = "Movement 3- Bottom Right"
-    action3.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action3.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100      # (meters)
-    cartesian_pose.y = 6/100     # (meters)
-    cartesian_pose.z = 12.4/100      # (meters)
-    cartesian_pose.theta_x = 90  # (degrees)
-    cartesian_pose.theta_y = 0  # (degrees)
-    cartesian_pose.theta_z = 90  # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-    print("Executing action")
-    base.ExecuteAction(action3)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-    # Movement 10
-    print("Starting Cartesian action movement ...")
-    action3 = Base_pb2.Action()
-    action3.name = "Movement 3- Bottom Right"
-    action3.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action3.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100      # (meters)
-    cartesian_pose.y = 6/100     # (meters)
-    cartesian_pose.z = 12.3/100      # (meters)
-    cartesian_pose.theta_x = 90  # (degrees)
-    cartesian_pose.theta_y = 0  # (degrees)
-    cartesian_pose.theta_z = 90  # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-    print("Executing action")
-    base.ExecuteAction(action3)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Movement 11
-    print("Starting Cartesian action movement ...")
-    action3 = Base_pb2.Action()
-    action3.name = "Movement 3- Bottom Right"
-    action3.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action3.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100      # (meters)
-    cartesian_pose.y = 6/100     # (meters)
-    cartesian_pose.z = 12.2/100      # (meters)
-    cartesian_pose.theta_x = 90  # (degrees)
-    cartesian_pose.theta_y = 0  # (degrees)
-    cartesian_pose.theta_z = 90  # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-    print("Executing action")
-    base.ExecuteAction(action3)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Movement 12
-    print("Starting Cartesian action movement ...")
-    action3 = Base_pb2.Action()
-    action3.name = "Movement 3- Bottom Right"
-    action3.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action3.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100      # (meters)
-    cartesian_pose.y = 6/100     # (meters)
-    cartesian_pose.z = 12.1/100      # (meters)
-    cartesian_pose.theta_x = 90  # (degrees)
-    cartesian_pose.theta_y = 0  # (degrees)
-    cartesian_pose.theta_z = 90  # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-    print("Executing action")
-    base.ExecuteAction(action3)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-
-# Movement 12
-    print("Starting Cartesian action movement ...")
-    action3 = Base_pb2.Action()
-    action3.name = "Movement 3- Bottom Right"
-    action3.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action3.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = 40/100      # (meters)
-    cartesian_pose.y = 6/100     # (meters)
-    cartesian_pose.z = 20/100      # (meters)
-    cartesian_pose.theta_x = 90  # (degrees)
-    cartesian_pose.theta_y = 0  # (degrees)
-    cartesian_pose.theta_z = 90  # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-    print("Executing action")
-    base.ExecuteAction(action3)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
+    snapshot = sampler.wait_for_sample(SAMPLE_TIMEOUT)
+    if snapshot is None:
+        print("No cyclic feedback received")
+        return False
+    action = build_current_pose_action(snapshot.tool_pose)
+
+    # Tag recorded feedback with the step that is running
+    on_step = None
+    if recorder is not None:
+        sampler.add_listener(recorder.record_feedback)
+        on_step = recorder.begin_step
+
+    try:
+        print("Executing action")
+        execute_action(dispatcher, action, start_pose = snapshot.tool_pose)
+
+        print("Waiting for movement to finish ...")
+        if sequence:
+            # Upload the whole run and let the controller step through it
+            finished = run_sequence(dispatcher.base, compiled,
+                                    on_step = on_step,
+                                    start_pose = snapshot.tool_pose)
+        else:
+            finished = run_steps(dispatcher, compiled, on_step = on_step,
+                                 start_pose = snapshot.tool_pose)
+    except ActionAborted as error:
+        print(error)
+        finished = False
+    finally:
+        if recorder is not None:
+            sampler.remove_listener(recorder.record_feedback)
+            recorder.end_steps()
 
     if finished:
         print("Cartesian movement completed")
@@ -579,29 +259,62 @@ def example_angular_trajectory_movement(base):
 
 def main():
     
-    # Import the utilities helper module
+    # Import the utilities helper module, or the offline simulator when
+    # run with --simulate
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
+    utilities, BaseClient, BaseCyclicClient = kortex_sim.select_backend()
 
     # Parse arguments
-    args = utilities.parseConnectionArguments()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sequence", action = "store_true",
+                        help = "upload the protocol as one controller-side "
+                               "sequence")
+    parser.add_argument("--ramp", action = "store_true",
+                        help = "stream the 0.1 cm steps as one low-level "
+                               "servoing staircase")
+    parser.add_argument("--record", metavar = "PATH",
+                        help = "record cyclic feedback, including every "
+                               "ramp tick, to a telemetry file")
+    args = utilities.parseConnectionArguments(parser)
     
     # Create connection to the device and get the router
     with utilities.DeviceConnection.createTcpConnection(args) as router:
 
         # Create required services
         base = BaseClient(router)
-        base_cyclic = BaseCyclicClient(router)
-
-        # Example core
-        success = True
 
-        #success &= example_cartesian_action_movement(base, base_cyclic)
-        #success &= example_angular_action_movement(base)
-        success &= example_test_movement(base, base_cyclic)
-        #success &= example_angular_trajectory_movement(base)
-        
-        #success &= example_move_to_pack_position(base)
+        # Cyclic feedback is polled over UDP by a background sampler, and
+        # one action notification subscription serves the whole session
+        with utilities.DeviceConnection.createUdpConnection(args) \
+                as router_real_time, \
+             FeedbackSampler(BaseCyclicClient(router_real_time),
+                             SAMPLE_RATE) as sampler, \
+             ActionDispatcher(base) as dispatcher:
+
+            # Flush and close the recorder however the run ends
+            recorder = None
+            try:
+                if args.record:
+                    recorder = TelemetryRecorder(args.record)
+
+                # Example core
+                success = True
+
+                #success &= example_cartesian_action_movement(base,
+                #                                             base_cyclic)
+                #success &= example_angular_action_movement(base)
+                if args.ramp:
+                    success &= example_ramp_movement(dispatcher, sampler,
+                                                     recorder)
+                else:
+                    success &= example_test_movement(dispatcher, sampler,
+                                                     args.sequence, recorder)
+                #success &= example_angular_trajectory_movement(base)
+
+                #success &= example_move_to_pack_position(base)
+            finally:
+                if recorder is not None:
+                    recorder.close()
 
         return 0 if success else 1
 
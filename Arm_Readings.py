@@ -28,6 +28,12 @@ from kortex_api.autogen.client_stubs.BaseCyclicClientRpc import BaseCyclicClient
 
 from kortex_api.autogen.messages import Base_pb2, BaseCyclic_pb2, Common_pb2
 
+import kortex_sim
+from action_notifications import ActionDispatcher, ActionAborted
+from feedback_sampler import FeedbackSampler
+from indentation_steps import IndentationStep, compile_steps, run_steps, \
+    execute_action, build_current_pose_action
+
 #DEFINITIONS:
 
 #Index Variables
@@ -66,240 +72,51 @@ P2 = [47, 10, -3.5]; #Top Right
 P3 = [30, -14, -3.5]; #Bottom Right
 P4 = [30, 10, -3.5]; #Bottom Left
 
-# Maximum allowed waiting time during actions (in seconds)
-TIMEOUT_DURATION = 1000
-
-# Create closure to set an event after an END or an ABORT
-def check_for_end_or_abort(e):
-    """Return a closure checking for END or ABORT notifications
-    Arguments:
-    e -- event to signal when the action is completed
-        (will be set when an END or ABORT occurs)
-    """
-    def check(notification, e = e):
-        print("EVENT : " + \
-              Base_pb2.ActionEvent.Name(notification.action_event))
-        if notification.action_event == Base_pb2.ACTION_END \
-        or notification.action_event == Base_pb2.ACTION_ABORT:
-            e.set()
-    return check
-
-def example_test_movement(base, base_cyclic):
-    
-    print("Starting Cartesian action movement ...")
-    action = Base_pb2.Action()
-    action.name = "Example Cartesian action movement"
-    action.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action.reach_pose.target_pose
-    cartesian_pose.x = feedback.base.tool_pose_x          # (meters)
-    cartesian_pose.y = feedback.base.tool_pose_y     # (meters)
-    cartesian_pose.z = feedback.base.tool_pose_z     # (meters)
-    cartesian_pose.theta_x = feedback.base.tool_pose_theta_x # (degrees)
-    cartesian_pose.theta_y = feedback.base.tool_pose_theta_y # (degrees)
-    cartesian_pose.theta_z = feedback.base.tool_pose_theta_z # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-    
-    # Movement 1
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
+# Cyclic feedback sampling rate (Hz) and maximum wait for the first
+# sample (in seconds)
+SAMPLE_RATE = 500
+SAMPLE_TIMEOUT = 5
 
-    feedback = base_cyclic.RefreshFeedback()
+# Maximum allowed waiting time during actions (in seconds). None lets
+# the step engine predict each move's deadline from its length.
+TIMEOUT_DURATION = None
 
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = soft[x]/100        # (meters)
-    cartesian_pose.y = softy/100       # (meters)
-    cartesian_pose.z = softz/100        # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-	
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Movement 2
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
+# Indentation Depths - Unit: cm
+depths = [0, -0.2, -0.4, -0.6, -0.8, -1];
 
-    feedback = base_cyclic.RefreshFeedback()
+# Protocol Table
+# The first reading is taken with the tube over the phantom center
+# (soft[x]); the rest are offset by the tube radius (softx).
+protocol = [
+    IndentationStep("Movement 1", (soft[x], softy, softz), [0],
+                    (adx, ady, adz)),
+    IndentationStep("Soft Indentation", (softx, softy, softz), depths[1:],
+                    (adx, ady, adz)),
+]
 
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = softx/100       # (meters)
-    cartesian_pose.y = softy/100             # (meters)
-    cartesian_pose.z = softz/100 - 0.2/100       # (meters)
-    cartesian_pose.theta_x = adx     # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Movement 3
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
+def example_test_movement(dispatcher, sampler):
 
-    feedback = base_cyclic.RefreshFeedback()
+    compiled = compile_steps(protocol)
 
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = softx/100        # (meters)
-    cartesian_pose.y = softy/100       # (meters)
-    cartesian_pose.z = softz/100 - 0.4/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Movement 4
     print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
+    snapshot = sampler.wait_for_sample(SAMPLE_TIMEOUT)
+    if snapshot is None:
+        print("No cyclic feedback received")
+        return False
+    action = build_current_pose_action(snapshot.tool_pose)
+
+    try:
+        print("Executing action")
+        execute_action(dispatcher, action, TIMEOUT_DURATION,
+                       snapshot.tool_pose)
+
+        print("Waiting for movement to finish ...")
+        finished = run_steps(dispatcher, compiled, TIMEOUT_DURATION,
+                             start_pose = snapshot.tool_pose)
+    except ActionAborted as error:
+        print(error)
+        finished = False
 
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = softx/100        # (meters)
-    cartesian_pose.y = softy/100       # (meters)
-    cartesian_pose.z = softz/100 - 0.6/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Movement 5
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = softx/100        # (meters)
-    cartesian_pose.y = softy/100       # (meters)
-    cartesian_pose.z = softz/100 - 0.8/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-# Movement 6
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
-    # These are loaded directly from Kinova Web app (the first three are divided by 100 since it gives them in mm)
-    
-    cartesian_pose.x = softx/100        # (meters)
-    cartesian_pose.y = softy/100       # (meters)
-    cartesian_pose.z = softz/100 - 1/100       # (meters)
-    cartesian_pose.theta_x = adx   # (degrees)
-    cartesian_pose.theta_y = ady     # (degrees)
-    cartesian_pose.theta_z = adz     # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-    
     if finished:
         print("Cartesian movement completed")
     else:
@@ -308,9 +125,10 @@ def example_test_movement(base, base_cyclic):
 
 def main():
     
-    # Import the utilities helper module
+    # Import the utilities helper module, or the offline simulator when
+    # run with --simulate
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
+    utilities, BaseClient, BaseCyclicClient = kortex_sim.select_backend()
 
     # Parse arguments
     args = utilities.parseConnectionArguments()
@@ -320,12 +138,19 @@ def main():
 
         # Create required services
         base = BaseClient(router)
-        base_cyclic = BaseCyclicClient(router)
 
-        # Example core
-        success = True
-        success &= example_test_movement(base, base_cyclic)
-        #success &= example_test_movement(base, base_cyclic)
+        # Cyclic feedback is polled over UDP by a background sampler, and
+        # one action notification subscription serves the whole session
+        with utilities.DeviceConnection.createUdpConnection(args) \
+                as router_real_time, \
+             FeedbackSampler(BaseCyclicClient(router_real_time),
+                             SAMPLE_RATE) as sampler, \
+             ActionDispatcher(base) as dispatcher:
+
+            # Example core
+            success = True
+            success &= example_test_movement(dispatcher, sampler)
+            #success &= example_test_movement(dispatcher, sampler)
 
         return 0 if success else 1
 
@@ -13,26 +13,58 @@
 #
 # Refer to the LICENSE file for details.
 
-x_cart = float(input("Enter X Coordinate: "))
-y_cart = float(input("Enter Y Coordinate: "))
-z_cart = float(input("Enter Z Coordinate: "))
-#x_ang  = int(input("Enter X End Effector Angle: ")) 
-#y_ang  = int(input("Enter Y End Effector Angle: "))
-#z_ang  = int(input("Enter Z End Effector Angle: "))
+# Batch mode: "--batch points.csv" (or "--batch -" for stdin) runs many
+# points in one session instead of prompting for one. Each line holds
+# X, Y, Z (cm) and optionally the end effector angles (degrees); a header
+# line and "#" comments are skipped. Upcoming points are parsed and built
+# into actions on a reader thread while the arm moves, each is sent as
+# soon as the previous one ends, and one result line per point is
+# appended to the --results file as it finishes.
 
 import sys
 import os
+import csv
 import time
+import queue
+import argparse
 import threading
+import collections
 
 from kortex_api.autogen.client_stubs.BaseClientRpc import BaseClient
 from kortex_api.autogen.client_stubs.BaseCyclicClientRpc import BaseCyclicClient
 
 from kortex_api.autogen.messages import Base_pb2, BaseCyclic_pb2, Common_pb2
 
+import kortex_sim
+from action_notifications import ActionDispatcher, ActionAborted
+from feedback_sampler import FeedbackSampler
+from indentation_steps import build_pose_action, build_current_pose_action, \
+    execute_action, target_pose
+
 # Maximum allowed waiting time during actions (in seconds)
 TIMEOUT_DURATION = 180
 
+# Default End Effector Angle - Unit: degrees
+theta_x = 0;
+theta_y = -180;
+theta_z = 90;
+
+# Cyclic feedback sampling rate (Hz) and maximum wait for the first
+# sample (in seconds)
+SAMPLE_RATE = 500
+SAMPLE_TIMEOUT = 5
+
+# Points parsed and built ahead of the arm in batch mode
+PREFETCH = 4
+
+# One batch point, ready to send: the input line it came from, its pose
+# (cm / degrees) and action, or the reason it could not be read
+PreparedPoint = collections.namedtuple(
+    "PreparedPoint", ["line", "pose", "action", "error"])
+
+RESULT_FIELDS = ["line", "x", "y", "z", "theta_x", "theta_y", "theta_z",
+                 "status", "seconds", "reached_x", "reached_y", "reached_z"]
+
 # Create closure to set an event after an END or an ABORT
 def check_for_end_or_abort(e):
     """Return a closure checking for END or ABORT notifications
@@ -82,66 +114,30 @@ def example_angular_action_movement(base):
         print("Timeout on action notification wait")
     return finished
 
-def example_test_movement(base, base_cyclic):
+def example_test_movement(dispatcher, sampler, x_cart, y_cart, z_cart):
     
     print("Starting Cartesian action movement ...")
-    action = Base_pb2.Action()
-    action.name = "Example Cartesian action movement"
-    action.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action.reach_pose.target_pose
-    cartesian_pose.x = feedback.base.tool_pose_x          # (meters)
-    cartesian_pose.y = feedback.base.tool_pose_y         # (meters)
-    cartesian_pose.z = feedback.base.tool_pose_z         # (meters)
-    cartesian_pose.theta_x = feedback.base.tool_pose_theta_x # (degrees)
-    cartesian_pose.theta_y = feedback.base.tool_pose_theta_y # (degrees)
-    cartesian_pose.theta_z = feedback.base.tool_pose_theta_z # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
+    snapshot = sampler.wait_for_sample(SAMPLE_TIMEOUT)
+    if snapshot is None:
+        print("No cyclic feedback received")
+        return False
+    action = build_current_pose_action(snapshot.tool_pose)
 
-    print("Executing action")
-    base.ExecuteAction(action)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-    
     # Movement 1
-    print("Starting Cartesian action movement ...")
-    action1 = Base_pb2.Action()
-    action1.name = "Movement 1- Top Left"
-    action1.application_data = ""
-
-    feedback = base_cyclic.RefreshFeedback()
-
-    cartesian_pose = action1.reach_pose.target_pose
     # These are loaded directly from Kinova Web app "Cartesian" menu. 
-    
-    cartesian_pose.x = x_cart/100        # (meters)
-    cartesian_pose.y = y_cart/100        # (meters)
-    cartesian_pose.z = z_cart/100        # (meters)
-    cartesian_pose.theta_x = 0   # (degrees)
-    cartesian_pose.theta_y = -180      # (degrees)
-    cartesian_pose.theta_z = 90     # (degrees)
+    action1 = build_pose_action("Movement 1- Top Left", x_cart/100,
+                                y_cart/100, z_cart/100, theta_x, theta_y,
+                                theta_z)
 
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
+    try:
+        print("Executing action")
+        execute_action(dispatcher, action, TIMEOUT_DURATION)
 
-    print("Executing action")
-    base.ExecuteAction(action1)
-
-    print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
+        print("Waiting for movement to finish ...")
+        finished = execute_action(dispatcher, action1, TIMEOUT_DURATION)
+    except ActionAborted as error:
+        print(error)
+        finished = False
 
     if finished:
         print("Cartesian movement completed")
@@ -149,28 +145,189 @@ def example_test_movement(base, base_cyclic):
         print("Timeout on action notification wait")
     return finished
 
+def prepare_points(lines, prepared):
+    """Parse CSV point lines and queue a PreparedPoint for each, then
+    None once the input ends
+    """
+    try:
+        for number, row in enumerate(csv.reader(lines), 1):
+            if not row or not "".join(row).strip() \
+            or row[0].strip().startswith("#"):
+                continue
+            try:
+                values = [float(value) for value in row]
+            except ValueError:
+                if number > 1:
+                    prepared.put(PreparedPoint(number, None, None,
+                                               "not a number"))
+                continue
+            if len(values) == 3:
+                values += [theta_x, theta_y, theta_z]
+            elif len(values) != 6:
+                prepared.put(PreparedPoint(number, None, None,
+                                           "expected 3 or 6 values"))
+                continue
+            x, y, z, angle_x, angle_y, angle_z = values
+            action = build_pose_action(
+                "Point (line {})".format(number), x/100, y/100, z/100,
+                angle_x, angle_y, angle_z)
+            prepared.put(PreparedPoint(number, tuple(values), action, None))
+    finally:
+        prepared.put(None)
+
+def write_results(sampler, outcomes, results):
+    """Write one RESULT_FIELDS line per outcome queued by run_batch, until
+    None is queued
+
+    The reached position is the first feedback sample after the move
+    ended, so waiting for it never holds up the next move.
+    """
+    writer = csv.writer(results)
+    writer.writerow(RESULT_FIELDS)
+    results.flush()
+    while True:
+        outcome = outcomes.get()
+        if outcome is None:
+            return
+        point, status, seconds, ended = outcome
+        if point.pose is None:
+            writer.writerow([point.line] + [""] * 6 + [status] + [""] * 4)
+        else:
+            reached = ["", "", ""]
+            snapshot = sampler.wait_for_sample(SAMPLE_TIMEOUT, ended)
+            if snapshot is not None:
+                reached = ["{:.3f}".format(value * 100)
+                           for value in snapshot.tool_pose[:3]]
+            writer.writerow([point.line]
+                            + ["{:g}".format(value) for value in point.pose]
+                            + [status, "{:.3f}".format(seconds)] + reached)
+        results.flush()
+
+def run_batch(dispatcher, sampler, lines, results, timeout = None):
+    """Move to every point of a CSV stream in one session
+    Arguments:
+    lines   -- iterable of CSV lines, e.g. an open file or sys.stdin
+    results -- open text file; one RESULT_FIELDS line is written and
+               flushed per point as it finishes
+    timeout -- maximum wait per move (seconds), None to predict it
+
+    Reading and building the next points and writing results run on
+    their own threads, so the arm goes from one point to the next
+    without waiting on either. Lines that cannot be read are reported
+    and skipped. The batch stops at the first move that times out or
+    aborts. Returns True if every line was a point that was reached.
+    """
+    snapshot = sampler.wait_for_sample(SAMPLE_TIMEOUT)
+    if snapshot is None:
+        print("No cyclic feedback received")
+        return False
+    pose = snapshot.tool_pose
+
+    prepared = queue.Queue(PREFETCH)
+    reader = threading.Thread(target = prepare_points,
+                              args = (lines, prepared),
+                              name = "PointReader", daemon = True)
+    outcomes = queue.Queue()
+    writer = threading.Thread(target = write_results,
+                              args = (sampler, outcomes, results),
+                              name = "ResultWriter")
+    reader.start()
+    writer.start()
+
+    success = True
+    count = 0
+    try:
+        while True:
+            point = prepared.get()
+            if point is None:
+                break
+            if point.action is None:
+                print("Line {}: {}".format(point.line, point.error))
+                outcomes.put((point, "invalid", None, None))
+                success = False
+                continue
+
+            count += 1
+            print("Point {}: line {}, {}".format(
+                count, point.line, ", ".join("{:g}".format(value)
+                                             for value in point.pose)))
+            start = time.perf_counter()
+            try:
+                status = "reached" if execute_action(
+                    dispatcher, point.action, timeout, pose) else "timeout"
+            except ActionAborted as error:
+                print(error)
+                status = "aborted"
+            ended = time.perf_counter()
+            outcomes.put((point, status, ended - start, ended))
+            if status != "reached":
+                print("Stopping batch at line {}".format(point.line))
+                return False
+            pose = target_pose(point.action)
+    finally:
+        outcomes.put(None)
+        writer.join()
+
+    print("Batch completed: {} points".format(count))
+    return success
+
 def main():
     
-    # Import the utilities helper module
+    # Import the utilities helper module, or the offline simulator when
+    # run with --simulate
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
+    utilities, BaseClient, BaseCyclicClient = kortex_sim.select_backend()
 
     # Parse arguments
-    args = utilities.parseConnectionArguments()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", metavar = "PATH",
+                        help = "CSV file of points to visit, \"-\" for "
+                               "stdin")
+    parser.add_argument("--results", metavar = "PATH",
+                        default = "results.csv",
+                        help = "CSV file the batch results are written to")
+    args = utilities.parseConnectionArguments(parser)
+
+    if not args.batch:
+        x_cart = float(input("Enter X Coordinate: "))
+        y_cart = float(input("Enter Y Coordinate: "))
+        z_cart = float(input("Enter Z Coordinate: "))
+        #x_ang  = int(input("Enter X End Effector Angle: ")) 
+        #y_ang  = int(input("Enter Y End Effector Angle: "))
+        #z_ang  = int(input("Enter Z End Effector Angle: "))
     
     # Create connection to the device and get the router
     with utilities.DeviceConnection.createTcpConnection(args) as router:
 
         # Create required services
         base = BaseClient(router)
-        base_cyclic = BaseCyclicClient(router)
-
-        # Example core
-        success = True
 
-        #success &= example_cartesian_action_movement(base, base_cyclic)
-        #success &= example_angular_action_movement(base)
-        success &= example_test_movement(base, base_cyclic)
+        # Cyclic feedback is polled over UDP by a background sampler, and
+        # one action notification subscription serves the whole session
+        with utilities.DeviceConnection.createUdpConnection(args) \
+                as router_real_time, \
+             FeedbackSampler(BaseCyclicClient(router_real_time),
+                             SAMPLE_RATE) as sampler, \
+             ActionDispatcher(base) as dispatcher:
+
+            # Example core
+            success = True
+
+            #success &= example_cartesian_action_movement(base, base_cyclic)
+            #success &= example_angular_action_movement(base)
+            if args.batch:
+                lines = sys.stdin if args.batch == "-" \
+                        else open(args.batch, newline = "")
+                try:
+                    with open(args.results, "w", newline = "") as results:
+                        success &= run_batch(dispatcher, sampler, lines,
+                                             results)
+                finally:
+                    if lines is not sys.stdin:
+                        lines.close()
+            else:
+                success &= example_test_movement(dispatcher, sampler,
+                                                 x_cart, y_cart, z_cart)
         
         #success &= example_move_to_pack_position(base)
 
@@ -0,0 +1,172 @@
+#! /usr/bin/env python3
+
+
+### Action Notification Dispatcher ###
+
+# The example scripts open an action-topic subscription before every
+# move and unsubscribe after it, which costs two RPCs per step. Here a
+# single subscription is opened for the whole session and each
+# notification is routed to the waiter that owns the action it refers
+# to.
+#
+# Ownership works like this: ExecuteAction does not return the handle
+# of the action it starts, so the dispatcher hands the first
+# ACTION_START after an ExecuteAction to the waiter that issued it, and
+# from then on routes by notification.handle.identifier. An action the
+# arm rejects (e.g. an unreachable pose) aborts without ever starting,
+# so an END or ABORT for an identifier never seen before also goes to
+# the waiting action. The identifiers of finished and replaced actions
+# are remembered, and late notifications for them (e.g. the END of the
+# previous action) are dropped instead of completing the wrong step.
+#
+# An ABORT is not a completion: waiters report it through aborted(), and
+# the step engine raises ActionAborted carrying the abort details.
+
+import threading
+import collections
+
+from kortex_api.autogen.messages import Base_pb2, Errors_pb2
+
+# Identifiers of finished actions remembered to drop late notifications
+RETIRED_LENGTH = 64
+
+def abort_reason(notification):
+    """Readable name of a notification's abort_details sub-error code
+    """
+    try:
+        return Errors_pb2.SubErrorCodes.Name(notification.abort_details)
+    except ValueError:
+        return str(notification.abort_details)
+
+class ActionAborted(Exception):
+    """An action or sequence task ended with an abort instead of an end
+    Attributes:
+    name         -- name of the action that aborted
+    notification -- the ABORT notification, with its abort_details
+    """
+    def __init__(self, name, notification):
+        super().__init__("{} aborted: {}".format(
+            name, abort_reason(notification)))
+        self.name = name
+        self.notification = notification
+
+class ActionWaiter:
+    """Completion state of one action sent through an ActionDispatcher
+    """
+    def __init__(self, name):
+        self.name = name
+        self.identifier = None
+        self.notification = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def notify(self, notification):
+        print("EVENT : " + \
+              Base_pb2.ActionEvent.Name(notification.action_event))
+        if notification.action_event == Base_pb2.ACTION_END \
+        or notification.action_event == Base_pb2.ACTION_ABORT:
+            with self._lock:
+                self.notification = notification
+                self._event.set()
+                callbacks, self._callbacks = self._callbacks, []
+            for callback in callbacks:
+                callback(notification)
+
+    def add_done_callback(self, callback):
+        """Call callback(notification) once the action ends or aborts
+
+        Runs on the notification thread, or right away if the action has
+        already finished.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self.notification)
+
+    def done(self):
+        return self._event.is_set()
+
+    def aborted(self):
+        """True once the action has ended with ACTION_ABORT
+        """
+        return self.notification is not None \
+            and self.notification.action_event == Base_pb2.ACTION_ABORT
+
+    def wait(self, timeout):
+        """Block until END or ABORT, returns False on timeout
+        """
+        return self._event.wait(timeout)
+
+class ActionDispatcher:
+    """Session-wide action notification subscription
+
+    Use as a context manager around the session:
+
+        with ActionDispatcher(base) as dispatcher:
+            waiter = dispatcher.execute(action)
+            waiter.wait(TIMEOUT_DURATION)
+    """
+    def __init__(self, base):
+        self.base = base
+        self._lock = threading.Lock()
+        self._owners = {}
+        self._retired = collections.deque(maxlen = RETIRED_LENGTH)
+        self._pending = None
+        self._notification_handle = None
+
+    def open(self):
+        if self._notification_handle is None:
+            self._notification_handle = self.base.OnNotificationActionTopic(
+                self._on_notification,
+                Base_pb2.NotificationOptions()
+            )
+        return self
+
+    def close(self):
+        if self._notification_handle is not None:
+            self.base.Unsubscribe(self._notification_handle)
+            self._notification_handle = None
+        with self._lock:
+            self._owners.clear()
+            self._pending = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def execute(self, action):
+        """Send an action and return the ActionWaiter that tracks it
+        """
+        waiter = ActionWaiter(action.name)
+        # The arm runs one action at a time, so anything still owned
+        # belongs to an action that the new one replaces.
+        with self._lock:
+            self._retired.extend(self._owners)
+            self._owners.clear()
+            self._pending = waiter
+            self.base.ExecuteAction(action)
+        return waiter
+
+    def _on_notification(self, notification):
+        identifier = notification.handle.identifier
+        finished = notification.action_event == Base_pb2.ACTION_END \
+            or notification.action_event == Base_pb2.ACTION_ABORT
+        with self._lock:
+            waiter = self._owners.get(identifier)
+            if waiter is None and self._pending is not None \
+            and identifier not in self._retired \
+            and (notification.action_event == Base_pb2.ACTION_START \
+            or finished):
+                waiter = self._pending
+                waiter.identifier = identifier
+                self._owners[identifier] = waiter
+                self._pending = None
+            if waiter is not None and finished:
+                del self._owners[identifier]
+                self._retired.append(identifier)
+        if waiter is not None:
+            waiter.notify(notification)
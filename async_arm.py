@@ -0,0 +1,197 @@
+#! /usr/bin/env python3
+
+
+### asyncio Action API ###
+
+# Awaitable moves on top of the ActionDispatcher. Instead of blocking a
+# thread in Event.wait() per move, each action gets an asyncio future
+# that the notification thread resolves through
+# loop.call_soon_threadsafe, so one event loop can drive motion, sensor
+# capture, logging and a UI side by side:
+#
+#     async with AsyncArm(base) as arm:
+#         await arm.reach_pose(0.45, 0.05, 0.10, 90, 0, 90)
+#
+# Blocking RPCs (ExecuteAction, Stop) run in the loop's default executor
+# so they never stall other tasks. Cancelling an awaiting move stops the
+# arm. Deadlines are predicted from each move's length like in the step
+# engine, and an aborted move raises ActionAborted.
+#
+# Example (runs a reading script's protocol while logging the tool
+# force every 0.5 s on the same loop):
+#   python3 async_arm.py --simulate --time_scale 0.1
+
+import os
+import sys
+import asyncio
+import argparse
+
+import kortex_sim
+from action_notifications import ActionDispatcher, ActionAborted
+from feedback_sampler import FeedbackSampler
+from benchmark_motion import DEFAULT_SCRIPT, load_protocol
+from indentation_steps import build_pose_action, build_current_pose_action, \
+    compile_steps, move_timeout, target_pose
+
+# Cyclic feedback sampling rate (Hz) for the example
+SAMPLE_RATE = 100
+
+class AsyncArm:
+    """asyncio front end for one arm's actions
+
+    Must be opened from a running event loop. Pass an already open
+    ActionDispatcher to share its subscription; otherwise the arm opens
+    and closes its own.
+    """
+    def __init__(self, base, dispatcher = None):
+        self.base = base
+        self.dispatcher = dispatcher
+        self._own_dispatcher = dispatcher is None
+        self._loop = None
+        self._lock = None
+        self._pose = None
+
+    async def open(self):
+        self._loop = asyncio.get_running_loop()
+        self._lock = asyncio.Lock()
+        if self._own_dispatcher:
+            self.dispatcher = await self._loop.run_in_executor(
+                None, ActionDispatcher(self.base).open)
+        return self
+
+    async def close(self):
+        if self._own_dispatcher and self.dispatcher is not None:
+            await self._loop.run_in_executor(None, self.dispatcher.close)
+            self.dispatcher = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def execute(self, action, timeout = None):
+        """Send a reach_pose action and wait for it to end
+        Arguments:
+        action  -- action message to send
+        timeout -- maximum wait (seconds), None to predict it from the
+                   move (see indentation_steps.move_timeout)
+
+        Returns the END notification. Raises ActionAborted if the action
+        aborts and asyncio.TimeoutError on timeout; the arm is stopped on
+        timeout or cancellation.
+        """
+        if timeout is None:
+            timeout = move_timeout(action, self._pose)
+        future = self._loop.create_future()
+
+        def resolve(notification):
+            if not future.done():
+                future.set_result(notification)
+
+        # Sending is serialized so the dispatcher pairs each ACTION_START
+        # with the action that caused it.
+        async with self._lock:
+            waiter = await self._loop.run_in_executor(
+                None, self.dispatcher.execute, action)
+        waiter.add_done_callback(
+            lambda notification:
+                self._loop.call_soon_threadsafe(resolve, notification))
+        try:
+            notification = await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self._pose = None
+            await asyncio.shield(
+                self._loop.run_in_executor(None, self.base.Stop))
+            raise
+        if waiter.aborted():
+            self._pose = None
+            raise ActionAborted(action.name, notification)
+        self._pose = target_pose(action)
+        return notification
+
+    async def reach_pose(self, x, y, z, theta_x, theta_y, theta_z,
+                         name = "", timeout = None):
+        """Move the tool to a pose (meters / degrees)
+        Returns the END notification.
+        """
+        action = build_pose_action(name, x, y, z, theta_x, theta_y, theta_z)
+        return await self.execute(action, timeout)
+
+    async def reach_current_pose(self, sampler, timeout = None):
+        """Send the tool to its own measured pose, e.g. to start a run
+        """
+        snapshot = sampler.latest()
+        if snapshot is None:
+            return None
+        self._pose = snapshot.tool_pose
+        return await self.execute(
+            build_current_pose_action(snapshot.tool_pose), timeout)
+
+    async def run_steps(self, compiled, timeout = None, on_step = None):
+        """Awaitable counterpart of indentation_steps.run_steps
+        Returns False at the first timeout. Raises ActionAborted if a step
+        aborts.
+        """
+        for index, compiled_step in enumerate(compiled):
+            print("Step {}/{}: {}".format(
+                index + 1, len(compiled), compiled_step.action.name))
+            if on_step is not None:
+                on_step(index, compiled_step)
+            try:
+                await self.execute(compiled_step.action, timeout)
+            except asyncio.TimeoutError:
+                print("Timeout on action notification wait")
+                return False
+            if compiled_step.step.dwell:
+                await asyncio.sleep(compiled_step.step.dwell)
+        return True
+
+async def log_force(sampler, period = 0.5):
+    """Print the tool force along z every period seconds"""
+    while True:
+        snapshot = sampler.latest()
+        if snapshot is not None:
+            print("force_z = {:.2f} N".format(snapshot.tool_wrench[2]))
+        await asyncio.sleep(period)
+
+async def run_example(base, sampler, protocol):
+    compiled = compile_steps(protocol)
+    logger = asyncio.ensure_future(log_force(sampler))
+    try:
+        async with AsyncArm(base) as arm:
+            await arm.reach_current_pose(sampler)
+            return await arm.run_steps(compiled)
+    finally:
+        logger.cancel()
+
+def main():
+
+    # Import the utilities helper module, or the offline simulator when
+    # run with --simulate
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+    utilities, BaseClient, BaseCyclicClient = kortex_sim.select_backend()
+
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", default = DEFAULT_SCRIPT,
+                        help = "reading script whose protocol table to run")
+    args = utilities.parseConnectionArguments(parser)
+    protocol = load_protocol(args.script)
+
+    # Create connection to the device and get the router
+    with utilities.DeviceConnection.createTcpConnection(args) as router, \
+         utilities.DeviceConnection.createUdpConnection(args) \
+            as router_real_time, \
+         FeedbackSampler(BaseCyclicClient(router_real_time),
+                         SAMPLE_RATE) as sampler:
+        base = BaseClient(router)
+        if sampler.wait_for_sample(5) is None:
+            print("No cyclic feedback received")
+            return 1
+        success = asyncio.run(run_example(base, sampler, protocol))
+
+    return 0 if success else 1
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,264 @@
+#! /usr/bin/env python3
+
+
+### Motion Sequence Latency Benchmark ###
+
+# Runs the soft/hard indentation protocol from a reading script against
+# the offline simulator and reports where the time goes in every step:
+#
+#   build       -- compiling the protocol, per step
+#   execute     -- the ExecuteAction call itself
+#   to_start    -- ExecuteAction sent -> ACTION_START received
+#   to_end      -- ExecuteAction sent -> ACTION_END received
+#   unsubscribe -- Unsubscribe call (per step with --legacy, otherwise
+#                  once per session)
+#
+# Percentiles are taken over all runs, and the wall time spent at each
+# phantom is reported so sequencing overhead shows up before it costs
+# robot time.
+#
+# Example:
+#   python3 benchmark_motion.py --runs 50 --time_scale 0.01 --rpc_latency 0.002
+
+import os
+import time
+import argparse
+import threading
+import importlib.util
+import collections
+
+from kortex_api.autogen.messages import Base_pb2
+
+import kortex_sim
+from action_notifications import ActionDispatcher
+from indentation_steps import compile_steps, run_steps
+from protocol_file import load_plan
+
+DEFAULT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "90-Degree_EE_TIS_Reading.py")
+
+METRICS = ["build", "execute", "to_start", "to_end", "unsubscribe"]
+
+PERCENTILES = [50, 90, 99]
+
+# Timings of one step of one run (seconds); unsubscribe is None when the
+# step did not unsubscribe.
+StepTiming = collections.namedtuple(
+    "StepTiming", ["name", "phantom"] + METRICS)
+
+def load_protocol(path):
+    """Import a reading script by path and return its protocol table
+
+    The script names are not valid module names, so they are loaded from
+    their file location instead of imported. JSON and TOML protocol files
+    are loaded with protocol_file.load_plan.
+    """
+    if path.endswith((".json", ".toml")):
+        return load_plan(path)
+    spec = importlib.util.spec_from_file_location("protocol_script", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.protocol
+
+def phantom_labels(protocol):
+    """Label each protocol row with the phantom it works on
+
+    Rows that share a probe (x, y) belong to the same phantom. The row
+    with the most offsets there (the indentation series) names it, e.g.
+    "Soft Indentation" -> "Soft".
+    """
+    series = {}
+    for step in protocol:
+        key = tuple(step.target[:2])
+        if key not in series or len(step.offsets) > len(series[key].offsets):
+            series[key] = step
+    return [series[tuple(step.target[:2])].name.split()[0]
+            for step in protocol]
+
+def percentile(values, q):
+    """Linearly interpolated percentile of a list (q in 0-100)"""
+    ordered = sorted(values)
+    if not ordered:
+        return float("nan")
+    position = (len(ordered) - 1) * q / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) \
+        * (position - lower)
+
+class InstrumentedBase:
+    """Timestamps RPCs and action notifications of a wrapped base"""
+    def __init__(self, base):
+        self.base = base
+        self.sent = []
+        self.events = []
+        self.calls = collections.defaultdict(list)
+
+    def __getattr__(self, name):
+        return getattr(self.base, name)
+
+    def _timed(self, name, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.calls[name].append(time.perf_counter() - start)
+        return result
+
+    def OnNotificationActionTopic(self, callback, notification_options):
+        def timed_callback(notification):
+            self.events.append((notification.action_event,
+                                time.perf_counter()))
+            callback(notification)
+        return self._timed("subscribe", self.base.OnNotificationActionTopic,
+                           timed_callback, notification_options)
+
+    def Unsubscribe(self, notification_handle):
+        return self._timed("unsubscribe", self.base.Unsubscribe,
+                           notification_handle)
+
+    def ExecuteAction(self, action):
+        self.sent.append(time.perf_counter())
+        return self._timed("execute", self.base.ExecuteAction, action)
+
+def run_legacy(base, compiled, timeout):
+    """Run compiled steps the way the original scripts did: subscribe,
+    send, wait and unsubscribe around every step
+    Returns the Unsubscribe duration of each step.
+    """
+    unsubscribes = []
+    for compiled_step in compiled:
+        e = threading.Event()
+        def check(notification, e = e):
+            if notification.action_event == Base_pb2.ACTION_END \
+            or notification.action_event == Base_pb2.ACTION_ABORT:
+                e.set()
+        notification_handle = base.OnNotificationActionTopic(
+            check, Base_pb2.NotificationOptions())
+        base.ExecuteAction(compiled_step.action)
+        finished = e.wait(timeout)
+        base.Unsubscribe(notification_handle)
+        unsubscribes.append(base.calls["unsubscribe"][-1])
+        if not finished:
+            raise RuntimeError("Timeout on {}".format(
+                compiled_step.action.name))
+        if compiled_step.step.dwell:
+            time.sleep(compiled_step.step.dwell)
+    return unsubscribes
+
+def run_once(base, protocol, labels, legacy, timeout):
+    """Run the protocol once, returning (step timings, phantom walls)
+
+    The table is compiled once and run with run_steps(), as the reading
+    scripts do, so dwell times, the shared notification subscription
+    and blended waypoint moves are all part of the timings. build is the compile time spread
+    evenly over the steps.
+    """
+    start = time.perf_counter()
+    compiled = compile_steps(protocol)
+    build = (time.perf_counter() - start) / max(len(compiled), 1)
+    row_labels = {id(step): label for step, label in zip(protocol, labels)}
+
+    base.sent = []
+    base.events = []
+    executes = len(base.calls["execute"])
+    if legacy:
+        unsubscribes = run_legacy(base, compiled, timeout)
+    else:
+        unsubscribes = [None] * len(compiled)
+        with ActionDispatcher(base) as dispatcher:
+            if not run_steps(dispatcher, compiled, timeout):
+                raise RuntimeError("Timeout on protocol run")
+    end = time.perf_counter()
+
+    # Each step owns the notifications between its ExecuteAction and the
+    # next one
+    timings = []
+    phantom_wall = collections.OrderedDict()
+    bounds = base.sent + [end]
+    for index, compiled_step in enumerate(compiled):
+        sent, after = bounds[index], bounds[index + 1]
+        events = {}
+        for event, timestamp in base.events:
+            if sent <= timestamp < after:
+                events.setdefault(event, timestamp)
+        label = row_labels[id(compiled_step.step)]
+        timings.append(StepTiming(
+            compiled_step.action.name, label, build,
+            base.calls["execute"][executes + index],
+            events.get(Base_pb2.ACTION_START, sent) - sent,
+            events.get(Base_pb2.ACTION_END, sent) - sent,
+            unsubscribes[index]))
+        phantom_wall[label] = phantom_wall.get(label, 0.0) + after - sent
+    return timings, phantom_wall
+
+def report(runs, session_unsubscribe):
+    """Print per-step percentiles (ms) and per-phantom wall time (s)"""
+    header = "{:<40}".format("step") + "".join(
+        "{:>10}".format("{} p{}".format(metric[:5], q))
+        for metric in METRICS for q in PERCENTILES)
+    print(header)
+
+    step_count = len(runs[0][0])
+    for index in range(step_count):
+        samples = [timings[index] for timings, _ in runs]
+        line = "{:<40}".format(samples[0].name[:39])
+        for metric in METRICS:
+            values = [getattr(sample, metric) for sample in samples
+                      if getattr(sample, metric) is not None]
+            for q in PERCENTILES:
+                if values:
+                    line += "{:>10.3f}".format(percentile(values, q) * 1000)
+                else:
+                    line += "{:>10}".format("-")
+        print(line)
+
+    if session_unsubscribe:
+        print("\nsession unsubscribe (ms): p50 {:.3f}  max {:.3f}".format(
+            percentile(session_unsubscribe, 50) * 1000,
+            max(session_unsubscribe) * 1000))
+
+    print("\nwall time per phantom (s)")
+    for label in runs[0][1]:
+        walls = [phantom_wall[label] for _, phantom_wall in runs]
+        print("  {:<12}".format(label) + "  ".join(
+            "p{} {:.3f}".format(q, percentile(walls, q))
+            for q in PERCENTILES))
+    totals = [sum(phantom_wall.values()) for _, phantom_wall in runs]
+    print("  {:<12}".format("total") + "  ".join(
+        "p{} {:.3f}".format(q, percentile(totals, q))
+        for q in PERCENTILES))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = "Per-step latency of a reading script's protocol "
+                      "against the offline simulator")
+    parser.add_argument("--script", default = DEFAULT_SCRIPT,
+                        help = "reading script whose protocol table to run")
+    parser.add_argument("--runs", type = int, default = 20)
+    parser.add_argument("--time_scale", type = float, default = 0.01,
+                        help = "real seconds per simulated second")
+    parser.add_argument("--rpc_latency", type = float,
+                        default = kortex_sim.RPC_LATENCY,
+                        help = "simulated RPC round trip (seconds)")
+    parser.add_argument("--legacy", action = "store_true",
+                        help = "subscribe and unsubscribe around every step")
+    parser.add_argument("--timeout", type = float, default = 60)
+    args = parser.parse_args()
+
+    protocol = load_protocol(args.script)
+    labels = phantom_labels(protocol)
+
+    arm = kortex_sim.SimulatedArm(args.time_scale,
+                                  rpc_latency = args.rpc_latency)
+    base = InstrumentedBase(kortex_sim.SimulatedBase(arm))
+
+    runs = []
+    for run in range(args.runs):
+        runs.append(run_once(base, protocol, labels, args.legacy,
+                             args.timeout))
+    arm.close()
+
+    report(runs, [] if args.legacy else base.calls["unsubscribe"])
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
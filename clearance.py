@@ -0,0 +1,96 @@
+#! /usr/bin/env python3
+
+
+### Minimum Safe Clearance Planner ###
+
+# Works out how far the tool has to lift between two probe points instead
+# of always retracting 15 cm. The sensor tube is modelled as a vertical
+# cylinder hanging below the tool point, the phantoms as discs with a top
+# height, and the Pyrex table as a plane under everything. The tube is
+# lifted straight up, moved across at one height and lowered straight
+# down, so the transit height only has to clear what its footprint
+# sweeps over on the way across.
+#
+# Coordinates are in cm, like the protocol tables. Tool points are the
+# protocol targets, i.e. the tube edge sits x_offset behind the tube
+# center and the tube bottom is sensor_height below the tool.
+
+import math
+import collections
+
+# Gap kept between the tube and anything it passes over (cm)
+CLEARANCE_MARGIN = 1
+
+# A disc-shaped obstacle, e.g. a phantom (cm)
+#   x, y   -- center
+#   radius -- footprint radius
+#   top    -- height of its upper surface
+Obstacle = collections.namedtuple(
+    "Obstacle", ["name", "x", "y", "radius", "top"])
+
+def table_height(corners):
+    """Highest point of the table plane spanned by the Pyrex corners (cm)
+    """
+    return max(corner[2] for corner in corners)
+
+def _segment_distance(point, a, b):
+    """XY distance from a point to the segment a-b"""
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    length = dx * dx + dy * dy
+    t = 0.0
+    if length > 0:
+        t = ((point[0] - a[0]) * dx + (point[1] - a[1]) * dy) / length
+        t = min(1.0, max(0.0, t))
+    return math.hypot(point[0] - a[0] - t * dx, point[1] - a[1] - t * dy)
+
+def transit_height(start, end, obstacles, table, sensor_height,
+                   sensor_radius, x_offset = 0, margin = CLEARANCE_MARGIN):
+    """Lowest tool z at which the tube can cross from start to end
+    Arguments:
+    start, end    -- tool points (x, y, z) (cm)
+    obstacles     -- list of Obstacle
+    table         -- height of the table plane (cm)
+    sensor_height -- tube length below the tool point (cm)
+    sensor_radius -- tube radius (cm)
+    x_offset      -- tube center x minus tool x (cm)
+    margin        -- gap kept below the tube (cm)
+
+    Never lower than either end point, so neither end moves down first.
+    """
+    a = (start[0] + x_offset, start[1])
+    b = (end[0] + x_offset, end[1])
+    bottom = table + margin
+    for obstacle in obstacles:
+        reach = obstacle.radius + sensor_radius + margin
+        if _segment_distance((obstacle.x, obstacle.y), a, b) < reach:
+            bottom = max(bottom, obstacle.top + margin)
+    return max(bottom + sensor_height, start[2], end[2])
+
+def clearance(start, end, obstacles, table, sensor_height, sensor_radius,
+              x_offset = 0, margin = CLEARANCE_MARGIN):
+    """Minimum lifts for a move between two probe points
+    Arguments as for transit_height().
+
+    Returns (lift above start, lift above end) in cm, ready to be used
+    as the offsets of the retract and approach protocol rows.
+    """
+    z = transit_height(start, end, obstacles, table, sensor_height,
+                       sensor_radius, x_offset, margin)
+    return z - start[2], z - end[2]
+
+def surface_height(point, obstacles, sensor_radius):
+    """Height the tube bottom first touches when lowered over a point
+    Arguments:
+    point         -- tube center (x, y, z), z the table height there (cm)
+    obstacles     -- list of Obstacle
+    sensor_radius -- tube radius (cm)
+
+    The top of the highest obstacle under any part of the tube
+    footprint, or the table if the footprint misses every obstacle.
+    """
+    surface = point[2]
+    for obstacle in obstacles:
+        if math.hypot(point[0] - obstacle.x, point[1] - obstacle.y) \
+           < obstacle.radius + sensor_radius:
+            surface = max(surface, obstacle.top)
+    return surface
@@ -0,0 +1,206 @@
+#! /usr/bin/env python3
+
+
+### Force-Threshold Contact Detection ###
+
+# Finds the phantom surface instead of trusting hand-measured heights.
+# The tool descends with a slow twist command while a FeedbackSampler
+# listener watches the external tool force; as soon as the force rises
+# past a threshold above its tared value the listener calls Stop() from
+# the sampler thread, so the reaction time is one sample period (1 ms at
+# 1 kHz) plus the Stop RPC. The depth series is then run relative to the
+# measured contact height.
+
+import math
+import threading
+import collections
+
+from kortex_api.autogen.messages import Base_pb2
+
+from indentation_steps import compile_steps, run_steps
+
+# Defaults for the search (SI units, like the Kortex twist command)
+CONTACT_FORCE = 1.0      # force rise over the tared value (N)
+SEARCH_SPEED = 0.005     # descent speed (meters/second)
+SEARCH_TRAVEL = 0.03     # give up after descending this far (meters)
+SEARCH_HEIGHT = 0.01     # start the search this far above the estimate (meters)
+
+# Samples averaged to tare the force sensor before descending
+TARE_SAMPLES = 50
+
+# Where the tool touched the surface
+#   z        -- tool z when the threshold was crossed (meters)
+#   force    -- force rise over the tared value at that moment (N)
+#   snapshot -- FeedbackSnapshot that crossed the threshold
+Contact = collections.namedtuple("Contact", ["z", "force", "snapshot"])
+
+def _force(snapshot):
+    return snapshot.tool_wrench[:3]
+
+def tare_force(sampler, samples = TARE_SAMPLES, timeout = 5):
+    """Average the external force over the next `samples` samples
+    Returns (force_x, force_y, force_z), or None if the sampler stalls.
+    """
+    totals = [0.0, 0.0, 0.0]
+    after = None
+    for count in range(samples):
+        snapshot = sampler.wait_for_sample(timeout, after)
+        if snapshot is None:
+            return None
+        after = snapshot.timestamp
+        totals = [total + value for total, value in
+                  zip(totals, _force(snapshot))]
+    return tuple(total / samples for total in totals)
+
+def find_contact(base, sampler, threshold = CONTACT_FORCE,
+                 speed = SEARCH_SPEED, max_travel = SEARCH_TRAVEL,
+                 timeout_margin = 5):
+    """Descend from the current pose until the tool force crosses a
+    threshold, then stop
+    Arguments:
+    base       -- BaseClient connected to the arm
+    sampler    -- running FeedbackSampler (ideally at 1 kHz)
+    threshold  -- force rise that counts as contact (N)
+    speed      -- descent speed (meters/second)
+    max_travel -- maximum descent before giving up (meters)
+
+    Returns a Contact, or None if nothing was touched within max_travel.
+    """
+    tare = tare_force(sampler)
+    if tare is None:
+        print("No cyclic feedback received")
+        return None
+    start_z = sampler.latest().tool_pose[2]
+
+    found = []
+    done = threading.Event()
+
+    def watch(snapshot, feedback):
+        if done.is_set():
+            return
+        rise = math.sqrt(sum((value - zero) ** 2 for value, zero in
+                             zip(_force(snapshot), tare)))
+        if rise >= threshold:
+            base.Stop()
+            found.append(Contact(snapshot.tool_pose[2], rise, snapshot))
+            done.set()
+        elif start_z - snapshot.tool_pose[2] >= max_travel:
+            base.Stop()
+            done.set()
+
+    command = Base_pb2.TwistCommand()
+    command.reference_frame = Base_pb2.CARTESIAN_REFERENCE_FRAME_BASE
+    command.duration = 0
+    command.twist.linear_z = -speed
+
+    sampler.add_listener(watch)
+    try:
+        print("Searching for contact ...")
+        base.SendTwistCommand(command)
+        if not done.wait(max_travel / speed + timeout_margin):
+            print("Timeout on contact search")
+    finally:
+        sampler.remove_listener(watch)
+        if not done.is_set():
+            base.Stop()
+            done.set()
+
+    if not found:
+        print("No contact within {:.1f} cm".format(max_travel * 100))
+        return None
+    print("Contact at z = {:.2f} cm ({:.2f} N)".format(
+        found[0].z * 100, found[0].force))
+    return found[0]
+
+def _tool_pose(sampler):
+    snapshot = sampler.latest()
+    return None if snapshot is None else snapshot.tool_pose
+
+def relative_to_contact(step, contact):
+    """Return a protocol row whose offsets are measured from a contact
+    """
+    x, y, z = step.target
+    return step._replace(target = (x, y, contact.z * 100))
+
+def _at_contact(compiled_step, contact):
+    """Copy of a compiled reach_pose move of a contact row, shifted so
+    its offset is measured from the contact
+    """
+    action = Base_pb2.Action()
+    action.CopyFrom(compiled_step.action)
+    action.reach_pose.target_pose.z = contact.z + compiled_step.offset / 100
+    return compiled_step._replace(
+        action = action, step = relative_to_contact(compiled_step.step,
+                                                    contact))
+
+def run_with_contact(dispatcher, sampler, protocol, contact_rows,
+                     timeout, on_step = None, threshold = CONTACT_FORCE,
+                     speed = SEARCH_SPEED, max_travel = SEARCH_TRAVEL,
+                     search_height = SEARCH_HEIGHT):
+    """Run a protocol table, locating the surface before contact rows
+    Arguments:
+    dispatcher   -- open ActionDispatcher for the session
+    sampler      -- running FeedbackSampler
+    protocol     -- list of IndentationStep
+    contact_rows -- rows of `protocol` (by identity) whose offsets should
+                    be taken from the measured contact instead of the
+                    nominal target height
+    timeout      -- maximum wait per move (seconds), None to predict
+                    each move's deadline
+    on_step      -- optional on_step(index, compiled_step)
+
+    The table is compiled once, so rows between contact rows keep their
+    blended transits. Contact rows are not blended: before each one the
+    tool moves to search_height above the nominal target and searches
+    downwards from there, and the row's moves are shifted to the
+    contact. Returns (finished, contacts) with one Contact per contact
+    row reached.
+    """
+    contacts = []
+    searched = set()
+    rows = []
+    for step in protocol:
+        if any(step is row for row in contact_rows):
+            step = step._replace(blend = None)
+            searched.add(id(step))
+        rows.append(step)
+    compiled = compile_steps(rows)
+
+    def shifted(offset):
+        if on_step is None:
+            return None
+        return lambda step_index, compiled_step: \
+            on_step(offset + step_index, compiled_step)
+
+    index = 0
+    while index < len(compiled):
+        step = compiled[index].step
+        end = index + 1
+        if id(step) in searched:
+            while end < len(compiled) and compiled[end].step is step:
+                end += 1
+            x, y, z = step.target
+            search = step._replace(name = step.name + " search start",
+                                   target = (x, y, z + search_height * 100),
+                                   offsets = [0])
+            if not run_steps(dispatcher, compile_steps([search]), timeout,
+                             start_pose = _tool_pose(sampler)):
+                return False, contacts
+            contact = find_contact(dispatcher.base, sampler, threshold,
+                                   speed, max_travel)
+            if contact is None:
+                return False, contacts
+            contacts.append(contact)
+            segment = [_at_contact(compiled_step, contact)
+                       for compiled_step in compiled[index:end]]
+        else:
+            while end < len(compiled) \
+            and id(compiled[end].step) not in searched:
+                end += 1
+            segment = compiled[index:end]
+
+        if not run_steps(dispatcher, segment, timeout, shifted(index),
+                         _tool_pose(sampler)):
+            return False, contacts
+        index = end
+    return True, contacts
@@ -0,0 +1,357 @@
+#! /usr/bin/env python3
+
+
+### Experiment Store ###
+
+# Keeps every run in its own directory under a store root:
+#
+#   <root>/<session>/session.json       when and how the run was started
+#   <root>/<session>/telemetry.tel      TelemetryRecorder file
+#   <root>/<session>/frames.cam<i>.tis  TactileCapture file per camera
+#   <root>/<session>/steps.idx          one INDEX_DTYPE row per step
+#
+# Telemetry and frames are appended chunk by chunk while the run goes on.
+# Each step's index row is written when the step starts and completed
+# when it ends, with the range of telemetry rows and frames it covers and
+# its repeat number (how many times the run has already been at that
+# phantom and depth). A crash loses at most the chunk being filled.
+#
+# Reading back only loads the small index files. Matching steps are then
+# sliced straight out of memory-mapped data files, so a query such as
+#
+#   ExperimentStore("runs").select(phantom = "hard", depth = -0.6)
+#
+# reads just those rows and frames, from every session and repeat.
+# Rows right at a step boundary may carry the neighbouring step's tag.
+#
+# Example (list the hard inclusion readings at -0.6 cm):
+#   python3 experiment_store.py runs --phantom hard --depth -0.6
+
+import os
+import glob
+import json
+import time
+import argparse
+import collections
+
+import numpy as np
+
+from telemetry_recorder import PHANTOM_CODES, PHANTOM_NAMES, \
+    TelemetryRecorder, load_recording
+from tactile_capture import TactileCapture, load_frames
+
+# Index file header: magic string and format version
+MAGIC = b"CSNAPIDX"
+VERSION = 1
+HEADER_SIZE = 64
+
+# Cameras with a frame range in the index
+MAX_CAMERAS = 4
+
+# Depth offsets closer than this are the same depth (cm)
+DEPTH_TOLERANCE = 0.001
+
+INDEX_DTYPE = np.dtype([
+    ("step", "<i4"),                            # protocol step
+    ("repeat", "<i4"),                          # earlier visits, same depth
+    ("phantom", "u1"),                          # PHANTOM_CODES
+    ("depth", "<f4"),                           # depth offset (cm)
+    ("name", "S40"),                            # action name
+    ("start_time", "<f8"),                      # host perf_counter (s)
+    ("end_time", "<f8"),                        # NaN while running
+    ("row_start", "<i8"),                       # telemetry rows
+    ("row_end", "<i8"),                         # -1 while running
+    ("frame_start", "<i8", (MAX_CAMERAS,)),     # frames per camera
+    ("frame_end", "<i8", (MAX_CAMERAS,)),       # -1 while running
+])
+
+SESSION_FILE = "session.json"
+TELEMETRY_FILE = "telemetry.tel"
+FRAMES_PREFIX = "frames"
+INDEX_FILE = "steps.idx"
+
+# One matching step: the session it is from, its index row, its
+# telemetry rows and its frames from each camera
+Selection = collections.namedtuple(
+    "Selection", ["session", "entry", "telemetry", "frames"])
+
+def _header():
+    header = MAGIC + np.array([VERSION, INDEX_DTYPE.itemsize],
+                              dtype = "<u4").tobytes()
+    return header.ljust(HEADER_SIZE, b"\0")
+
+def load_index(path):
+    """Read a step index file
+    """
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+        data = f.read()
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError("{} is not a step index".format(path))
+    version, itemsize = np.frombuffer(header, dtype = "<u4", count = 2,
+                                      offset = len(MAGIC))
+    if version != VERSION or itemsize != INDEX_DTYPE.itemsize:
+        raise ValueError("{} has unsupported format version {}".format(
+            path, version))
+    # A row cut short by a crash is dropped
+    count = len(data) // INDEX_DTYPE.itemsize
+    return np.frombuffer(data, dtype = INDEX_DTYPE, count = count).copy()
+
+class ExperimentSession:
+    """One run being written to the store
+
+    Stands in for a TelemetryRecorder: attach record_feedback to the
+    sampler and pass begin_step as on_step, and the session records the
+    telemetry, tags the frames and writes the step index:
+
+        with ExperimentStore("runs").create_session(sources) as session:
+            sampler.add_listener(session.record_feedback)
+            run_steps(dispatcher, compiled, on_step = session.begin_step)
+    """
+    def __init__(self, directory, sources = (), metadata = None):
+        if len(sources) > MAX_CAMERAS:
+            raise ValueError("At most {} cameras per session".format(
+                MAX_CAMERAS))
+        self.directory = directory
+        os.makedirs(directory)
+        with open(os.path.join(directory, SESSION_FILE), "w") as f:
+            json.dump(dict(metadata or {}, cameras = len(sources),
+                           created = time.strftime("%Y-%m-%dT%H:%M:%S")),
+                      f, indent = 1, sort_keys = True)
+
+        self.recorder = TelemetryRecorder(
+            os.path.join(directory, TELEMETRY_FILE))
+        self.capture = None
+        self._index = None
+        try:
+            if sources:
+                self.capture = TactileCapture(
+                    os.path.join(directory, FRAMES_PREFIX), sources)
+            self._index = open(os.path.join(directory, INDEX_FILE), "w+b")
+            self._index.write(_header())
+            self._index.flush()
+        except:
+            self.close()
+            raise
+        self._entry = None
+        self._entry_offset = None
+        self._visits = collections.Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _counters(self):
+        frames = np.full(MAX_CAMERAS, -1, dtype = np.int64)
+        if self.capture is not None:
+            for camera in self.capture.cameras:
+                frames[camera.index] = camera.frames
+        return time.perf_counter(), self.recorder.rows, frames
+
+    def _write_entry(self):
+        self._index.seek(self._entry_offset)
+        self._index.write(self._entry.tobytes())
+        self._index.seek(0, os.SEEK_END)
+        self._index.flush()
+
+    def _finish_entry(self):
+        if self._entry is None:
+            return
+        timestamp, rows, frames = self._counters()
+        self._entry["end_time"] = timestamp
+        self._entry["row_end"] = rows
+        self._entry["frame_end"] = frames
+        self._write_entry()
+        self._entry = None
+
+    def begin_step(self, index, compiled_step):
+        """Tag the data that follows with a compiled protocol step and
+        start its index row
+        """
+        self._finish_entry()
+        self.recorder.begin_step(index, compiled_step)
+        if self.capture is not None:
+            self.capture.begin_step(index, compiled_step)
+
+        phantom = PHANTOM_CODES[compiled_step.step.phantom]
+        key = (phantom, round(compiled_step.offset, 3))
+        timestamp, rows, frames = self._counters()
+        entry = np.zeros((), dtype = INDEX_DTYPE)
+        entry["step"] = index
+        entry["repeat"] = self._visits[key]
+        entry["phantom"] = phantom
+        entry["depth"] = compiled_step.offset
+        entry["name"] = compiled_step.action.name.encode()[:40]
+        entry["start_time"] = timestamp
+        entry["end_time"] = np.nan
+        entry["row_start"] = rows
+        entry["row_end"] = -1
+        entry["frame_start"] = frames
+        entry["frame_end"] = -1
+        self._visits[key] += 1
+
+        self._entry = entry
+        self._index.seek(0, os.SEEK_END)
+        self._entry_offset = self._index.tell()
+        self._write_entry()
+
+    def end_steps(self):
+        """Tag the data that follows as outside the protocol
+        """
+        self._finish_entry()
+        self.recorder.end_steps()
+        if self.capture is not None:
+            self.capture.end_steps()
+
+    def record_feedback(self, snapshot, feedback):
+        """FeedbackSampler listener: record one feedback sample
+        """
+        self.recorder.record_feedback(snapshot, feedback)
+
+    def close(self):
+        """Complete the index and close the telemetry and frame files
+        """
+        if self._index is not None:
+            self._finish_entry()
+            self._index.close()
+            self._index = None
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+class StoredSession:
+    """A run read back from the store
+
+    The index is loaded when the session is opened; telemetry and frame
+    files are memory-mapped the first time they are needed.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.name = os.path.basename(os.path.normpath(directory))
+        with open(os.path.join(directory, SESSION_FILE)) as f:
+            self.metadata = json.load(f)
+        self.steps = load_index(os.path.join(directory, INDEX_FILE))
+        self._telemetry = None
+        self._frames = None
+
+        # Steps cut short by a crash run up to the next step's start
+        unfinished = self.steps["row_end"] < 0
+        next_rows = np.r_[self.steps["row_start"][1:], np.iinfo(np.int64).max]
+        self.steps["row_end"][unfinished] = next_rows[unfinished]
+        next_frames = np.vstack([self.steps["frame_start"][1:],
+                                 np.full((1, MAX_CAMERAS),
+                                         np.iinfo(np.int64).max)])
+        self.steps["frame_end"][unfinished] = next_frames[unfinished]
+
+    @property
+    def telemetry(self):
+        if self._telemetry is None:
+            self._telemetry = load_recording(
+                os.path.join(self.directory, TELEMETRY_FILE))
+        return self._telemetry
+
+    @property
+    def frames(self):
+        if self._frames is None:
+            self._frames = [
+                load_frames(os.path.join(self.directory, "{}.cam{}.tis"
+                                         .format(FRAMES_PREFIX, index)))
+                for index in range(self.metadata.get("cameras", 0))]
+        return self._frames
+
+    def find(self, phantom = None, depth = None, repeat = None, step = None):
+        """Index rows of the steps matching every given criterion
+        Arguments:
+        phantom -- "soft" or "hard"
+        depth   -- depth offset (cm)
+        repeat  -- visit number at that phantom and depth, 0 for the first
+        step    -- protocol step number
+        """
+        match = np.ones(len(self.steps), dtype = bool)
+        if phantom is not None:
+            match &= self.steps["phantom"] == PHANTOM_CODES[phantom]
+        if depth is not None:
+            match &= np.abs(self.steps["depth"] - depth) < DEPTH_TOLERANCE
+        if repeat is not None:
+            match &= self.steps["repeat"] == repeat
+        if step is not None:
+            match &= self.steps["step"] == step
+        return self.steps[match]
+
+    def select(self, **criteria):
+        """Selection of each step matching the criteria of find()
+        """
+        return [Selection(self, entry,
+                          self.telemetry[entry["row_start"]:entry["row_end"]],
+                          [frames[entry["frame_start"][index]:
+                                  entry["frame_end"][index]]
+                           for index, frames in enumerate(self.frames)])
+                for entry in self.find(**criteria)]
+
+class ExperimentStore:
+    """Directory of sessions
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def create_session(self, sources = (), metadata = None, name = None):
+        """Start a new ExperimentSession, named after the current time
+        unless a name is given
+        """
+        os.makedirs(self.root, exist_ok = True)
+        if name is None:
+            name = time.strftime("%Y%m%d-%H%M%S")
+            base, suffix = name, 1
+            while os.path.exists(os.path.join(self.root, name)):
+                suffix += 1
+                name = "{}-{}".format(base, suffix)
+        return ExperimentSession(os.path.join(self.root, name), sources,
+                                 metadata)
+
+    def sessions(self):
+        """Names of the stored sessions, oldest first"""
+        return sorted(os.path.basename(os.path.dirname(path)) for path in
+                      glob.glob(os.path.join(self.root, "*", INDEX_FILE)))
+
+    def open_session(self, name):
+        return StoredSession(os.path.join(self.root, name))
+
+    def select(self, **criteria):
+        """Selection of each matching step in every session
+        (see StoredSession.find for the criteria)
+        """
+        selections = []
+        for name in self.sessions():
+            selections.extend(self.open_session(name).select(**criteria))
+        return selections
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", help = "store directory")
+    parser.add_argument("--phantom", choices = ["soft", "hard"])
+    parser.add_argument("--depth", type = float, help = "depth offset (cm)")
+    parser.add_argument("--repeat", type = int)
+    args = parser.parse_args()
+
+    selections = ExperimentStore(args.root).select(
+        phantom = args.phantom, depth = args.depth, repeat = args.repeat)
+    for selection in selections:
+        entry = selection.entry
+        force = selection.telemetry["tool_wrench"][:, 2]
+        print("{} step {:3d} repeat {:2d} {:>4} {:6.2f} cm: {:5d} rows, "
+              "{} frames, mean force_z {:.2f} N".format(
+                  selection.session.name, entry["step"], entry["repeat"],
+                  PHANTOM_NAMES[int(entry["phantom"])] or "", entry["depth"],
+                  len(selection.telemetry),
+                  "/".join(str(len(frames)) for frames in selection.frames),
+                  force.mean() if len(force) else float("nan")))
+    print("{} matching steps".format(len(selections)))
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,173 @@
+#! /usr/bin/env python3
+
+
+### Cyclic Feedback Sampler ###
+
+# Polls BaseCyclicClient.RefreshFeedback() on a background thread and
+# keeps the most recent sample plus a bounded history. Motion code reads
+# the cached snapshot instead of making a blocking RPC of its own.
+#
+# For rates above ~100 Hz build the BaseCyclicClient on a UDP router
+# (utilities.DeviceConnection.createUdpConnection), as the Kortex
+# cyclic examples do. The controller refreshes at 1 kHz, which is the
+# upper limit for the rate here.
+
+import time
+import threading
+import collections
+
+# Default polling rate (Hz) and history length (samples)
+SAMPLE_RATE = 100
+HISTORY_LENGTH = 10000
+
+# Highest rate the controller can serve (Hz)
+MAX_SAMPLE_RATE = 1000
+
+# One immutable feedback sample.
+#   timestamp   -- host time.perf_counter() when the sample returned (s)
+#   tool_pose   -- (x, y, z, theta_x, theta_y, theta_z) (meters / degrees)
+#   tool_wrench -- external (force_x, force_y, force_z,
+#                  torque_x, torque_y, torque_z) at the tool (N / Nm)
+#   joint_positions  -- actuator positions (degrees)
+#   joint_velocities -- actuator velocities (degrees/s)
+#   joint_torques    -- actuator torques (Nm)
+FeedbackSnapshot = collections.namedtuple(
+    "FeedbackSnapshot",
+    ["timestamp", "tool_pose", "tool_wrench",
+     "joint_positions", "joint_velocities", "joint_torques"])
+
+def snapshot_from_feedback(feedback, timestamp):
+    """Copy the fields we keep out of a BaseCyclic feedback message
+    """
+    base = feedback.base
+    return FeedbackSnapshot(
+        timestamp,
+        (base.tool_pose_x, base.tool_pose_y, base.tool_pose_z,
+         base.tool_pose_theta_x, base.tool_pose_theta_y,
+         base.tool_pose_theta_z),
+        (base.tool_external_wrench_force_x,
+         base.tool_external_wrench_force_y,
+         base.tool_external_wrench_force_z,
+         base.tool_external_wrench_torque_x,
+         base.tool_external_wrench_torque_y,
+         base.tool_external_wrench_torque_z),
+        tuple(actuator.position for actuator in feedback.actuators),
+        tuple(actuator.velocity for actuator in feedback.actuators),
+        tuple(actuator.torque for actuator in feedback.actuators))
+
+class FeedbackSampler:
+    """Background RefreshFeedback poller with a latest-snapshot cache
+
+    Use as a context manager so the thread stops with the session:
+
+        with FeedbackSampler(base_cyclic, rate = 500) as sampler:
+            snapshot = sampler.wait_for_sample(1)
+    """
+    def __init__(self, base_cyclic, rate = SAMPLE_RATE,
+                 history_length = HISTORY_LENGTH):
+        if rate <= 0 or rate > MAX_SAMPLE_RATE:
+            raise ValueError("Sample rate must be in (0, {}] Hz".format(
+                MAX_SAMPLE_RATE))
+        self.base_cyclic = base_cyclic
+        self.period = 1.0 / rate
+        self._history = collections.deque(maxlen = history_length)
+        self.errors = 0
+        self.listener_errors = 0
+        self._latest = None
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._listeners = []
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target = self._run, name = "FeedbackSampler", daemon = True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def add_listener(self, listener):
+        """Call listener(snapshot, feedback) on the sampler thread for
+        every new sample. Listeners must return quickly.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def latest(self):
+        """Return the most recent FeedbackSnapshot, or None before the
+        first sample arrives
+        """
+        return self._latest
+
+    def history(self):
+        """Return a list copy of the bounded sample history, oldest first
+        """
+        with self._condition:
+            return list(self._history)
+
+    def wait_for_sample(self, timeout, after = None):
+        """Block until a snapshot newer than `after` exists
+        Arguments:
+        timeout -- maximum wait (seconds)
+        after   -- timestamp the snapshot must be newer than (None for
+                   any snapshot)
+
+        Returns the snapshot, or None on timeout.
+        """
+        def ready():
+            return self._latest is not None \
+                and (after is None or self._latest.timestamp > after)
+        with self._condition:
+            if not self._condition.wait_for(ready, timeout):
+                return None
+            return self._latest
+
+    def _run(self):
+        next_time = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                feedback = self.base_cyclic.RefreshFeedback()
+            except Exception as ex:
+                # Keep sampling through transient RPC errors; the count
+                # tells the caller how many samples were lost.
+                self.errors += 1
+                print("Feedback sampling error: {}".format(ex))
+            else:
+                snapshot = snapshot_from_feedback(
+                    feedback, time.perf_counter())
+                with self._condition:
+                    self._latest = snapshot
+                    self._history.append(snapshot)
+                    self._condition.notify_all()
+                # A failing listener must not end sampling for the
+                # others (e.g. a contact watcher that stops the arm)
+                for listener in list(self._listeners):
+                    try:
+                        listener(snapshot, feedback)
+                    except Exception as ex:
+                        self.listener_errors += 1
+                        print("Feedback listener error: {}".format(ex))
+
+            # Fixed-rate schedule; if we fall behind, skip the missed
+            # periods instead of bursting to catch up.
+            next_time += self.period
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                next_time = time.perf_counter()
@@ -0,0 +1,207 @@
+#! /usr/bin/env python3
+
+
+### Pyrex Grid Scan ###
+
+# Generates indentation points over the Pyrex quadrilateral P1-P4 at a
+# given pitch and orders them to keep air travel short: the serpentine
+# (boustrophedon) order and a nearest-neighbour tour are both built, the
+# shorter one is kept and then improved with 2-opt. Between neighbouring
+# points the tool only lifts as far as the clearance planner needs to
+# clear the phantoms and the table; the full retract is used once at the
+# start and once at the end. The depth series at each point starts from
+# the surface under the tube, and never presses below the table.
+#
+# Coordinates are in cm, like the protocol tables.
+
+import math
+
+from clearance import clearance, surface_height
+from indentation_steps import IndentationStep
+
+# Full retract, and height above each point where the approach slows to
+# the contact speed (cm)
+RETRACT_HEIGHT = 15
+APPROACH_HEIGHT = 1
+
+# Upper bound on 2-opt passes over the whole tour
+MAX_2OPT_PASSES = 20
+
+def _lerp(a, b, t):
+    return [p + (q - p) * t for p, q in zip(a, b)]
+
+def _distance(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+def grid_points(corners, pitch):
+    """Return rows of points covering a quadrilateral at a pitch
+    Arguments:
+    corners -- (top left, top right, bottom right, bottom left), each
+               (x, y, z) in cm, i.e. (P1, P2, P3, P4)
+    pitch   -- target spacing between neighbouring points (cm)
+
+    Points are the bilinear interpolation of the corners, so z follows
+    the corner heights. The number of points per side comes from the
+    longer of each pair of opposite edges, which keeps the pitch honest
+    when the quadrilateral is skewed or degenerate (e.g. P1 == P2).
+    Returns a list of rows (top to bottom), each a list of (x, y, z).
+    """
+    if pitch <= 0:
+        raise ValueError("Scan pitch must be positive")
+    top_left, top_right, bottom_right, bottom_left = corners
+    columns = max(_distance(top_left, top_right),
+                  _distance(bottom_left, bottom_right))
+    rows = max(_distance(top_left, bottom_left),
+               _distance(top_right, bottom_right))
+    column_count = int(math.floor(columns / pitch)) + 1
+    row_count = int(math.floor(rows / pitch)) + 1
+
+    grid = []
+    seen = set()
+    for i in range(row_count):
+        v = i / (row_count - 1) if row_count > 1 else 0.0
+        left = _lerp(top_left, bottom_left, v)
+        right = _lerp(top_right, bottom_right, v)
+        row = []
+        for j in range(column_count):
+            u = j / (column_count - 1) if column_count > 1 else 0.0
+            point = tuple(_lerp(left, right, u))
+            # Degenerate edges map several (u, v) to the same point
+            key = (round(point[0], 6), round(point[1], 6))
+            if key not in seen:
+                seen.add(key)
+                row.append(point)
+        if row:
+            grid.append(row)
+    return grid
+
+def serpentine_order(grid):
+    """Flatten grid rows, reversing every other row"""
+    order = []
+    for index, row in enumerate(grid):
+        order.extend(row if index % 2 == 0 else reversed(row))
+    return order
+
+def nearest_neighbour_order(points, start = None):
+    """Greedy tour: always go to the closest unvisited point"""
+    remaining = list(points)
+    current = remaining.pop(0) if start is None else start
+    if start is not None:
+        remaining.remove(start)
+    order = [current]
+    while remaining:
+        index = min(range(len(remaining)),
+                    key = lambda k: _distance(current, remaining[k]))
+        current = remaining.pop(index)
+        order.append(current)
+    return order
+
+def path_length(order, start = None):
+    """Total XY travel of an open path, optionally from a start point"""
+    length = sum(_distance(a, b) for a, b in zip(order, order[1:]))
+    if start is not None and order:
+        length += _distance(start, order[0])
+    return length
+
+def two_opt(order, max_passes = MAX_2OPT_PASSES):
+    """Improve an open path by reversing segments while that shortens it
+
+    The first point stays fixed; the end is free.
+    """
+    order = list(order)
+    count = len(order)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, count - 1):
+            a, b = order[i - 1], order[i]
+            for k in range(i + 1, count):
+                c = order[k]
+                d = order[k + 1] if k + 1 < count else None
+                before = _distance(a, b) \
+                    + (_distance(c, d) if d is not None else 0.0)
+                after = _distance(a, c) \
+                    + (_distance(b, d) if d is not None else 0.0)
+                if after < before - 1e-9:
+                    order[i:k + 1] = reversed(order[i:k + 1])
+                    b = order[i]
+                    improved = True
+        if not improved:
+            break
+    return order
+
+def visit_order(grid):
+    """Travel-minimising visit order for grid points
+
+    Starts from the better of the serpentine and nearest-neighbour tours
+    (both begin at the first point of the grid) and refines it with 2-opt.
+    """
+    serpentine = serpentine_order(grid)
+    if len(serpentine) < 3:
+        return serpentine
+    greedy = nearest_neighbour_order(serpentine, serpentine[0])
+    best = min(serpentine, greedy, key = path_length)
+    return two_opt(best)
+
+def scan_protocol(order, depths, orientation, obstacles = (),
+                  x_offset = 0, height_offset = 0, sensor_radius = 0,
+                  retract = RETRACT_HEIGHT, transit_speed = None,
+                  contact_speed = None, blend = None,
+                  approach_height = APPROACH_HEIGHT):
+    """Build a protocol table indenting at every point of a tour
+    Arguments:
+    order         -- list of (x, y, z) points (cm), in visit order, z
+                     the table height under each point
+    depths        -- indentation offsets from the surface (cm)
+    orientation   -- (theta_x, theta_y, theta_z) (degrees)
+    obstacles     -- list of clearance.Obstacle, e.g. the phantoms
+    x_offset      -- subtracted from x, e.g. the sensor radius (cm)
+    height_offset -- added to z, e.g. the sensor height (cm)
+    sensor_radius -- tube radius (cm)
+    retract       -- lift before the first and after the last point (cm)
+    transit_speed -- speed of approach and lift rows (cm/s), None for
+                     the controller's default
+    contact_speed -- speed of the indentation rows (cm/s)
+    blend         -- blending radius of the lift and approach rows (cm),
+                     None to stop at every transit point
+    approach_height -- height above each point where the approach
+                       switches to the contact speed (cm)
+
+    Depths that would push the tube below the table are left out, so a
+    point on bare glass is only touched. Points without any depth left
+    are skipped.
+    """
+    table = max((point[2] for point in order), default = 0)
+    targets = []
+    series = []
+    for x, y, z in order:
+        surface = surface_height((x, y, z), obstacles, sensor_radius)
+        offsets = [depth for depth in depths if surface + depth >= z]
+        if offsets:
+            targets.append((x - x_offset, y, surface + height_offset))
+            series.append(offsets)
+
+    def transit_offsets(lift):
+        if lift > approach_height:
+            return [lift, approach_height]
+        return [approach_height]
+
+    protocol = []
+    lift = retract
+    for index, (target, offsets) in enumerate(zip(targets, series)):
+        name = "Scan point {}".format(index + 1)
+        protocol.append(IndentationStep(name + " approach", target,
+                                        transit_offsets(lift), orientation,
+                                        speed = transit_speed,
+                                        blend = blend))
+        protocol.append(IndentationStep(name, target, offsets, orientation,
+                                        speed = contact_speed))
+        if index + 1 < len(targets):
+            hop, lift = clearance(target, targets[index + 1], obstacles,
+                                  table, height_offset, sensor_radius,
+                                  x_offset)
+        else:
+            hop = retract
+        protocol.append(IndentationStep(name + " lift", target, [hop],
+                                        orientation, speed = transit_speed,
+                                        blend = blend))
+    return protocol
@@ -0,0 +1,293 @@
+#! /usr/bin/env python3
+
+
+### Gripper Control ###
+
+# Waits on the gripper fingers without spinning on RPCs. With a running
+# FeedbackSampler, a listener reads the finger position from every
+# cyclic sample (interconnect.gripper_feedback.motor[0], 0-100 %) and
+# wakes the waiting thread as soon as a threshold is crossed. Without
+# one, GetMeasuredGripperMovement is polled at a fixed rate. Every wait
+# ends at a deadline.
+#
+# Positions are fractions of the finger stroke, 0 fully open and 1 fully
+# closed. Speed commands follow the Kortex convention (positive opens);
+# measured speeds are the rate of change of the position, so they are
+# positive while the fingers close.
+#
+# Example:
+#   with FeedbackSampler(base_cyclic, rate = 500) as sampler, \
+#        GripperController(base, sampler) as gripper:
+#       gripper.move_to(0.5)
+#       gripper.grasp()
+
+import math
+import time
+import threading
+import collections
+
+from kortex_api.autogen.messages import Base_pb2
+
+# Polling rate without a sampler, and speed command update rate of a
+# closed-loop move (Hz)
+POLL_RATE = 20
+COMMAND_RATE = 10
+
+# Defaults for the waits (fractions of the stroke, seconds)
+GRIPPER_TIMEOUT = 20
+POSITION_TOLERANCE = 0.01
+STOPPED_SPEED = 0.005    # (stroke/second)
+SETTLE_TIME = 0.1        # stopped for this long counts as stopped
+START_TIME = 0.5         # fingers that have not moved count as stopped
+                         # this long after the command
+
+# Measurements further apart than this give no speed (seconds)
+SPEED_GAP = 0.2
+
+# Speed limits of a closed-loop move (fraction of the maximum speed)
+MAX_SPEED = 1.0
+MIN_SPEED = 0.05
+
+# One gripper measurement
+#   timestamp -- host time.perf_counter() of the measurement (s)
+#   position  -- finger position (0 open, 1 closed)
+#   speed     -- position change rate (stroke/second), None without a
+#                measurement less than SPEED_GAP before it
+GripperState = collections.namedtuple(
+    "GripperState", ["timestamp", "position", "speed"])
+
+class GripperController:
+    """Threshold waits and closed-loop moves of the gripper fingers
+    Arguments:
+    base      -- BaseClient connected to the arm
+    sampler   -- optional running FeedbackSampler; the fingers are then
+                 read from its cyclic feedback instead of polled
+    poll_rate -- GetMeasuredGripperMovement rate without a sampler (Hz)
+    proportional_gain -- speed command per unit of position error in
+                         closed-loop moves (1/s)
+
+    Use as a context manager so the sampler listener is removed with the
+    session. Only one thread should wait on a controller at a time.
+    """
+    def __init__(self, base, sampler = None, poll_rate = POLL_RATE,
+                 proportional_gain = 2.0):
+        self.base = base
+        self.sampler = sampler
+        self.proportional_gain = proportional_gain
+        self.period = 1.0 / poll_rate
+        self._state = None
+        self._condition = None
+        self._reached = None
+        self._done = threading.Event()
+        if sampler is not None:
+            sampler.add_listener(self._on_feedback)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.sampler is not None:
+            self.sampler.remove_listener(self._on_feedback)
+            self.sampler = None
+
+    def _update(self, timestamp, position):
+        previous = self._state
+        speed = None
+        # A speed from measurements far apart (e.g. the end of the last
+        # wait) would hide any motion in between
+        if previous is not None \
+        and 0 < timestamp - previous.timestamp <= SPEED_GAP:
+            speed = (position - previous.position) \
+                    / (timestamp - previous.timestamp)
+        state = GripperState(timestamp, position, speed)
+        self._state = state
+        condition = self._condition
+        if condition is not None and not self._done.is_set() \
+        and condition(state):
+            self._reached = state
+            self._done.set()
+        return state
+
+    def _on_feedback(self, snapshot, feedback):
+        motors = feedback.interconnect.gripper_feedback.motor
+        if len(motors):
+            self._update(snapshot.timestamp, motors[0].position / 100.0)
+
+    def _poll(self):
+        request = Base_pb2.GripperRequest()
+        request.mode = Base_pb2.GRIPPER_POSITION
+        measure = self.base.GetMeasuredGripperMovement(request)
+        if not len(measure.finger):
+            return None
+        return self._update(time.perf_counter(), measure.finger[0].value)
+
+    def state(self):
+        """Latest GripperState, None if no gripper reported yet
+        Without a sampler this makes one GetMeasuredGripperMovement call.
+        """
+        if self.sampler is None:
+            return self._poll()
+        return self._state
+
+    def _wait(self, condition, timeout):
+        deadline = time.perf_counter() + timeout
+        if self.sampler is None:
+            next_time = time.perf_counter()
+            while True:
+                state = self._poll()
+                if state is None or condition(state):
+                    return state
+                next_time += self.period
+                delay = next_time - time.perf_counter()
+                if next_time >= deadline:
+                    return None
+                if delay > 0:
+                    time.sleep(delay)
+
+        self._reached = None
+        self._done.clear()
+        self._condition = condition
+        try:
+            state = self._state
+            if state is not None and condition(state):
+                return state
+            if self._done.wait(max(deadline - time.perf_counter(), 0)):
+                return self._reached
+            return None
+        finally:
+            self._condition = None
+
+    def wait(self, condition, timeout = GRIPPER_TIMEOUT):
+        """Block until condition(state) holds for a measurement
+        Arguments:
+        condition -- function of a GripperState; with a sampler it runs
+                     on the sampler thread and must return quickly
+        timeout   -- maximum wait (seconds)
+
+        Returns the GripperState that satisfied the condition, or None on
+        timeout or if no gripper reports.
+        """
+        state = self._wait(condition, timeout)
+        if state is None:
+            print("Timeout on gripper wait")
+        return state
+
+    def wait_for_position(self, below = None, above = None,
+                          timeout = GRIPPER_TIMEOUT):
+        """Wait until the finger position is below and/or above a value
+        """
+        return self.wait(lambda state:
+                         (below is None or state.position < below) and
+                         (above is None or state.position > above),
+                         timeout)
+
+    def wait_until_stopped(self, timeout = GRIPPER_TIMEOUT,
+                           speed = STOPPED_SPEED, settle = SETTLE_TIME,
+                           start = None):
+        """Wait until the fingers have moved slower than `speed` for
+        `settle` seconds, e.g. when they close on an object
+        Arguments:
+        start -- optional GripperState when the motion was commanded;
+                 until the fingers have moved POSITION_TOLERANCE away
+                 from it, or START_TIME has passed, they are still
+                 starting and do not count as stopped
+        """
+        since = []
+        started = [start is None]
+
+        def stopped(state):
+            if not started[0]:
+                started[0] = \
+                    abs(state.position - start.position) \
+                    > POSITION_TOLERANCE \
+                    or state.timestamp - start.timestamp >= START_TIME
+            if not started[0] or state.speed is None \
+            or abs(state.speed) > speed:
+                del since[:]
+                return False
+            if not since:
+                since.append(state.timestamp)
+            return state.timestamp - since[0] >= settle
+        return self.wait(stopped, timeout)
+
+    def _send(self, mode, value):
+        command = Base_pb2.GripperCommand()
+        command.mode = mode
+        finger = command.gripper.finger.add()
+        finger.finger_identifier = 1
+        finger.value = value
+        self.base.SendGripperCommand(command)
+
+    def send_position(self, position):
+        """Command a finger position (0 open, 1 closed) and return"""
+        self._send(Base_pb2.GRIPPER_POSITION, position)
+
+    def send_speed(self, speed):
+        """Command a finger speed (positive opens, negative closes) and
+        return
+        """
+        self._send(Base_pb2.GRIPPER_SPEED, speed)
+
+    def release(self, speed = 0.1, tolerance = POSITION_TOLERANCE,
+             timeout = GRIPPER_TIMEOUT):
+        """Open the fingers at `speed` until they are fully open
+        Returns the GripperState at the end, or None on timeout.
+        """
+        self.send_speed(abs(speed))
+        return self.wait_for_position(below = tolerance, timeout = timeout)
+
+    def grasp(self, speed = 0.1, timeout = GRIPPER_TIMEOUT):
+        """Close the fingers at `speed` until they stop, fully closed or
+        on an object
+        Returns the GripperState at the end, or None on timeout.
+        """
+        # Without a measurement only START_TIME can end the start
+        before = self.state()
+        start = GripperState(time.perf_counter(),
+                             math.nan if before is None else before.position,
+                             None)
+        self.send_speed(-abs(speed))
+        return self.wait_until_stopped(timeout, start = start)
+
+    def move_to(self, position, tolerance = POSITION_TOLERANCE,
+                timeout = GRIPPER_TIMEOUT, max_speed = MAX_SPEED):
+        """Closed-loop move of the fingers to a position
+        Arguments:
+        position  -- target position (0 open, 1 closed)
+        tolerance -- position error that counts as reached
+        timeout   -- maximum duration of the move (seconds)
+        max_speed -- speed command limit (fraction of the maximum speed)
+
+        The speed command is proportional to the position error and is
+        updated at COMMAND_RATE; the fingers are stopped as soon as a
+        measurement is within tolerance. Returns the GripperState that
+        reached the target, or None on timeout.
+        """
+        target = min(max(position, 0.0), 1.0)
+        deadline = time.perf_counter() + timeout
+
+        def reached(state):
+            return abs(target - state.position) <= tolerance
+
+        state = self._state if self.sampler is not None else self._poll()
+        if state is None:
+            state = self._wait(lambda state: True, timeout)
+        while state is not None and not reached(state):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                state = None
+                break
+            error = target - state.position
+            speed = min(max(self.proportional_gain * abs(error), MIN_SPEED),
+                        max_speed)
+            # Closing (a positive error) takes a negative speed command
+            self.send_speed(-math.copysign(speed, error))
+            state = self._wait(reached, min(1.0 / COMMAND_RATE, remaining)) \
+                    or self._state
+        self.send_speed(0.0)
+        if state is None:
+            print("Timeout on gripper move to {:0.2f}".format(target))
+        return state
@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+
+
+### Inverse-Kinematics Cache ###
+
+# The soft/hard probe poses are the same on every run. This cache keeps
+# the controller's IK solution for each of them in a JSON file, keyed by
+# the pose quantized to 0.1 mm and 0.01 degree, so a protocol can be sent
+# as reach_joint_angles actions without asking ComputeInverseKinematics
+# again. Only poses never seen before cost an IK call, and those calls
+# are all made before the arm moves.
+#
+# The solutions depend on the tool transform, so the file records the
+# tool configuration it was built with and is discarded when that
+# changes.
+#
+# Joint moves follow a joint-space path rather than a straight Cartesian
+# line. Between neighbouring probe poses the difference is negligible;
+# rows with a Cartesian speed limit get a joint duration constraint that
+# gives the same average speed.
+
+import os
+import json
+
+from kortex_api.autogen.messages import Base_pb2
+
+from indentation_steps import step_pose, waypoint_poses
+
+# Quantization of cache keys (meters / degrees)
+POSITION_QUANTUM = 0.0001
+ANGLE_QUANTUM = 0.01
+
+FORMAT_VERSION = 1
+
+def tool_fingerprint(tool_configuration):
+    """Rounded tool transform of a ControlConfig ToolConfiguration, or
+    None if unknown
+    """
+    if tool_configuration is None:
+        return None
+    transform = tool_configuration.tool_transform
+    return [round(value, 6) for value in
+            (transform.x, transform.y, transform.z, transform.theta_x,
+             transform.theta_y, transform.theta_z)]
+
+def pose_key(pose):
+    """Cache key of a pose (meters / degrees)"""
+    position = [int(round(value / POSITION_QUANTUM)) for value in pose[:3]]
+    angles = [int(round((value % 360.0) / ANGLE_QUANTUM))
+              % int(round(360.0 / ANGLE_QUANTUM)) for value in pose[3:]]
+    return ",".join(str(value) for value in position + angles)
+
+def build_joint_action(name, joints, duration = None):
+    """Return a reach_joint_angles action
+    Arguments:
+    joints   -- joint angles (degrees), one per actuator
+    duration -- optional duration constraint (seconds)
+    """
+    action = Base_pb2.Action()
+    action.name = name
+    action.application_data = ""
+
+    for joint_id, value in enumerate(joints):
+        joint_angle = action.reach_joint_angles.joint_angles.joint_angles.add()
+        joint_angle.joint_identifier = joint_id
+        joint_angle.value = value
+    if duration is not None:
+        constraint = action.reach_joint_angles.constraint
+        constraint.type = Base_pb2.JOINT_CONSTRAINT_DURATION
+        constraint.value = duration
+    return action
+
+class IKCache:
+    """Persistent pose -> joint angles map
+
+        cache = IKCache("ik_cache.json",
+                        control_config.GetToolConfiguration())
+        compiled = cache.joint_steps(base, compiled, start_pose, joints)
+        cache.save()
+    """
+    def __init__(self, path, tool_configuration = None):
+        self.path = path
+        self.fingerprint = tool_fingerprint(tool_configuration)
+        self.solutions = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        """Read the cache file, unless it was built for another tool"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            data = json.load(f)
+        if data.get("version") != FORMAT_VERSION \
+        or data.get("tool") != self.fingerprint:
+            print("Tool configuration changed, IK cache cleared")
+            return
+        self.solutions = data["solutions"]
+
+    def save(self):
+        """Write the cache file (atomically)"""
+        data = {"version": FORMAT_VERSION, "tool": self.fingerprint,
+                "solutions": self.solutions}
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(data, f, indent = 1, sort_keys = True)
+        os.replace(temporary, self.path)
+
+    def lookup(self, pose):
+        return self.solutions.get(pose_key(pose))
+
+    def store(self, pose, joints):
+        self.solutions[pose_key(pose)] = list(joints)
+
+    def solve(self, base, pose, guess):
+        """Joint angles for a pose, from the cache or the IK service
+        Arguments:
+        base  -- BaseClient connected to the arm
+        pose  -- (x, y, z, theta_x, theta_y, theta_z) (meters / degrees)
+        guess -- joint angles to start the IK solver from (degrees)
+        """
+        joints = self.lookup(pose)
+        if joints is not None:
+            self.hits += 1
+            return joints
+
+        self.misses += 1
+        ik_data = Base_pb2.IKData()
+        cartesian_pose = ik_data.cartesian_pose
+        (cartesian_pose.x, cartesian_pose.y, cartesian_pose.z,
+         cartesian_pose.theta_x, cartesian_pose.theta_y,
+         cartesian_pose.theta_z) = pose
+        for joint_id, value in enumerate(guess):
+            ik_data.guess.joint_angles.add(joint_identifier = joint_id,
+                                           value = value)
+        solution = base.ComputeInverseKinematics(ik_data)
+        joints = [joint_angle.value for joint_angle in solution.joint_angles]
+        self.store(pose, joints)
+        return joints
+
+    def joint_steps(self, base, compiled, start_pose, start_joints):
+        """Compile steps into reach_joint_angles actions
+        Arguments:
+        base         -- BaseClient connected to the arm
+        compiled     -- list returned by indentation_steps.compile_steps()
+        start_pose   -- measured tool pose before the first step
+        start_joints -- measured joint angles before the first step
+
+        Each solution seeds the IK guess of the next step. Rows with a
+        speed limit get the duration that speed implies. Blended
+        waypoint transits are kept as they are, so they still follow
+        their Cartesian path.
+        """
+        joint_compiled = []
+        pose, joints = start_pose, start_joints
+        for compiled_step in compiled:
+            end_pose = step_pose(compiled_step)
+            joints = self.solve(base, end_pose, joints)
+            if waypoint_poses(compiled_step.action):
+                joint_compiled.append(compiled_step)
+                pose = end_pose
+                continue
+            duration = None
+            if compiled_step.step.speed:
+                travel = sum((b - a) ** 2 for a, b in
+                             zip(pose[:3], end_pose[:3])) ** 0.5
+                duration = travel / (compiled_step.step.speed / 100)
+            action = build_joint_action(compiled_step.action.name, joints,
+                                        duration)
+            joint_compiled.append(compiled_step._replace(action = action))
+            pose = end_pose
+        print("IK cache: {} hits, {} solved".format(self.hits, self.misses))
+        return joint_compiled
@@ -0,0 +1,370 @@
+#! /usr/bin/env python3
+
+
+### Indentation Step Engine ###
+
+# Turns a table of probe targets and depth offsets into ready-to-send
+# Kortex actions, then runs them back to back. The reading scripts
+# describe their protocol as data and leave the action plumbing here.
+#
+# All coordinates in a protocol table are in cm and degrees, the same
+# units as the Kinova Web app "Cartesian" menu. They are converted to
+# meters once, when the table is compiled.
+#
+# Each move gets its own deadline, predicted from the distance it covers
+# and conservative speed limits plus a margin, so a stuck step fails in
+# seconds. A move that aborts raises ActionAborted instead of passing for
+# a finished one.
+#
+# Rows can carry their own Cartesian speed limit, so transit moves run
+# fast while the final approach and the indentation run slowly and
+# repeatably. Rows without one move at the controller's default speed.
+# Rows can also hold the tool still for a dwell time after each move, so
+# a reading is taken once the phantom has relaxed.
+#
+# Transit rows can be given a blending radius. Consecutive moves of such
+# rows are sent as one Cartesian waypoint trajectory that rounds its
+# corners instead of stopping at them; rows without one (the in-contact
+# approach and indentation) keep exact stop-and-settle moves.
+
+import math
+import time
+import collections
+
+from kortex_api.autogen.messages import Base_pb2
+
+from action_notifications import ActionAborted
+
+# Speeds assumed when predicting a move's deadline. They are well below
+# the arm's default Cartesian limits so a slow but healthy move is never
+# cut short.
+PREDICTED_LINEAR_SPEED = 0.1     # (meters/second)
+PREDICTED_ANGULAR_SPEED = 30     # (degrees/second)
+
+# Deadline = TIMEOUT_FACTOR * predicted duration + TIMEOUT_MARGIN
+TIMEOUT_FACTOR = 2
+TIMEOUT_MARGIN = 5               # (seconds)
+
+# Travel assumed when the start pose of a move is unknown: across the
+# whole workspace and half a turn (meters / degrees)
+MAX_TRAVEL = 1.8
+MAX_ROTATION = 180
+
+# Orientation speed limit sent along with a row's translation speed
+# (degrees/second)
+ORIENTATION_SPEED = 30
+
+# Translation speed of waypoints from rows without a speed limit
+# (meters/second)
+WAYPOINT_SPEED = 0.1
+
+# One row of a protocol table.
+#   name        -- label printed while the step runs
+#   target      -- (x, y, z) of the probe point (cm)
+#   offsets     -- z offsets from target[z], one move per offset (cm)
+#   orientation -- (theta_x, theta_y, theta_z) of the end effector (degrees)
+#   phantom     -- "soft", "hard" or None, used to tag recorded data
+#   speed       -- translation speed limit of the row's moves (cm/s), or
+#                  None for the controller's default
+#   dwell       -- time to hold after each of the row's moves (seconds),
+#                  or None
+#   blend       -- blending radius (cm) to blend the row's moves with
+#                  neighbouring blended moves, or None to stop at each
+IndentationStep = collections.namedtuple(
+    "IndentationStep", ["name", "target", "offsets", "orientation",
+                        "phantom", "speed", "dwell", "blend"],
+    defaults = [None, None, None, None])
+
+# A single compiled move: the action message plus the table row and
+# offset it came from.
+CompiledStep = collections.namedtuple(
+    "CompiledStep", ["action", "step", "offset"])
+
+def build_pose_action(name, x, y, z, theta_x, theta_y, theta_z,
+                      speed = None):
+    """Return a reach_pose action for a pose given in meters and degrees
+    Arguments:
+    speed -- optional translation speed limit (meters/second), sent as a
+             CartesianSpeed constraint with ORIENTATION_SPEED
+    """
+    action = Base_pb2.Action()
+    action.name = name
+    action.application_data = ""
+
+    cartesian_pose = action.reach_pose.target_pose
+    cartesian_pose.x = x                # (meters)
+    cartesian_pose.y = y                # (meters)
+    cartesian_pose.z = z                # (meters)
+    cartesian_pose.theta_x = theta_x    # (degrees)
+    cartesian_pose.theta_y = theta_y    # (degrees)
+    cartesian_pose.theta_z = theta_z    # (degrees)
+
+    if speed is not None:
+        cartesian_speed = action.reach_pose.constraint.speed
+        cartesian_speed.translation = speed             # (meters/second)
+        cartesian_speed.orientation = ORIENTATION_SPEED  # (degrees/second)
+    return action
+
+def build_waypoint_action(name, poses, speeds, blending_radii):
+    """Return an execute_waypoint_list action through Cartesian poses
+    Arguments:
+    poses          -- list of (x, y, z, theta_x, theta_y, theta_z)
+                      (meters / degrees)
+    speeds         -- translation speed limit of the move into each pose
+                      (meters/second), None for WAYPOINT_SPEED
+    blending_radii -- blending radius of each pose (meters); the last
+                      pose is always reached exactly
+    """
+    action = Base_pb2.Action()
+    action.name = name
+    action.application_data = ""
+
+    waypoint_list = action.execute_waypoint_list
+    waypoint_list.duration = 0
+    waypoint_list.use_optimal_blending = False
+    for index, (pose, speed, radius) in enumerate(
+            zip(poses, speeds, blending_radii)):
+        waypoint = waypoint_list.waypoints.add()
+        waypoint.name = "{} {}".format(name, index + 1)
+        cartesian_waypoint = waypoint.cartesian_waypoint
+        cartesian_pose = cartesian_waypoint.pose
+        (cartesian_pose.x, cartesian_pose.y, cartesian_pose.z,
+         cartesian_pose.theta_x, cartesian_pose.theta_y,
+         cartesian_pose.theta_z) = pose
+        cartesian_waypoint.reference_frame = \
+            Base_pb2.CARTESIAN_REFERENCE_FRAME_BASE
+        cartesian_waypoint.maximum_linear_velocity = \
+            WAYPOINT_SPEED if speed is None else speed   # (meters/second)
+        cartesian_waypoint.maximum_angular_velocity = \
+            ORIENTATION_SPEED                             # (degrees/second)
+        cartesian_waypoint.blending_radius = \
+            0.0 if index == len(poses) - 1 else radius    # (meters)
+    return action
+
+def build_current_pose_action(tool_pose):
+    """Return an action that holds the tool at a measured pose
+    Arguments:
+    tool_pose -- (x, y, z, theta_x, theta_y, theta_z) in meters and
+                 degrees, e.g. FeedbackSnapshot.tool_pose
+    """
+    return build_pose_action("Move to current pose", *tool_pose)
+
+def _pose_tuple(pose):
+    return (pose.x, pose.y, pose.z, pose.theta_x, pose.theta_y,
+            pose.theta_z)
+
+def waypoint_poses(action):
+    """Poses of the waypoints of an execute_waypoint_list action, an
+    empty list for other actions
+    """
+    return [_pose_tuple(waypoint.cartesian_waypoint.pose)
+            for waypoint in action.execute_waypoint_list.waypoints]
+
+def target_pose(action):
+    """(x, y, z, theta_x, theta_y, theta_z) a reach_pose or waypoint list
+    action ends at
+    """
+    poses = waypoint_poses(action)
+    if poses:
+        return poses[-1]
+    return _pose_tuple(action.reach_pose.target_pose)
+
+def step_pose(compiled_step):
+    """Pose a compiled step moves to (meters / degrees), whichever kind
+    of action it was compiled into
+    """
+    x, y, z = compiled_step.step.target
+    return (x/100, y/100, (z + compiled_step.offset)/100) \
+        + tuple(compiled_step.step.orientation)
+
+def move_timeout(action, start_pose = None, end_pose = None):
+    """Predict the deadline of a move (seconds)
+    Arguments:
+    action     -- reach_pose, waypoint list or reach_joint_angles action
+                  to be sent
+    start_pose -- pose the tool starts from (meters / degrees), None if
+                  unknown
+    end_pose   -- pose the tool ends at, defaults to the action's target
+
+    A CartesianSpeed, waypoint velocity or joint duration constraint
+    slower than the predicted speeds is taken into account.
+    """
+    if end_pose is None:
+        end_pose = target_pose(action)
+    path = waypoint_poses(action)[:-1] + [end_pose]
+    if start_pose is None:
+        travel, rotation = MAX_TRAVEL, MAX_ROTATION
+    else:
+        travel, rotation = 0.0, 0.0
+        path = [start_pose] + path
+    for a, b in zip(path, path[1:]):
+        travel += math.sqrt(sum((q - p) ** 2 for p, q in zip(a[:3], b[:3])))
+        rotation += max(abs((q - p + 180.0) % 360.0 - 180.0) for p, q in
+                        zip(a[3:], b[3:]))
+    linear_speed = PREDICTED_LINEAR_SPEED
+    angular_speed = PREDICTED_ANGULAR_SPEED
+    constraint = action.reach_pose.constraint
+    if action.reach_pose.HasField("constraint") \
+    and constraint.WhichOneof("type") == "speed":
+        linear_speed = min(linear_speed,
+                           constraint.speed.translation or linear_speed)
+        angular_speed = min(angular_speed,
+                            constraint.speed.orientation or angular_speed)
+    for waypoint in action.execute_waypoint_list.waypoints:
+        cartesian_waypoint = waypoint.cartesian_waypoint
+        linear_speed = min(linear_speed,
+                           cartesian_waypoint.maximum_linear_velocity
+                           or linear_speed)
+        angular_speed = min(angular_speed,
+                            cartesian_waypoint.maximum_angular_velocity
+                            or angular_speed)
+    duration = max(travel / linear_speed, rotation / angular_speed)
+    joint_constraint = action.reach_joint_angles.constraint
+    if joint_constraint.type == Base_pb2.JOINT_CONSTRAINT_DURATION:
+        duration = max(duration, joint_constraint.value)
+    return TIMEOUT_FACTOR * duration + TIMEOUT_MARGIN
+
+def step_timeouts(compiled, start_pose = None):
+    """Predicted deadline of each compiled step, each starting where the
+    previous one ends
+    """
+    timeouts = []
+    for compiled_step in compiled:
+        end_pose = step_pose(compiled_step)
+        timeouts.append(move_timeout(compiled_step.action, start_pose,
+                                     end_pose))
+        start_pose = end_pose
+    return timeouts
+
+def _blend(path):
+    """One CompiledStep for a run of blended moves"""
+    if len(path) == 1:
+        return path[0]
+    poses = [step_pose(compiled_step) for compiled_step in path]
+    speeds = [None if compiled_step.step.speed is None
+              else compiled_step.step.speed/100 for compiled_step in path]
+
+    # A corner can only be rounded within half of either of its segments
+    radii = []
+    for index, compiled_step in enumerate(path):
+        radius = compiled_step.step.blend/100
+        for neighbour in (index - 1, index + 1):
+            if 0 <= neighbour < len(poses):
+                radius = min(radius, 0.5 * math.sqrt(sum(
+                    (b - a) ** 2 for a, b in zip(poses[index][:3],
+                                                 poses[neighbour][:3]))))
+        radii.append(radius)
+
+    name = " -> ".join(compiled_step.action.name for compiled_step in path)
+    action = build_waypoint_action(name, poses, speeds, radii)
+    return CompiledStep(action, path[-1].step, path[-1].offset)
+
+def compile_steps(steps):
+    """Compile a protocol table into a flat list of CompiledStep
+    Arguments:
+    steps -- iterable of IndentationStep (cm / degrees)
+
+    Every offset of every row becomes one reach_pose action, limited to
+    the row's speed if it has one, except that consecutive moves of rows
+    with a blending radius become one waypoint list action. Nothing is
+    sent to the arm here, so the list can be built once and run as many
+    times as needed.
+    """
+    compiled = []
+    path = []
+    for step in steps:
+        x, y, z = step.target
+        theta_x, theta_y, theta_z = step.orientation
+        for offset in step.offsets:
+            name = "{} ({:+g} cm)".format(step.name, offset)
+            action = build_pose_action(
+                name, x/100, y/100, (z + offset)/100,
+                theta_x, theta_y, theta_z,
+                None if step.speed is None else step.speed/100)
+            compiled_step = CompiledStep(action, step, offset)
+            if step.blend is not None:
+                path.append(compiled_step)
+                continue
+            if path:
+                compiled.append(_blend(path))
+                path = []
+            compiled.append(compiled_step)
+    if path:
+        compiled.append(_blend(path))
+    return compiled
+
+def wait_action(waiter, action, timeout):
+    """Block until a sent action ends, aborts or times out
+    Arguments:
+    waiter  -- ActionWaiter returned by ActionDispatcher.execute()
+    action  -- the action message that was sent
+    timeout -- maximum wait (seconds)
+
+    Returns True once ACTION_END arrives and False on timeout. Raises
+    ActionAborted if the action aborts.
+    """
+    if not waiter.wait(timeout):
+        return False
+    if waiter.aborted():
+        raise ActionAborted(action.name, waiter.notification)
+    return True
+
+def execute_action(dispatcher, action, timeout = None, start_pose = None):
+    """Send one action and block until it ends, aborts or times out
+    Arguments:
+    dispatcher -- open ActionDispatcher for the session
+    action     -- action message to send
+    timeout    -- maximum wait (seconds), None to predict it from the
+                  move (see move_timeout)
+    start_pose -- pose the tool starts from, used for the prediction
+
+    Returns True once ACTION_END arrives and False on timeout. Raises
+    ActionAborted if the action aborts.
+    """
+    if timeout is None:
+        timeout = move_timeout(action, start_pose)
+    return wait_action(dispatcher.execute(action), action, timeout)
+
+def run_steps(dispatcher, compiled, timeout = None, on_step = None,
+              start_pose = None):
+    """Run compiled steps in order, stopping at the first timeout
+    Arguments:
+    dispatcher -- open ActionDispatcher for the session
+    compiled   -- list returned by compile_steps()
+    timeout    -- maximum wait per move (seconds), None to predict each
+                  move's deadline
+    on_step    -- optional on_step(index, compiled_step), called as soon
+                  as each step has been sent
+    start_pose -- pose the tool starts from, used for the prediction
+
+    The actions are built by compile_steps() beforehand and one
+    notification subscription serves the whole run, so only
+    ExecuteAction sits between one step's END and the next move.
+    Announcing and tagging step N happen after it is sent, while it
+    moves; nothing is prepared ahead for step N + 1, so on_step tags
+    start an ExecuteAction round trip after the previous step ended.
+    Steps from rows with a dwell time hold the tool that long after the
+    move ends. Returns False on timeout. Raises ActionAborted if a step
+    aborts.
+    """
+    if timeout is None:
+        timeouts = step_timeouts(compiled, start_pose)
+    else:
+        timeouts = [timeout] * len(compiled)
+    for index, compiled_step in enumerate(compiled):
+        waiter = dispatcher.execute(compiled_step.action)
+
+        # Step N is moving: announce and tag it before waiting for the
+        # move to end
+        print("Step {}/{}: {}".format(
+            index + 1, len(compiled), compiled_step.action.name))
+        if on_step is not None:
+            on_step(index, compiled_step)
+
+        if not wait_action(waiter, compiled_step.action, timeouts[index]):
+            print("Timeout on action notification wait ({:.0f} s)".format(
+                timeouts[index]))
+            return False
+        if compiled_step.step.dwell:
+            time.sleep(compiled_step.step.dwell)
+    return True
@@ -0,0 +1,891 @@
+#! /usr/bin/env python3
+
+
+### Offline Kortex Base / BaseCyclic Simulator ###
+
+# A local stand-in for the subset of BaseClient and BaseCyclicClient the
+# reading scripts use, so protocols can be profiled and regression-tested
+# without a Gen3 arm. Messages are the real kortex_api protobufs; only
+# the transport and the arm are simulated.
+#
+# The arm model is deliberately simple:
+#   * reach_pose / Cartesian trajectories move the tool pose in a straight
+#     line; the duration comes from the distance and the speed limits
+#     (or a CartesianSpeed constraint, if the move has one).
+#   * reach_joint_angles / joint trajectories move the joints; the tool
+#     pose follows them.
+#   * waypoint lists move through their Cartesian waypoints in straight
+#     lines without stopping at them; blending radii are ignored.
+#   * pose and joints are tied by a toy linear map instead of a kinematic
+#     model: 1 degree of joints 0-2 per cm of x/y/z and 1 degree of
+#     joints 3-5 per degree of theta_x/y/z. Every motion moves both, and
+#     ComputeInverseKinematics and low-level servoing use the same map. It
+#     only has to be self-consistent, not realistic.
+#   * twist commands integrate a constant velocity until Stop() or the
+#     next command.
+#   * a new action preempts the running one, which reports ACTION_ABORT.
+#   * a pose or waypoint beyond MAX_REACH from the base is rejected: the
+#     action reports ACTION_ABORT (INVALID_PARAM) without an ACTION_START
+#     and the running action carries on.
+#   * sequences run their tasks back to back on the notification thread,
+#     in group_identifier order; delay tasks just wait.
+#   * optional flat circular surfaces (add_surface) push back on the tool
+#     like linear springs, which shows up as external tool force.
+#
+# The scripts select the simulator with "--simulate" on the command line
+# (see select_backend()).
+
+import sys
+import time
+import math
+import heapq
+import argparse
+import threading
+import itertools
+
+from kortex_api.autogen.messages import Base_pb2, BaseCyclic_pb2, \
+    ControlConfig_pb2, Errors_pb2
+
+# Default speed limits used to time simulated motion
+MAX_LINEAR_SPEED = 0.25      # (meters/second)
+MAX_ANGULAR_SPEED = 60.0     # (degrees/second)
+MAX_JOINT_SPEED = 40.0       # (degrees/second)
+MAX_FINGER_SPEED = 1.0       # (fraction of full stroke/second)
+
+# Poses further than this from the base origin are unreachable (meters)
+MAX_REACH = 0.9
+
+# Fixed controller-side latency added to every action (seconds)
+ACTION_OVERHEAD = 0.05
+
+# Round-trip time charged to every simulated RPC (seconds)
+RPC_LATENCY = 0.0
+
+# Stiffness of simulated contact surfaces (N/meter)
+SURFACE_STIFFNESS = 2000.0
+
+# Toy kinematics: joint degrees per unit of each tool pose component
+JOINTS_PER_POSE = (100.0, 100.0, 100.0, 1.0, 1.0, 1.0)
+
+ACTUATOR_COUNT = 7
+
+# Starting tool pose (meters / degrees), roughly the Gen3 "Home" pose
+HOME_POSE = (0.456, 0.001, 0.434, 90.0, 0.0, 90.0)
+
+# Joint angles of the stored actions returned by ReadAllActions (degrees)
+STORED_JOINT_ACTIONS = [
+    ("Home", (0.0, 15.0, 180.0, 230.0, 0.0, 55.0, 90.0)),
+    ("Retract", (0.0, 340.0, 180.0, 214.0, 0.0, 310.0, 90.0)),
+    ("Packaging", (0.0, 330.0, 180.0, 213.0, 0.0, 238.0, 90.0)),
+    ("Zero", (0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)),
+]
+
+def _angle_delta(a, b):
+    """Shortest signed difference b - a between two angles (degrees)"""
+    return (b - a + 180.0) % 360.0 - 180.0
+
+def _lerp(start, end, fraction, angular = ()):
+    """Interpolate two tuples, going the short way round for angle slots"""
+    values = []
+    for index, (a, b) in enumerate(zip(start, end)):
+        if index in angular:
+            values.append(a + _angle_delta(a, b) * fraction)
+        else:
+            values.append(a + (b - a) * fraction)
+    return tuple(values)
+
+def _map_joints(joints, start_pose, end_pose):
+    """Joints after the tool moves from start_pose to end_pose (toy map)"""
+    joints = list(joints)
+    for index, scale in enumerate(JOINTS_PER_POSE):
+        delta = end_pose[index] - start_pose[index]
+        if index >= 3:
+            delta = _angle_delta(start_pose[index], end_pose[index])
+        joints[index] += delta * scale
+    return tuple(joints)
+
+def _map_pose(pose, start_joints, end_joints):
+    """Tool pose after the joints move from start_joints to end_joints"""
+    pose = list(pose)
+    for index, scale in enumerate(JOINTS_PER_POSE):
+        pose[index] += _angle_delta(start_joints[index],
+                                    end_joints[index]) / scale
+    return tuple(pose)
+
+def _pose_tuple(pose):
+    return (pose.x, pose.y, pose.z, pose.theta_x, pose.theta_y, pose.theta_z)
+
+class _Motion:
+    """Straight-line interpolation between two states over a duration"""
+    def __init__(self, start, end, t0, duration, angular):
+        self.start = start
+        self.end = end
+        self.t0 = t0
+        self.duration = duration
+        self.angular = angular
+
+    def at(self, t):
+        if self.duration <= 0:
+            return self.end
+        fraction = min(max((t - self.t0) / self.duration, 0.0), 1.0)
+        return _lerp(self.start, self.end, fraction, self.angular)
+
+class _Path:
+    """Straight lines through several states, one after another without
+    stopping at the corners"""
+    def __init__(self, states, t0, durations, angular):
+        self.segments = []
+        for start, end, duration in zip(states, states[1:], durations):
+            self.segments.append(_Motion(start, end, t0, duration, angular))
+            t0 += duration
+        self.end = states[-1]
+
+    def at(self, t):
+        for segment in self.segments:
+            if t < segment.t0 + segment.duration:
+                return segment.at(t)
+        return self.end
+
+class SimulatedArm:
+    """Shared simulated arm state behind the Base and BaseCyclic stand-ins
+
+    Arguments:
+    time_scale -- real seconds per simulated second; 0.01 runs the
+                  protocol 100 times faster than the real arm
+    """
+    def __init__(self, time_scale = 1.0,
+                 linear_speed = MAX_LINEAR_SPEED,
+                 angular_speed = MAX_ANGULAR_SPEED,
+                 joint_speed = MAX_JOINT_SPEED,
+                 action_overhead = ACTION_OVERHEAD,
+                 rpc_latency = RPC_LATENCY):
+        self.time_scale = time_scale
+        self.rpc_latency = rpc_latency
+        self.linear_speed = linear_speed
+        self.angular_speed = angular_speed
+        self.joint_speed = joint_speed
+        self.action_overhead = action_overhead
+
+        self._lock = threading.RLock()
+        self._epoch = time.perf_counter()
+
+        self._pose = _Motion(HOME_POSE, HOME_POSE, 0.0, 0.0, (3, 4, 5))
+        self._joints = _Motion(STORED_JOINT_ACTIONS[0][1],
+                               STORED_JOINT_ACTIONS[0][1], 0.0, 0.0,
+                               tuple(range(ACTUATOR_COUNT)))
+        self._twist = None
+        self._finger = _Motion((0.0,), (0.0,), 0.0, 0.0, ())
+        self._finger_velocity = None
+        self._surfaces = []
+        self.servoing_mode = Base_pb2.SINGLE_LEVEL_SERVOING
+        self.tool_configuration = ControlConfig_pb2.ToolConfiguration()
+
+        self._subscribers = {}
+        self._subscriber_ids = itertools.count(1)
+        self._action_ids = itertools.count(1000)
+        self._current_action = None
+
+        self._queue = []
+        self._queue_ids = itertools.count()
+        self._queue_condition = threading.Condition(self._lock)
+        self._running = True
+        self._thread = threading.Thread(
+            target = self._run_scheduler, name = "SimulatedArm",
+            daemon = True)
+        self._thread.start()
+
+    # Clock and scheduler
+
+    def clock(self):
+        """Simulated time since the arm was created (seconds)"""
+        return (time.perf_counter() - self._epoch) / self.time_scale
+
+    def sleep(self, seconds):
+        """Sleep for a simulated duration"""
+        time.sleep(seconds * self.time_scale)
+
+    def rpc(self):
+        """Charge one RPC round trip to the caller"""
+        if self.rpc_latency > 0:
+            self.sleep(self.rpc_latency)
+
+    def schedule(self, delay, callback):
+        """Run callback on the notification thread after a simulated delay"""
+        with self._queue_condition:
+            heapq.heappush(self._queue, (self.clock() + delay,
+                                         next(self._queue_ids), callback))
+            self._queue_condition.notify()
+
+    def close(self):
+        with self._queue_condition:
+            self._running = False
+            self._queue_condition.notify()
+        self._thread.join()
+
+    def _run_scheduler(self):
+        while True:
+            with self._queue_condition:
+                while self._running:
+                    if self._queue:
+                        delay = self._queue[0][0] - self.clock()
+                        if delay <= 0:
+                            break
+                        self._queue_condition.wait(delay * self.time_scale)
+                    else:
+                        self._queue_condition.wait()
+                if not self._running:
+                    return
+                _, _, callback = heapq.heappop(self._queue)
+            callback()
+
+    # State
+
+    def inverse_kinematics(self, pose):
+        """Joint angles for a tool pose under the toy kinematic map"""
+        with self._lock:
+            t = self.clock()
+            return _map_joints(self.joint_angles(t), self.tool_pose(t), pose)
+
+    def servo_joints(self, joints):
+        """Jump to commanded joint angles (low-level servoing), moving
+        the tool pose through the toy kinematic map
+        """
+        with self._lock:
+            self.preempt()
+            t = self.clock()
+            pose = _map_pose(self.tool_pose(t), self.joint_angles(t), joints)
+            self._pose = _Motion(pose, pose, t, 0.0, (3, 4, 5))
+            self._joints = _Motion(joints, joints, t, 0.0,
+                                   tuple(range(ACTUATOR_COUNT)))
+
+    def add_surface(self, x, y, radius, z, stiffness = SURFACE_STIFFNESS):
+        """Add a flat disc the tool touches when its z drops below `z`
+        Arguments:
+        x, y, radius -- disc center and radius (meters)
+        z            -- tool z at which contact starts (meters)
+        stiffness    -- spring constant of the surface (N/meter)
+        """
+        with self._lock:
+            self._surfaces.append((x, y, radius, z, stiffness))
+
+    def contact_force(self, pose):
+        """Upward force the surfaces push on the tool with at a pose (N)"""
+        force = 0.0
+        for x, y, radius, z, stiffness in self._surfaces:
+            if (pose[0] - x) ** 2 + (pose[1] - y) ** 2 <= radius ** 2 \
+            and pose[2] < z:
+                force += stiffness * (z - pose[2])
+        return force
+
+    def tool_pose(self, t = None):
+        with self._lock:
+            t = self.clock() if t is None else t
+            pose = self._pose.at(t)
+            if self._twist is not None:
+                linear, angular, t0 = self._twist
+                dt = t - t0
+                pose = tuple(p + v * dt for p, v in
+                             zip(pose, linear + angular))
+            return pose
+
+    def joint_angles(self, t = None):
+        with self._lock:
+            return self._joints.at(self.clock() if t is None else t)
+
+    def finger_position(self, t = None):
+        with self._lock:
+            t = self.clock() if t is None else t
+            position = self._finger.at(t)[0]
+            if self._finger_velocity is not None:
+                velocity, t0 = self._finger_velocity
+                position += velocity * (t - t0)
+            return min(max(position, 0.0), 1.0)
+
+    def freeze_twist(self):
+        """Fold a running twist into the static pose"""
+        with self._lock:
+            if self._twist is not None:
+                t = self.clock()
+                pose = self.tool_pose(t)
+                self._twist = None
+                self._pose = _Motion(pose, pose, t, 0.0, (3, 4, 5))
+
+    def freeze_finger(self):
+        with self._lock:
+            if self._finger_velocity is not None:
+                t = self.clock()
+                position = self.finger_position(t)
+                self._finger_velocity = None
+                self._finger = _Motion((position,), (position,), t, 0.0, ())
+
+    # Actions
+
+    def subscribe(self, callback, topic = "action"):
+        with self._lock:
+            identifier = next(self._subscriber_ids)
+            self._subscribers[identifier] = (topic, callback)
+            return identifier
+
+    def unsubscribe(self, identifier):
+        with self._lock:
+            self._subscribers.pop(identifier, None)
+
+    def notify(self, action_event, identifier, action_type,
+               abort_details = None):
+        notification = Base_pb2.ActionNotification()
+        notification.action_event = action_event
+        notification.handle.identifier = identifier
+        notification.handle.action_type = action_type
+        if abort_details is not None:
+            notification.abort_details = abort_details
+        self.publish("action", notification)
+
+    def publish(self, topic, notification):
+        with self._lock:
+            callbacks = [callback for callback_topic, callback
+                         in self._subscribers.values()
+                         if callback_topic == topic]
+        for callback in callbacks:
+            callback(notification)
+
+    def pose_duration(self, start, end, speed = None):
+        """Time to move between poses, optionally slowed down by a
+        (linear, angular) speed limit like a CartesianSpeed constraint
+        """
+        linear_speed, angular_speed = self.linear_speed, self.angular_speed
+        if speed is not None:
+            linear_speed = min(linear_speed, speed[0] or linear_speed)
+            angular_speed = min(angular_speed, speed[1] or angular_speed)
+        distance = math.sqrt(sum((b - a) ** 2 for a, b in
+                                 zip(start[:3], end[:3])))
+        rotation = max(abs(_angle_delta(a, b)) for a, b in
+                       zip(start[3:], end[3:]))
+        return max(distance / linear_speed, rotation / angular_speed)
+
+    def joint_duration(self, start, end):
+        return max(abs(_angle_delta(a, b)) for a, b in zip(start, end)) \
+            / self.joint_speed
+
+    def reachable(self, pose):
+        """Whether a tool pose is within MAX_REACH of the base"""
+        return math.sqrt(sum(value ** 2 for value in pose[:3])) <= MAX_REACH
+
+    def start_action(self, action_type, identifier = None,
+                     pose = None, joints = None, duration = None,
+                     on_end = None, on_abort = None, speed = None,
+                     waypoints = None):
+        """Start a pose or joint motion and schedule its notifications
+        Returns the identifier the notifications will carry. on_end and
+        on_abort are called on the notification thread after the END or
+        ABORT notification went out. waypoints is a list of (pose, speed)
+        the tool goes through in turn instead of moving to one pose.
+        """
+        with self._lock:
+            if identifier is None:
+                identifier = next(self._action_ids)
+            targets = [point for point, _ in waypoints or ()]
+            if pose is not None:
+                targets.append(pose)
+            if not all(self.reachable(target) for target in targets):
+                def reject():
+                    self.notify(Base_pb2.ACTION_ABORT, identifier,
+                                action_type, Errors_pb2.INVALID_PARAM)
+                    if on_abort is not None:
+                        on_abort()
+                self.schedule(self.action_overhead, reject)
+                return identifier
+            self.preempt()
+            t = self.clock()
+            start_pose = self.tool_pose(t)
+            start_joints = self.joint_angles(t)
+            if waypoints:
+                poses = [start_pose] + [point for point, _ in waypoints]
+                durations = [self.pose_duration(a, b, limit) for a, b, limit
+                             in zip(poses, poses[1:],
+                                    [limit for _, limit in waypoints])]
+                joint_states = [start_joints]
+                for a, b in zip(poses, poses[1:]):
+                    joint_states.append(_map_joints(joint_states[-1], a, b))
+                start = t + self.action_overhead
+                self._pose = _Path(poses, start, durations, (3, 4, 5))
+                self._joints = _Path(joint_states, start, durations,
+                                     tuple(range(ACTUATOR_COUNT)))
+                duration = sum(durations)
+            elif pose is not None:
+                if duration is None:
+                    duration = self.pose_duration(start_pose, pose, speed)
+                if joints is None:
+                    joints = _map_joints(start_joints, start_pose, pose)
+            elif joints is not None:
+                if duration is None:
+                    duration = self.joint_duration(start_joints, joints)
+                pose = _map_pose(start_pose, start_joints, joints)
+            if pose is not None:
+                self._pose = _Motion(start_pose, pose,
+                                     t + self.action_overhead, duration,
+                                     (3, 4, 5))
+                self._joints = _Motion(start_joints, joints,
+                                       t + self.action_overhead, duration,
+                                       tuple(range(ACTUATOR_COUNT)))
+            token = object()
+            self._current_action = (token, identifier, action_type,
+                                    on_abort)
+
+        def finish():
+            with self._lock:
+                if self._current_action is None \
+                or self._current_action[0] is not token:
+                    return
+                self._current_action = None
+            self.notify(Base_pb2.ACTION_END, identifier, action_type)
+            if on_end is not None:
+                on_end()
+
+        self.schedule(0.0, lambda: self.notify(
+            Base_pb2.ACTION_START, identifier, action_type))
+        self.schedule(self.action_overhead + (duration or 0.0), finish)
+        return identifier
+
+    def preempt(self):
+        """Abort the running action, holding the arm where it is"""
+        with self._lock:
+            self.freeze_twist()
+            t = self.clock()
+            pose = self.tool_pose(t)
+            joints = self.joint_angles(t)
+            self._pose = _Motion(pose, pose, t, 0.0, (3, 4, 5))
+            self._joints = _Motion(joints, joints, t, 0.0,
+                                   tuple(range(ACTUATOR_COUNT)))
+            current = self._current_action
+            self._current_action = None
+        if current is not None:
+            _, identifier, action_type, on_abort = current
+            def abort():
+                self.notify(Base_pb2.ACTION_ABORT, identifier, action_type)
+                if on_abort is not None:
+                    on_abort()
+            self.schedule(0.0, abort)
+
+class SimulatedBase:
+    """Stand-in for kortex_api BaseClient"""
+    def __init__(self, arm):
+        self.arm = arm
+        self._sequences = {}
+        self._sequence_ids = itertools.count(1)
+        self._playing = None
+        self._stored = {}
+        for index, (name, joints) in enumerate(STORED_JOINT_ACTIONS):
+            action = Base_pb2.Action()
+            action.name = name
+            action.handle.identifier = index + 1
+            action.handle.action_type = Base_pb2.REACH_JOINT_ANGLES
+            for joint_id, value in enumerate(joints):
+                joint_angle = \
+                    action.reach_joint_angles.joint_angles.joint_angles.add()
+                joint_angle.joint_identifier = joint_id
+                joint_angle.value = value
+            self._stored[action.handle.identifier] = action
+
+    def OnNotificationActionTopic(self, callback, notification_options):
+        self.arm.rpc()
+        handle = Base_pb2.NotificationHandle()
+        handle.identifier = self.arm.subscribe(callback)
+        return handle
+
+    def Unsubscribe(self, notification_handle):
+        self.arm.rpc()
+        self.arm.unsubscribe(notification_handle.identifier)
+
+    def GetActuatorCount(self):
+        self.arm.rpc()
+        actuator_count = Base_pb2.ActuatorInformation()
+        actuator_count.count = ACTUATOR_COUNT
+        return actuator_count
+
+    def SetServoingMode(self, servoing_mode_information):
+        self.arm.rpc()
+        self.arm.servoing_mode = servoing_mode_information.servoing_mode
+
+    def GetServoingMode(self):
+        self.arm.rpc()
+        servoing_mode_information = Base_pb2.ServoingModeInformation()
+        servoing_mode_information.servoing_mode = self.arm.servoing_mode
+        return servoing_mode_information
+
+    def ComputeInverseKinematics(self, ik_data):
+        self.arm.rpc()
+        joint_angles = Base_pb2.JointAngles()
+        for joint_id, value in enumerate(self.arm.inverse_kinematics(
+                _pose_tuple(ik_data.cartesian_pose))):
+            joint_angle = joint_angles.joint_angles.add()
+            joint_angle.joint_identifier = joint_id
+            joint_angle.value = value % 360.0
+        return joint_angles
+
+    def ReadAllActions(self, requested_action_type):
+        self.arm.rpc()
+        action_list = Base_pb2.ActionList()
+        for action in self._stored.values():
+            if action.handle.action_type == requested_action_type.action_type:
+                action_list.action_list.add().CopyFrom(action)
+        return action_list
+
+    def ExecuteActionFromReference(self, action_handle):
+        self.arm.rpc()
+        self._execute(self._stored[action_handle.identifier],
+                      action_handle.identifier)
+
+    def ExecuteAction(self, action):
+        self.arm.rpc()
+        self._execute(action, None)
+
+    def _execute(self, action, identifier, on_end = None, on_abort = None):
+        kind = action.WhichOneof("action_parameters")
+        if kind == "reach_pose":
+            self.arm.start_action(
+                Base_pb2.REACH_POSE, identifier,
+                pose = self._constrained_pose(action.reach_pose),
+                on_end = on_end, on_abort = on_abort,
+                speed = self._speed_limit(action.reach_pose))
+        elif kind == "reach_joint_angles":
+            self.arm.start_action(
+                Base_pb2.REACH_JOINT_ANGLES, identifier,
+                joints = self._constrained_joints(action.reach_joint_angles),
+                duration = self._joint_duration(action.reach_joint_angles),
+                on_end = on_end, on_abort = on_abort)
+        elif kind == "execute_waypoint_list":
+            self.arm.start_action(
+                Base_pb2.EXECUTE_WAYPOINT_LIST, identifier,
+                waypoints = self._waypoints(action.execute_waypoint_list),
+                on_end = on_end, on_abort = on_abort)
+        elif kind == "send_gripper_command":
+            self._send_gripper_command(action.send_gripper_command)
+        elif kind == "delay":
+            self.arm.schedule(action.delay.duration, on_end or (lambda: None))
+        else:
+            raise NotImplementedError(
+                "Simulator does not support {} actions".format(kind))
+
+    def _waypoints(self, waypoint_list):
+        waypoints = []
+        for waypoint in waypoint_list.waypoints:
+            cartesian = waypoint.cartesian_waypoint
+            waypoints.append((_pose_tuple(cartesian.pose),
+                              (cartesian.maximum_linear_velocity,
+                               cartesian.maximum_angular_velocity)))
+        return waypoints
+
+    def _constrained_pose(self, constrained_pose):
+        return _pose_tuple(constrained_pose.target_pose)
+
+    def _speed_limit(self, constrained_pose):
+        if not constrained_pose.HasField("constraint") \
+        or constrained_pose.constraint.WhichOneof("type") != "speed":
+            return None
+        speed = constrained_pose.constraint.speed
+        return (speed.translation, speed.orientation)
+
+    def _constrained_joints(self, constrained_joint_angles):
+        joints = list(self.arm.joint_angles())
+        for joint_angle in constrained_joint_angles.joint_angles.joint_angles:
+            joints[joint_angle.joint_identifier] = joint_angle.value
+        return tuple(joints)
+
+    def _joint_duration(self, constrained_joint_angles):
+        constraint = constrained_joint_angles.constraint
+        if constraint.type == Base_pb2.JOINT_CONSTRAINT_DURATION \
+        and constraint.value > 0:
+            return constraint.value
+        return None
+
+    def OnNotificationSequenceInfoTopic(self, callback,
+                                        notification_options):
+        self.arm.rpc()
+        handle = Base_pb2.NotificationHandle()
+        handle.identifier = self.arm.subscribe(callback, "sequence")
+        return handle
+
+    def CreateSequence(self, sequence):
+        self.arm.rpc()
+        handle = Base_pb2.SequenceHandle()
+        handle.identifier = next(self._sequence_ids)
+        stored = Base_pb2.Sequence()
+        stored.CopyFrom(sequence)
+        self._sequences[handle.identifier] = stored
+        return handle
+
+    def DeleteSequence(self, sequence_handle):
+        self.arm.rpc()
+        del self._sequences[sequence_handle.identifier]
+
+    def PlaySequence(self, sequence_handle):
+        self.arm.rpc()
+        tasks = sorted(self._sequences[sequence_handle.identifier].tasks,
+                       key = lambda task: task.group_identifier)
+        self._playing = sequence_handle.identifier
+        self._play_task(sequence_handle.identifier, tasks, 0)
+
+    def StopSequence(self):
+        self.arm.rpc()
+        self._playing = None
+        self.arm.preempt()
+
+    def _sequence_event(self, identifier, event, task_index = 0):
+        notification = Base_pb2.SequenceInfoNotification()
+        notification.event_identifier = event
+        notification.sequence_handle.identifier = identifier
+        notification.task_index = task_index
+        self.arm.publish("sequence", notification)
+
+    def _play_task(self, identifier, tasks, index):
+        if self._playing != identifier:
+            return
+        if index == len(tasks):
+            self.arm.schedule(0.0, lambda: self._sequence_event(
+                identifier, Base_pb2.SEQUENCE_COMPLETED, index))
+            return
+
+        def completed():
+            self._sequence_event(identifier,
+                                 Base_pb2.SEQUENCE_TASK_COMPLETED, index)
+            self._play_task(identifier, tasks, index + 1)
+
+        def aborted():
+            self._sequence_event(identifier, Base_pb2.SEQUENCE_ABORTED, index)
+
+        self.arm.schedule(0.0, lambda: self._sequence_event(
+            identifier, Base_pb2.SEQUENCE_TASK_STARTED, index))
+        self._execute(tasks[index].action, None, completed, aborted)
+
+    def PlayCartesianTrajectory(self, constrained_pose):
+        self.arm.rpc()
+        self.arm.start_action(Base_pb2.REACH_POSE,
+                              pose = self._constrained_pose(constrained_pose),
+                              speed = self._speed_limit(constrained_pose))
+
+    def PlayJointTrajectory(self, constrained_joint_angles):
+        self.arm.rpc()
+        self.arm.start_action(
+            Base_pb2.REACH_JOINT_ANGLES,
+            joints = self._constrained_joints(constrained_joint_angles),
+            duration = self._joint_duration(constrained_joint_angles))
+
+    def SendTwistCommand(self, twist_command):
+        self.arm.rpc()
+        twist = twist_command.twist
+        with self.arm._lock:
+            self.arm.preempt()
+            self.arm._twist = (
+                (twist.linear_x, twist.linear_y, twist.linear_z),
+                (twist.angular_x, twist.angular_y, twist.angular_z),
+                self.arm.clock())
+
+    def Stop(self):
+        self.arm.rpc()
+        self.arm.preempt()
+
+    def SendGripperCommand(self, gripper_command):
+        self.arm.rpc()
+        self._send_gripper_command(gripper_command)
+
+    def _send_gripper_command(self, gripper_command):
+        finger = gripper_command.gripper.finger[0]
+        with self.arm._lock:
+            self.arm.freeze_finger()
+            t = self.arm.clock()
+            position = self.arm.finger_position(t)
+            if gripper_command.mode == Base_pb2.GRIPPER_POSITION:
+                target = min(max(finger.value, 0.0), 1.0)
+                self.arm._finger = _Motion(
+                    (position,), (target,), t,
+                    abs(target - position) / MAX_FINGER_SPEED, ())
+            elif gripper_command.mode == Base_pb2.GRIPPER_SPEED:
+                # Negative speed closes, as on the Robotiq 2F-85
+                velocity = -finger.value * MAX_FINGER_SPEED
+                self.arm._finger = _Motion(
+                    (position,), (position,), t, 0.0, ())
+                self.arm._finger_velocity = (velocity, t)
+            else:
+                raise NotImplementedError(
+                    "Simulator does not support gripper mode {}".format(
+                        gripper_command.mode))
+
+    def GetMeasuredGripperMovement(self, gripper_request):
+        self.arm.rpc()
+        gripper = Base_pb2.Gripper()
+        finger = gripper.finger.add()
+        finger.finger_identifier = 1
+        with self.arm._lock:
+            t = self.arm.clock()
+            if gripper_request.mode == Base_pb2.GRIPPER_SPEED:
+                dt = 1e-3
+                finger.value = (self.arm.finger_position(t) -
+                                self.arm.finger_position(t - dt)) / dt
+            else:
+                finger.value = self.arm.finger_position(t)
+        return gripper
+
+class SimulatedBaseCyclic:
+    """Stand-in for kortex_api BaseCyclicClient"""
+    def __init__(self, arm):
+        self.arm = arm
+
+    def Refresh(self, command):
+        """Apply a low-level command and return the resulting feedback"""
+        if self.arm.servoing_mode != Base_pb2.LOW_LEVEL_SERVOING:
+            raise RuntimeError("Refresh requires LOW_LEVEL_SERVOING")
+        self.arm.servo_joints(tuple(actuator.position
+                                    for actuator in command.actuators))
+        return self.RefreshFeedback()
+
+    def RefreshFeedback(self):
+        self.arm.rpc()
+        feedback = BaseCyclic_pb2.Feedback()
+        with self.arm._lock:
+            t = self.arm.clock()
+            pose = self.arm.tool_pose(t)
+            joints = self.arm.joint_angles(t)
+            finger = self.arm.finger_position(t)
+
+        base = feedback.base
+        (base.tool_pose_x, base.tool_pose_y, base.tool_pose_z,
+         base.tool_pose_theta_x, base.tool_pose_theta_y,
+         base.tool_pose_theta_z) = pose
+        (base.commanded_tool_pose_x, base.commanded_tool_pose_y,
+         base.commanded_tool_pose_z, base.commanded_tool_pose_theta_x,
+         base.commanded_tool_pose_theta_y,
+         base.commanded_tool_pose_theta_z) = pose
+        base.tool_external_wrench_force_x = 0.0
+        base.tool_external_wrench_force_y = 0.0
+        base.tool_external_wrench_force_z = self.arm.contact_force(pose)
+        base.tool_external_wrench_torque_x = 0.0
+        base.tool_external_wrench_torque_y = 0.0
+        base.tool_external_wrench_torque_z = 0.0
+
+        for value in joints:
+            actuator = feedback.actuators.add()
+            actuator.position = value % 360.0
+            actuator.velocity = 0.0
+            actuator.torque = 0.0
+
+        motor = feedback.interconnect.gripper_feedback.motor.add()
+        motor.position = finger * 100.0
+        return feedback
+
+# Drop-in replacements for the Kortex example "utilities" module and the
+# client constructors, so a script can swap backends in one place.
+
+class SimulatedRouter:
+    def __init__(self, arm):
+        self.arm = arm
+
+class _SimulatedConnection:
+    def __init__(self, arm):
+        self.arm = arm
+
+    def __enter__(self):
+        return SimulatedRouter(self.arm)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+class SimulatedControlConfig:
+    """Stand-in for kortex_api ControlConfigClient (tool configuration)"""
+    def __init__(self, arm):
+        self.arm = arm
+
+    def GetToolConfiguration(self):
+        self.arm.rpc()
+        tool_configuration = ControlConfig_pb2.ToolConfiguration()
+        tool_configuration.CopyFrom(self.arm.tool_configuration)
+        return tool_configuration
+
+    def SetToolConfiguration(self, tool_configuration):
+        self.arm.rpc()
+        self.arm.tool_configuration.CopyFrom(tool_configuration)
+
+class DeviceConnection:
+    """Mirror of utilities.DeviceConnection backed by SimulatedArms
+
+    Each --ip gets its own SimulatedArm, shared by its TCP and UDP
+    connections, so several arms can be simulated side by side.
+    """
+    arms = {}
+    surfaces = []
+
+    @staticmethod
+    def _arm(args):
+        ip = getattr(args, "ip", None)
+        if ip not in DeviceConnection.arms:
+            arm = SimulatedArm(getattr(args, "time_scale", 1.0))
+            for surface in DeviceConnection.surfaces:
+                arm.add_surface(*surface)
+            DeviceConnection.arms[ip] = arm
+        return DeviceConnection.arms[ip]
+
+    @staticmethod
+    def createTcpConnection(args):
+        return _SimulatedConnection(DeviceConnection._arm(args))
+
+    @staticmethod
+    def createUdpConnection(args):
+        return _SimulatedConnection(DeviceConnection._arm(args))
+
+def parseConnectionArguments(parser = None):
+    if parser is None:
+        parser = argparse.ArgumentParser()
+    parser.add_argument("--ip", type = str, default = "192.168.1.10",
+                        help = "IP address of destination")
+    parser.add_argument("-u", "--username", type = str, default = "admin",
+                        help = "username to login")
+    parser.add_argument("-p", "--password", type = str, default = "admin",
+                        help = "password to login")
+    parser.add_argument("--time_scale", type = float, default = 1.0,
+                        help = "real seconds per simulated second")
+    parser.add_argument("--surface", action = "append", default = [],
+                        metavar = "X,Y,RADIUS,Z",
+                        help = "add a contact surface (meters)")
+    args = parser.parse_args()
+    DeviceConnection.surfaces = [
+        [float(value) for value in surface.split(",")]
+        for surface in args.surface]
+    return args
+
+def BaseClient(router):
+    return SimulatedBase(router.arm)
+
+def BaseCyclicClient(router):
+    return SimulatedBaseCyclic(router.arm)
+
+def ControlConfigClient(router):
+    return SimulatedControlConfig(router.arm)
+
+def select_backend(argv = None):
+    """Return (utilities, BaseClient, BaseCyclicClient) for a script
+
+    With "--simulate" in argv (removed before the connection arguments
+    are parsed) these are the simulator stand-ins; otherwise they are the
+    Kortex example utilities module and the real kortex_api clients.
+    The caller must already have the utilities directory on sys.path.
+    """
+    argv = sys.argv if argv is None else argv
+    if "--simulate" in argv:
+        argv.remove("--simulate")
+        return sys.modules[__name__], BaseClient, BaseCyclicClient
+
+    import utilities
+    from kortex_api.autogen.client_stubs.BaseClientRpc \
+        import BaseClient as KortexBaseClient
+    from kortex_api.autogen.client_stubs.BaseCyclicClientRpc \
+        import BaseCyclicClient as KortexBaseCyclicClient
+    return utilities, KortexBaseClient, KortexBaseCyclicClient
+
+def control_config_client(utilities, router):
+    """ControlConfigClient on a router, for the backend that
+    select_backend() returned as `utilities`
+    """
+    if utilities is sys.modules[__name__]:
+        return ControlConfigClient(router)
+    from kortex_api.autogen.client_stubs.ControlConfigClientRpc \
+        import ControlConfigClient as KortexControlConfigClient
+    return KortexControlConfigClient(router)
@@ -0,0 +1,204 @@
+#! /usr/bin/env python3
+
+
+### Multi-Arm Protocol Orchestration ###
+
+# Runs independent protocol tables on several arms at once. Each arm gets
+# its own session (TCP router and BaseClient, UDP router with a
+# FeedbackSampler, and an ActionDispatcher), and each protocol runs in
+# its own thread, so a bench with N arms takes about as long as its
+# slowest arm rather than the sum of all of them. Telemetry from every
+# arm goes into one recording, tagged by arm number.
+#
+# Example (two arms, same protocol on both, merged recording):
+#   python3 multi_arm.py --arm 192.168.1.10 --arm 192.168.1.11 \
+#       --record bench.tel
+#
+# Arms are numbered in the order they are given; --script can be given
+# once for all arms or once per arm.
+
+import os
+import sys
+import argparse
+import contextlib
+import concurrent.futures
+
+import kortex_sim
+from action_notifications import ActionDispatcher, ActionAborted
+from feedback_sampler import FeedbackSampler
+from telemetry_recorder import TelemetryRecorder
+from benchmark_motion import DEFAULT_SCRIPT, load_protocol
+from indentation_steps import compile_steps, run_steps, execute_action, \
+    build_current_pose_action
+
+# Cyclic feedback sampling rate per arm (Hz) and maximum wait for the
+# first sample (in seconds)
+SAMPLE_RATE = 500
+SAMPLE_TIMEOUT = 5
+
+# Maximum allowed waiting time during actions (in seconds). None lets
+# the step engine predict each move's deadline from its length.
+TIMEOUT_DURATION = None
+
+class ArmSession:
+    """All connections to one arm
+
+        with ArmSession("left", args, utilities, BaseClient,
+                        BaseCyclicClient) as session:
+            run_protocol(session, protocol)
+    """
+    def __init__(self, name, args, utilities, BaseClient, BaseCyclicClient,
+                 sample_rate = SAMPLE_RATE):
+        self.name = name
+        self.args = args
+        self.utilities = utilities
+        self.BaseClient = BaseClient
+        self.BaseCyclicClient = BaseCyclicClient
+        self.sample_rate = sample_rate
+        self.base = None
+        self.sampler = None
+        self.dispatcher = None
+        self._stack = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """Connect to the arm and start its sampler and dispatcher"""
+        stack = contextlib.ExitStack()
+        try:
+            DeviceConnection = self.utilities.DeviceConnection
+            router = stack.enter_context(
+                DeviceConnection.createTcpConnection(self.args))
+            router_real_time = stack.enter_context(
+                DeviceConnection.createUdpConnection(self.args))
+            self.base = self.BaseClient(router)
+            self.sampler = stack.enter_context(FeedbackSampler(
+                self.BaseCyclicClient(router_real_time), self.sample_rate))
+            self.dispatcher = stack.enter_context(ActionDispatcher(self.base))
+        except:
+            stack.close()
+            raise
+        self._stack = stack
+        return self
+
+    def close(self):
+        """Stop the sampler and dispatcher and close both routers"""
+        if self._stack is not None:
+            self._stack.close()
+            self._stack = None
+
+def run_protocol(session, protocol, timeout = TIMEOUT_DURATION,
+                 stream = None):
+    """Run a protocol table on one arm
+    Arguments:
+    session  -- open ArmSession
+    protocol -- list of IndentationStep
+    timeout  -- maximum wait per move (seconds), None to predict it
+    stream   -- optional TelemetryStream to record this arm into
+    """
+    compiled = compile_steps(protocol)
+
+    snapshot = session.sampler.wait_for_sample(SAMPLE_TIMEOUT)
+    if snapshot is None:
+        print("[{}] No cyclic feedback received".format(session.name))
+        return False
+
+    on_step = None
+    if stream is not None:
+        session.sampler.add_listener(stream.record_feedback)
+        on_step = stream.begin_step
+    try:
+        execute_action(session.dispatcher,
+                       build_current_pose_action(snapshot.tool_pose),
+                       timeout, snapshot.tool_pose)
+        finished = run_steps(session.dispatcher, compiled, timeout, on_step,
+                             snapshot.tool_pose)
+    except ActionAborted as error:
+        print("[{}] {}".format(session.name, error))
+        finished = False
+    finally:
+        if stream is not None:
+            session.sampler.remove_listener(stream.record_feedback)
+            stream.end_steps()
+
+    print("[{}] Protocol {}".format(
+        session.name, "completed" if finished else "failed"))
+    return finished
+
+def run_concurrently(sessions, protocols, timeout = TIMEOUT_DURATION,
+                     recorder = None):
+    """Run one protocol per session, all at the same time
+    Arguments:
+    sessions  -- list of open ArmSession
+    protocols -- list of protocol tables, one per session
+    timeout   -- maximum wait per move (seconds), None to predict it
+    recorder  -- optional TelemetryRecorder; session i records into
+                 recorder.stream(i)
+
+    Returns a list with the result of run_protocol for each session. An
+    exception on one arm does not stop the others; it is raised once
+    they have all finished.
+    """
+    with concurrent.futures.ThreadPoolExecutor(len(sessions)) as executor:
+        futures = []
+        for index, (session, protocol) in enumerate(zip(sessions,
+                                                        protocols)):
+            stream = None if recorder is None else recorder.stream(index)
+            futures.append(executor.submit(run_protocol, session, protocol,
+                                           timeout, stream))
+        concurrent.futures.wait(futures)
+    return [future.result() for future in futures]
+
+def main():
+
+    # Import the utilities helper module, or the offline simulator when
+    # run with --simulate
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+    utilities, BaseClient, BaseCyclicClient = kortex_sim.select_backend()
+
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arm", action = "append", default = [],
+                        metavar = "IP",
+                        help = "IP address of an arm (repeat for each arm)")
+    parser.add_argument("--script", action = "append", default = [],
+                        help = "reading script whose protocol table to run "
+                               "(once for all arms, or once per arm)")
+    parser.add_argument("--record", metavar = "PATH",
+                        help = "record cyclic feedback of all arms to one "
+                               "telemetry file")
+    parser.add_argument("--timeout", type = float,
+                        default = TIMEOUT_DURATION)
+    args = utilities.parseConnectionArguments(parser)
+
+    ips = args.arm or [args.ip]
+    scripts = args.script or [DEFAULT_SCRIPT]
+    if len(scripts) == 1:
+        scripts = scripts * len(ips)
+    if len(scripts) != len(ips):
+        parser.error("give --script once, or once per --arm")
+    protocols = [load_protocol(script) for script in scripts]
+
+    with contextlib.ExitStack() as stack:
+        sessions = []
+        for ip in ips:
+            arm_args = argparse.Namespace(**vars(args))
+            arm_args.ip = ip
+            sessions.append(stack.enter_context(ArmSession(
+                ip, arm_args, utilities, BaseClient, BaseCyclicClient)))
+
+        recorder = None
+        if args.record:
+            recorder = stack.enter_context(TelemetryRecorder(args.record))
+
+        results = run_concurrently(sessions, protocols, args.timeout,
+                                   recorder)
+
+    return 0 if all(results) else 1
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,265 @@
+#! /usr/bin/env python3
+
+
+### Protocol Files ###
+
+# Describes an indentation run in a JSON or TOML file instead of script
+# globals, and builds the same protocol table the reading scripts write
+# by hand:
+#
+#   {
+#     "sensor":      {"height": 11.5, "diameter": 6.5},
+#     "orientation": [90, 0, 90],
+#     "depths":      [0, -0.2, -0.4, -0.6, -0.8, -2],
+#     "speeds":      {"transit": 10, "contact": 0.5},
+#     "dwell":       0,
+#     "blending_radius": 0.5,
+#     "table":       [[47, 10, -3.5], [47, 10, -3.5],
+#                     [30, -14, -3.5], [30, 10, -3.5]],
+#     "phantoms": [
+#       {"name": "soft", "center": [45, 5, -1.5], "diameter": 5},
+#       {"name": "hard", "center": [45, -5, -0.5], "diameter": 5}
+#     ]
+#   }
+#
+# Phantoms are visited in the order given. Each gets a transit approach,
+# its depth series (its own "depths"/"dwell" if set, the file's
+# otherwise), and a lift just high enough to clear the way to the next
+# one; the last one retracts by "retract" cm. With "blending_radius"
+# the transit moves between series are blended into waypoint
+# trajectories. Units are cm, cm/s, degrees and seconds, like the
+# protocol tables.
+#
+# The table built from a file is cached under its content hash, so a
+# later launch with the same file skips validation and clearance
+# planning and only has to compile the actions.
+#
+# Example (print the plan of a protocol file):
+#   python3 protocol_file.py tis_protocol.json
+
+import os
+import json
+import hashlib
+import argparse
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+from telemetry_recorder import PHANTOM_CODES
+from clearance import Obstacle, table_height, clearance
+from indentation_steps import IndentationStep, compile_steps
+
+# Defaults of the optional settings
+RETRACT_HEIGHT = 15      # (cm)
+APPROACH_HEIGHT = 1      # (cm)
+
+# Compiled plans are cached here, one JSON file per content hash
+PLAN_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          ".plan_cache")
+
+# Part of the cache key, so a change to how plans are validated or
+# built invalidates every cached plan
+PLAN_VERSION = 3
+
+def _number(value, where, minimum = None, above = None):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("{}: expected a number".format(where))
+    if minimum is not None and value < minimum:
+        raise ValueError("{}: must be at least {}".format(where, minimum))
+    if above is not None and value <= above:
+        raise ValueError("{}: must be more than {}".format(where, above))
+    return float(value)
+
+def _numbers(value, where, count = None):
+    if not isinstance(value, list) or not value \
+    or (count is not None and len(value) != count):
+        raise ValueError("{}: expected a list of {}numbers".format(
+            where, "" if count is None else "{} ".format(count)))
+    return [_number(item, "{}[{}]".format(where, index))
+            for index, item in enumerate(value)]
+
+def _optional(value, where, minimum = None, above = None):
+    return None if value is None else _number(value, where, minimum,
+                                              above)
+
+def parse(content, path):
+    """Decode a protocol file, as TOML if its name ends in .toml and as
+    JSON otherwise
+    """
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise RuntimeError("TOML protocol files need Python 3.11")
+        return tomllib.loads(content.decode())
+    return json.loads(content)
+
+def validate(data):
+    """Check a decoded protocol file and fill in its defaults
+    Raises ValueError naming the first bad setting.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("protocol: expected a table of settings")
+    sensor = data.get("sensor")
+    if not isinstance(sensor, dict):
+        raise ValueError("sensor: expected height and diameter")
+    speeds = data.get("speeds", {})
+    if not isinstance(speeds, dict):
+        raise ValueError("speeds: expected transit and contact")
+
+    config = {
+        "height": _number(sensor.get("height"), "sensor.height", 0),
+        "diameter": _number(sensor.get("diameter"), "sensor.diameter", 0),
+        "orientation": _numbers(data.get("orientation"), "orientation", 3),
+        "depths": _numbers(data.get("depths"), "depths"),
+        "retract": _number(data.get("retract", RETRACT_HEIGHT), "retract",
+                           0),
+        "approach_height": _number(
+            data.get("approach_height", APPROACH_HEIGHT), "approach_height",
+            0),
+        "transit_speed": _optional(speeds.get("transit"), "speeds.transit",
+                                   above = 0),
+        "contact_speed": _optional(speeds.get("contact"), "speeds.contact",
+                                   above = 0),
+        "dwell": _optional(data.get("dwell"), "dwell", 0),
+        "blend": _optional(data.get("blending_radius"), "blending_radius",
+                           0),
+    }
+    table = data.get("table")
+    if not isinstance(table, list) or not table:
+        raise ValueError("table: expected the Pyrex corner points")
+    config["table"] = [_numbers(corner, "table[{}]".format(index), 3)
+                       for index, corner in enumerate(table)]
+
+    phantoms = data.get("phantoms")
+    if not isinstance(phantoms, list) or not phantoms:
+        raise ValueError("phantoms: expected at least one phantom")
+    config["phantoms"] = []
+    for index, phantom in enumerate(phantoms):
+        where = "phantoms[{}]".format(index)
+        if not isinstance(phantom, dict):
+            raise ValueError("{}: expected a table of settings".format(where))
+        name = phantom.get("name")
+        if not isinstance(name, str) or name not in PHANTOM_CODES:
+            raise ValueError("{}.name: expected one of {}".format(
+                where, ", ".join(sorted(key for key in PHANTOM_CODES
+                                        if key is not None))))
+        config["phantoms"].append({
+            "name": name,
+            "center": _numbers(phantom.get("center"), where + ".center", 3),
+            "diameter": _number(phantom.get("diameter"),
+                                where + ".diameter", 0),
+            "depths": config["depths"] if phantom.get("depths") is None
+                      else _numbers(phantom["depths"], where + ".depths"),
+            "dwell": config["dwell"] if phantom.get("dwell") is None
+                     else _number(phantom["dwell"], where + ".dwell", 0),
+        })
+    return config
+
+def build_protocol(config):
+    """Protocol table (list of IndentationStep) of a validated file
+    """
+    height = config["height"]
+    radius = config["diameter"] / 2
+    orientation = tuple(config["orientation"])
+    approach_height = config["approach_height"]
+    transit_speed = config["transit_speed"]
+    contact_speed = config["contact_speed"]
+    blend = config["blend"]
+
+    def transit_offsets(lift):
+        if lift > approach_height:
+            return [lift, approach_height]
+        return [approach_height]
+
+    # Probe points put the tube edge over each phantom center, like the
+    # reading scripts do
+    phantoms = config["phantoms"]
+    targets = [(phantom["center"][0] - radius, phantom["center"][1],
+                phantom["center"][2] + height) for phantom in phantoms]
+    obstacles = [Obstacle(phantom["name"], phantom["center"][0],
+                          phantom["center"][1], phantom["diameter"] / 2,
+                          phantom["center"][2]) for phantom in phantoms]
+    table = table_height(config["table"])
+
+    protocol = []
+    lift = config["retract"]
+    for index, (phantom, target) in enumerate(zip(phantoms, targets)):
+        label = phantom["name"].capitalize()
+        name = "{} Approach".format(label) if index == 0 \
+               else "Transition to {} Inclusion".format(label)
+        protocol.append(IndentationStep(
+            name, target, transit_offsets(lift), orientation,
+            phantom["name"], transit_speed, blend = blend))
+        protocol.append(IndentationStep(
+            "{} Indentation".format(label), target, phantom["depths"],
+            orientation, phantom["name"], contact_speed,
+            phantom["dwell"] or None))
+        if index + 1 < len(targets):
+            retract, lift = clearance(target, targets[index + 1], obstacles,
+                                      table, height, radius, radius)
+            protocol.append(IndentationStep(
+                "Retracting Arm", target, [retract], orientation,
+                phantom["name"], transit_speed, blend = blend))
+        else:
+            protocol.append(IndentationStep(
+                "Retracting Arm", target, [config["retract"]], orientation,
+                phantom["name"], transit_speed))
+    return protocol
+
+def plan_key(content):
+    """Cache key of a protocol file's content"""
+    return hashlib.sha256(
+        "{}\0".format(PLAN_VERSION).encode() + content).hexdigest()
+
+def load_plan(path, cache = PLAN_CACHE):
+    """Protocol table of a protocol file, from the cache if this exact
+    file content was loaded before
+    Arguments:
+    path  -- JSON or TOML protocol file
+    cache -- plan cache directory, None to always build the table
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+    cached = None
+    if cache is not None:
+        cached = os.path.join(cache, plan_key(content) + ".json")
+        if os.path.exists(cached):
+            with open(cached) as f:
+                return [IndentationStep(**dict(row,
+                                               target = tuple(row["target"]),
+                                               orientation = tuple(
+                                                   row["orientation"])))
+                        for row in json.load(f)]
+
+    protocol = build_protocol(validate(parse(content, path)))
+    if cached is not None:
+        os.makedirs(cache, exist_ok = True)
+        temporary = cached + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump([step._asdict() for step in protocol], f, indent = 1)
+        os.replace(temporary, cached)
+    return protocol
+
+def compile_plan(path, cache = PLAN_CACHE):
+    """Compiled steps of a protocol file (see load_plan)"""
+    return compile_steps(load_plan(path, cache))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help = "JSON or TOML protocol file")
+    parser.add_argument("--no_cache", action = "store_true",
+                        help = "validate and build the plan even if cached")
+    args = parser.parse_args()
+
+    compiled = compile_plan(args.path, None if args.no_cache else PLAN_CACHE)
+    for index, compiled_step in enumerate(compiled):
+        step = compiled_step.step
+        print("{:3d} {:<40} {:>6} cm/s{}".format(
+            index + 1, compiled_step.action.name,
+            "-" if step.speed is None else "{:g}".format(step.speed),
+            "" if not step.dwell else ", dwell {:g} s".format(step.dwell)))
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,161 @@
+#! /usr/bin/env python3
+
+
+### Controller-Side Sequence Upload ###
+
+# Runs a compiled protocol as one Base_pb2.Sequence. The whole step list
+# is uploaded with CreateSequence and started with PlaySequence; the
+# controller then goes from task to task on its own, so there is no host
+# round trip or scheduling jitter between steps. Progress is followed
+# through sequence info notifications.
+#
+# A row's dwell time becomes a delay task after each of its moves, so
+# the controller holds the tool there before going on.
+
+import threading
+
+from kortex_api.autogen.messages import Base_pb2
+
+from action_notifications import ActionAborted
+from indentation_steps import step_timeouts
+
+def task_steps(compiled):
+    """Compiled step index of each sequence task, None for delay tasks
+    """
+    steps = []
+    for index, compiled_step in enumerate(compiled):
+        steps.append(index)
+        if compiled_step.step.dwell:
+            steps.append(None)
+    return steps
+
+def build_sequence(compiled, name = "Indentation protocol"):
+    """Return a Base_pb2.Sequence running compiled steps one after another
+    Arguments:
+    compiled -- list returned by indentation_steps.compile_steps()
+    name     -- sequence name shown in the Kinova Web app
+
+    Steps from rows with a dwell time are followed by a delay task.
+    """
+    sequence = Base_pb2.Sequence()
+    sequence.name = name
+    sequence.application_data = ""
+    previous = None
+    for task_index, index in enumerate(task_steps(compiled)):
+        # Tasks that share a group identifier run together, so every
+        # task gets its own group to keep them sequential.
+        task = sequence.tasks.add()
+        task.group_identifier = task_index
+        if index is None:
+            task.action.name = "Dwell"
+            task.action.delay.duration = previous.step.dwell   # (seconds)
+        else:
+            previous = compiled[index]
+            task.action.CopyFrom(previous.action)
+    return sequence
+
+class SequenceProgress:
+    """Follows the sequence info notifications of one played sequence
+    """
+    def __init__(self, compiled, on_step = None):
+        self.compiled = compiled
+        self.on_step = on_step
+        self.steps = task_steps(compiled)
+        self.identifier = None
+        self.task_index = None
+        self.step_index = None
+        self.completed = False
+        self.aborted = False
+        self.notification = None
+        self._condition = threading.Condition()
+        self._updates = 0
+
+    def notify(self, notification):
+        with self._condition:
+            if self.identifier is None \
+            or notification.sequence_handle.identifier != self.identifier:
+                return
+            event = notification.event_identifier
+            if event == Base_pb2.SEQUENCE_TASK_STARTED:
+                self.task_index = notification.task_index
+                index = self.steps[self.task_index]
+                if index is not None:
+                    self.step_index = index
+                    print("Step {}/{}: {}".format(
+                        index + 1, len(self.compiled),
+                        self.compiled[index].action.name))
+                    if self.on_step is not None:
+                        self.on_step(index, self.compiled[index])
+            elif event == Base_pb2.SEQUENCE_COMPLETED:
+                self.completed = True
+            elif event == Base_pb2.SEQUENCE_ABORTED \
+            or event == Base_pb2.SEQUENCE_TASK_ERROR:
+                self.aborted = True
+                self.notification = notification
+            self._updates += 1
+            self._condition.notify_all()
+
+    def wait(self, timeout):
+        """Block until the sequence completes or aborts
+        Returns False if it aborted or made no progress for `timeout`.
+        """
+        with self._condition:
+            while not (self.completed or self.aborted):
+                updates = self._updates
+                if not self._condition.wait_for(
+                        lambda: self._updates != updates, timeout):
+                    return False
+            return self.completed
+
+def run_sequence(base, compiled, timeout = None, on_step = None,
+                 start_pose = None):
+    """Upload compiled steps as one sequence, play it and wait for it
+    Arguments:
+    base       -- BaseClient connected to the arm
+    compiled   -- list returned by indentation_steps.compile_steps()
+    timeout    -- maximum time without progress (seconds), None for the
+                  predicted deadline of the whole sequence
+    on_step    -- optional on_step(index, compiled_step), called from the
+                  notification thread as each task starts
+    start_pose -- pose the tool starts from, used for the prediction
+
+    On timeout the sequence and the arm are stopped before the sequence
+    is deleted. Returns False on timeout. Raises ActionAborted if a task
+    aborts.
+    """
+    if timeout is None:
+        timeout = sum(step_timeouts(compiled, start_pose)) \
+                + sum(compiled_step.step.dwell or 0
+                      for compiled_step in compiled)
+    progress = SequenceProgress(compiled, on_step)
+    notification_handle = base.OnNotificationSequenceInfoTopic(
+        progress.notify,
+        Base_pb2.NotificationOptions()
+    )
+    try:
+        sequence_handle = base.CreateSequence(build_sequence(compiled))
+        with progress._condition:
+            progress.identifier = sequence_handle.identifier
+        try:
+            print("Playing sequence of {} steps".format(len(compiled)))
+            base.PlaySequence(sequence_handle)
+            finished = progress.wait(timeout)
+            with progress._condition:
+                timed_out = not (progress.completed or progress.aborted)
+            if timed_out:
+                # Still playing: a sequence must not be deleted mid-run
+                base.StopSequence()
+                base.Stop()
+        finally:
+            base.DeleteSequence(sequence_handle)
+    finally:
+        base.Unsubscribe(notification_handle)
+
+    if timed_out:
+        print("Timeout on sequence notification wait")
+        return False
+    if progress.aborted:
+        raise ActionAborted(
+            compiled[progress.step_index or 0].action.name,
+            progress.notification)
+    return finished
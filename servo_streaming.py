@@ -0,0 +1,175 @@
+#! /usr/bin/env python3
+
+
+### Low-Level Servoing Depth Ramps ###
+
+# Streams joint position setpoints through BaseCyclic.Refresh at up to
+# 1 kHz to run continuous depth ramps, instead of a stop-and-go
+# reach_pose per 0.1-0.2 cm increment. Every Refresh returns a feedback
+# message, so force and pose are captured in the same loop that
+# commands the arm.
+#
+# Low-level servoing is joint-space only. The ramp is a vertical line at
+# fixed x, y and orientation, so IK is solved once per KNOT_SPACING along
+# it (each solution seeding the next) and joint angles are interpolated
+# linearly between knots. Over half a millimetre the Cartesian error of
+# that interpolation is far below the arm's repeatability.
+
+import time
+import collections
+
+from kortex_api.autogen.messages import Base_pb2, BaseCyclic_pb2
+
+from feedback_sampler import snapshot_from_feedback
+
+# Setpoint rate (Hz); the controller's cyclic rate is the upper limit
+SERVO_RATE = 1000
+
+# Spacing of IK solutions along the ramp (meters)
+KNOT_SPACING = 0.0005
+
+# A depth profile segment: move to `depth` at `speed`, then hold for
+# `dwell`. Depths are offsets from the ramp start (cm, negative is down);
+# speed is in cm/s and dwell in seconds. A constant-velocity ramp is a
+# single segment, a staircase is one segment per stair.
+RampSegment = collections.namedtuple(
+    "RampSegment", ["depth", "speed", "dwell"])
+
+# One streamed sample: the commanded and measured tool z (meters) and
+# the external tool force along z (N).
+RampSample = collections.namedtuple(
+    "RampSample", ["timestamp", "setpoint_z", "tool_z", "force_z"])
+
+def staircase(depths, speed, dwell):
+    """Return RampSegments visiting each depth (cm) and dwelling there"""
+    return [RampSegment(depth, speed, dwell) for depth in depths]
+
+def depth_profile(segments, rate = SERVO_RATE):
+    """Sample a list of RampSegments into one depth per servo tick (cm)
+    """
+    depths = []
+    current = 0.0
+    for segment in segments:
+        if segment.speed <= 0:
+            raise ValueError("Ramp speed must be positive")
+        ticks = max(1, int(round(abs(segment.depth - current)
+                                 / segment.speed * rate)))
+        for tick in range(1, ticks + 1):
+            depths.append(current + (segment.depth - current) * tick / ticks)
+        depths.extend([segment.depth] * int(round(segment.dwell * rate)))
+        current = segment.depth
+    return depths
+
+def _unwrap(previous, value):
+    """Move an angle by whole turns so it is closest to `previous`"""
+    return previous + (value - previous + 180.0) % 360.0 - 180.0
+
+def solve_knots(base, start_pose, start_joints, lowest_depth,
+                spacing = KNOT_SPACING):
+    """Solve IK at evenly spaced depths below a start pose
+    Arguments:
+    base         -- BaseClient connected to the arm
+    start_pose   -- tool pose at depth 0 (meters / degrees)
+    start_joints -- measured joint angles at start_pose (degrees)
+    lowest_depth -- deepest depth in the profile (cm, <= 0)
+    spacing      -- distance between knots (meters)
+
+    Returns a list of joint angle tuples, knot k at depth -k*spacing.
+    """
+    count = int(abs(lowest_depth) / 100 / spacing) + 2
+    knots = [tuple(start_joints)]
+    for k in range(1, count):
+        ik_data = Base_pb2.IKData()
+        pose = ik_data.cartesian_pose
+        (pose.x, pose.y, pose.z, pose.theta_x, pose.theta_y,
+         pose.theta_z) = start_pose
+        pose.z -= k * spacing
+        for joint_id, value in enumerate(knots[-1]):
+            ik_data.guess.joint_angles.add(joint_identifier = joint_id,
+                                           value = value % 360.0)
+        solution = base.ComputeInverseKinematics(ik_data)
+        knots.append(tuple(_unwrap(previous, joint_angle.value)
+                           for previous, joint_angle in
+                           zip(knots[-1], solution.joint_angles)))
+    return knots
+
+def joints_at(knots, depth, spacing = KNOT_SPACING):
+    """Interpolate joint angles for a depth (cm) between IK knots"""
+    position = max(0.0, -depth / 100 / spacing)
+    index = min(int(position), len(knots) - 2)
+    fraction = position - index
+    return tuple(a + (b - a) * fraction
+                 for a, b in zip(knots[index], knots[index + 1]))
+
+def run_depth_ramp(base, base_cyclic, segments, rate = SERVO_RATE,
+                   on_feedback = None):
+    """Stream a depth profile from the current pose in low-level servoing
+    Arguments:
+    base        -- BaseClient connected to the arm
+    base_cyclic -- BaseCyclicClient, ideally on a UDP router
+    segments    -- list of RampSegment, depths relative to the current
+                   tool z (cm)
+    rate        -- setpoint rate (Hz)
+    on_feedback -- optional on_feedback(snapshot, feedback) for every
+                   tick, e.g. TelemetryRecorder.record_feedback
+
+    Returns the list of RampSample. The arm is put back in single-level
+    servoing on the way out, even on error.
+    """
+    depths = depth_profile(segments, rate)
+    feedback = base_cyclic.RefreshFeedback()
+    start_pose = (feedback.base.tool_pose_x, feedback.base.tool_pose_y,
+                  feedback.base.tool_pose_z, feedback.base.tool_pose_theta_x,
+                  feedback.base.tool_pose_theta_y,
+                  feedback.base.tool_pose_theta_z)
+    start_joints = [actuator.position for actuator in feedback.actuators]
+
+    # Knot 0 is the measured joint position, so there is no jump when
+    # low-level servoing takes over.
+    print("Solving IK along the ramp ...")
+    knots = solve_knots(base, start_pose, start_joints, min(depths + [0.0]))
+
+    command = BaseCyclic_pb2.Command()
+    for value in start_joints:
+        actuator_command = command.actuators.add()
+        actuator_command.flags = 1
+        actuator_command.position = value
+
+    samples = []
+    servo_mode = Base_pb2.ServoingModeInformation()
+    servo_mode.servoing_mode = Base_pb2.LOW_LEVEL_SERVOING
+    base.SetServoingMode(servo_mode)
+    try:
+        print("Streaming {} setpoints at {} Hz ...".format(len(depths), rate))
+        period = 1.0 / rate
+        next_time = time.perf_counter()
+        for frame_id, depth in enumerate(depths):
+            command.frame_id = frame_id & 0xffff
+            for actuator_command, value in zip(command.actuators,
+                                               joints_at(knots, depth)):
+                actuator_command.position = value % 360.0
+                actuator_command.command_id = frame_id & 0xffff
+
+            feedback = base_cyclic.Refresh(command)
+            now = time.perf_counter()
+            samples.append(RampSample(
+                now, start_pose[2] + depth / 100,
+                feedback.base.tool_pose_z,
+                feedback.base.tool_external_wrench_force_z))
+            if on_feedback is not None:
+                on_feedback(snapshot_from_feedback(feedback, now), feedback)
+
+            # Sleep through most of the period and spin the last
+            # millisecond; sleep() alone is too coarse for 1 kHz.
+            next_time += period
+            delay = next_time - time.perf_counter()
+            if delay > 0.002:
+                time.sleep(delay - 0.001)
+            elif delay < -period:
+                next_time = time.perf_counter()
+            while time.perf_counter() < next_time:
+                pass
+    finally:
+        servo_mode.servoing_mode = Base_pb2.SINGLE_LEVEL_SERVOING
+        base.SetServoingMode(servo_mode)
+    return samples
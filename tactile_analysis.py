@@ -0,0 +1,254 @@
+#! /usr/bin/env python3
+
+
+### Tactile Stiffness Analysis ###
+
+# Compares contact area and intensity against indentation depth for the
+# frames captured by tactile_capture.py. Frames are grouped by the
+# phantom and depth offset they were tagged with (grid scan frames carry
+# no phantom and form one "untagged" group); only the settled end of
+# each step and offsets at or below the hover point (0 to -2 cm) are
+# used, so transit moves drop out.
+#
+# For every frame the contact region is segmented against the background
+# image, and its area, mean intensity and centroid are computed. Those
+# are averaged per phantom and depth, and a straight line is fitted to
+# each phantom's series. The stiffness index is the intensity slope over
+# the area slope: a stiffer inclusion brightens the image faster for the
+# same growth in contact area. It only compares phantoms measured with
+# the same sensor and settings.
+#
+# Everything runs as batched NumPy operations over the frame stack,
+# BATCH_FRAMES frames at a time to bound memory on long grid scans.
+#
+# Example:
+#   python3 tactile_analysis.py session.cam0.tis
+
+import argparse
+
+import numpy as np
+
+from telemetry_recorder import PHANTOM_NAMES
+from tactile_capture import load_frames
+
+# Part of each step's frames, at its end, taken as settled at the depth
+SETTLE_FRACTION = 0.5
+
+# Contact segmentation: a pixel is in contact if it is brighter than the
+# background by CONTACT_FRACTION of the frame's peak contrast, and by at
+# least MIN_CONTRAST (intensity levels)
+CONTACT_FRACTION = 0.5
+MIN_CONTRAST = 15
+
+# Frames processed per batch, and frames used for the background image
+BATCH_FRAMES = 256
+
+DEPTH_DTYPE = np.dtype([
+    ("phantom", "u1"),              # PHANTOM_CODES
+    ("depth", "<f4"),               # depth offset (cm)
+    ("frames", "<i8"),              # frames averaged
+    ("area", "<f8"),                # contact area (pixels)
+    ("intensity", "<f8"),           # mean contrast inside the contact
+    ("centroid_shift", "<f8"),      # from the shallowest depth (pixels)
+])
+
+def settled(records, fraction = SETTLE_FRACTION):
+    """Mask of frames in the last `fraction` of their step
+    Arguments:
+    records -- frame records in capture order (see load_frames)
+    """
+    step = records["step"]
+    count = len(step)
+    if count == 0:
+        return np.zeros(0, dtype = bool)
+    starts = np.flatnonzero(np.r_[True, step[1:] != step[:-1]])
+    lengths = np.diff(np.r_[starts, count])
+    run = np.repeat(np.arange(len(starts)), lengths)
+    position = np.arange(count) - starts[run]
+    return (position >= (1 - fraction) * lengths[run]) & (step >= 0)
+
+def background_frame(records):
+    """Per-pixel median of the frames taken outside the protocol, or the
+    per-pixel minimum of the stack if there are none
+    """
+    outside = np.flatnonzero(records["step"] < 0)
+    if len(outside):
+        sample = outside[np.linspace(0, len(outside) - 1,
+                                     min(len(outside), BATCH_FRAMES)
+                                     ).astype(int)]
+        return np.median(records["frame"][sample], axis = 0).astype(
+            np.float32)
+    background = None
+    for start in range(0, len(records), BATCH_FRAMES):
+        batch = records["frame"][start:start + BATCH_FRAMES].min(axis = 0)
+        background = batch if background is None \
+                     else np.minimum(background, batch)
+    return background.astype(np.float32)
+
+def contact_features(frames, background, fraction = CONTACT_FRACTION,
+                     min_contrast = MIN_CONTRAST):
+    """Segment the contact region of every frame
+    Arguments:
+    frames     -- (N, height, width) frame stack
+    background -- (height, width) background image
+
+    Returns (area, intensity, centroid) arrays of length N: area in
+    pixels, mean contrast inside the contact and the (row, column)
+    centroid. Frames without contact get NaN intensity and centroid.
+    """
+    count = len(frames)
+    area = np.zeros(count)
+    intensity = np.full(count, np.nan)
+    centroid = np.full((count, 2), np.nan)
+    if count == 0:
+        return area, intensity, centroid
+    rows = np.arange(background.shape[0], dtype = np.float64)
+    columns = np.arange(background.shape[1], dtype = np.float64)
+
+    for start in range(0, count, BATCH_FRAMES):
+        contrast = frames[start:start + BATCH_FRAMES].astype(np.float32) \
+                   - background
+        peak = contrast.reshape(len(contrast), -1).max(axis = 1)
+        threshold = np.maximum(fraction * peak, min_contrast)
+        mask = contrast > threshold[:, None, None]
+
+        batch = slice(start, start + len(contrast))
+        pixels = mask.sum(axis = (1, 2))
+        area[batch] = pixels
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            intensity[batch] = np.where(mask, contrast, 0).sum(
+                axis = (1, 2)) / pixels
+            centroid[batch, 0] = mask.sum(axis = 2) @ rows / pixels
+            centroid[batch, 1] = mask.sum(axis = 1) @ columns / pixels
+    return area, intensity, centroid
+
+def _phantom_name(code):
+    """Display name of a phantom code; untagged rows are e.g. grid scans"""
+    name = PHANTOM_NAMES.get(int(code), str(code))
+    return "untagged" if name is None else name
+
+def _group_mean(codes, values, count):
+    """Mean of `values` per code, ignoring NaN"""
+    valid = ~np.isnan(values)
+    totals = np.bincount(codes[valid], values[valid], minlength = count)
+    numbers = np.bincount(codes[valid], minlength = count)
+    with np.errstate(invalid = "ignore"):
+        return totals / numbers
+
+def depth_table(records, area, intensity, centroid, settle = SETTLE_FRACTION):
+    """Average the frame features per phantom and depth offset
+    Arguments:
+    records -- frame records (see load_frames)
+    area, intensity, centroid -- output of contact_features()
+
+    Returns a DEPTH_DTYPE array sorted by phantom, then from the
+    shallowest depth down.
+    """
+    keep = settled(records, settle) & (records["depth"] <= 0)
+    phantom = records["phantom"][keep]
+    depth = np.round(records["depth"][keep], 3)
+    keys, codes = np.unique(np.stack([phantom, -depth], axis = 1),
+                            axis = 0, return_inverse = True)
+    codes = codes.ravel()
+
+    table = np.zeros(len(keys), dtype = DEPTH_DTYPE)
+    table["phantom"] = keys[:, 0]
+    table["depth"] = -keys[:, 1]
+    table["frames"] = np.bincount(codes, minlength = len(keys))
+    table["area"] = _group_mean(codes, area[keep], len(keys))
+    table["intensity"] = _group_mean(codes, intensity[keep], len(keys))
+    mean_centroid = np.stack(
+        [_group_mean(codes, centroid[keep, axis], len(keys))
+         for axis in range(2)], axis = 1)
+
+    # Rows are sorted by phantom, then by depth from the surface down, so
+    # the first row of each phantom with a contact centroid is its
+    # reference. Rows above the surface have no contact (NaN centroid).
+    if len(table) == 0:
+        return table
+    first = np.r_[True, table["phantom"][1:] != table["phantom"][:-1]]
+    candidates = np.where(np.isfinite(mean_centroid).all(axis = 1),
+                          np.arange(len(table)), len(table))
+    reference_row = np.minimum.reduceat(candidates, np.flatnonzero(first))
+    # A phantom with no contact at any depth points past the last row,
+    # at a NaN reference
+    reference = np.vstack([mean_centroid, [np.nan, np.nan]])[
+        reference_row[np.cumsum(first) - 1]]
+    table["centroid_shift"] = np.hypot(*(mean_centroid - reference).T)
+    return table
+
+def fit_stiffness(table):
+    """Fit area and intensity against indentation depth per phantom
+    Arguments:
+    table -- output of depth_table()
+
+    Returns a dict phantom name -> (area slope (pixels/cm), intensity
+    slope (levels/cm), stiffness index). Slopes are NaN with fewer than
+    two depths in contact.
+    """
+    phantoms, codes = np.unique(table["phantom"], return_inverse = True)
+    indentation = -table["depth"].astype(np.float64)
+
+    def slope(values):
+        valid = ~np.isnan(values)
+        c, x, y = codes[valid], indentation[valid], values[valid]
+        n = np.bincount(c, minlength = len(phantoms))
+        sx = np.bincount(c, x, minlength = len(phantoms))
+        sy = np.bincount(c, y, minlength = len(phantoms))
+        sxx = np.bincount(c, x * x, minlength = len(phantoms))
+        sxy = np.bincount(c, x * y, minlength = len(phantoms))
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            return (n * sxy - sx * sy) / (n * sxx - sx * sx)
+
+    area_slope = slope(np.where(table["area"] > 0, table["area"], np.nan))
+    intensity_slope = slope(table["intensity"])
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        index = intensity_slope / area_slope
+    return {_phantom_name(phantom):
+                (area_slope[i], intensity_slope[i], index[i])
+            for i, phantom in enumerate(phantoms)}
+
+def analyze(path, settle = SETTLE_FRACTION, fraction = CONTACT_FRACTION,
+            min_contrast = MIN_CONTRAST):
+    """Depth table and stiffness fit of one frame file"""
+    records = load_frames(path)
+    area, intensity, centroid = contact_features(
+        records["frame"], background_frame(records), fraction, min_contrast)
+    table = depth_table(records, area, intensity, centroid, settle)
+    return table, fit_stiffness(table)
+
+def report(path, table, stiffness):
+    print(path)
+    print("  {:>8} {:>7} {:>7} {:>9} {:>10} {:>7}".format(
+        "phantom", "depth", "frames", "area", "intensity", "shift"))
+    for row in table:
+        print("  {:>8} {:>7.2f} {:>7} {:>9.1f} {:>10.1f} {:>7.2f}".format(
+            _phantom_name(row["phantom"]), row["depth"],
+            row["frames"], row["area"], row["intensity"],
+            row["centroid_shift"]))
+    for name, (area_slope, intensity_slope, index) in stiffness.items():
+        print("  {}: area {:.1f} px/cm, intensity {:.1f} /cm, "
+              "stiffness index {:.4f}".format(name, area_slope,
+                                              intensity_slope, index))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs = "+", metavar = "PATH",
+                        help = "frame files written by tactile_capture.py")
+    parser.add_argument("--settle", type = float, default = SETTLE_FRACTION,
+                        help = "part of each step's frames taken as settled")
+    parser.add_argument("--fraction", type = float,
+                        default = CONTACT_FRACTION,
+                        help = "contact threshold, fraction of peak contrast")
+    parser.add_argument("--min_contrast", type = float,
+                        default = MIN_CONTRAST)
+    args = parser.parse_args()
+
+    for path in args.paths:
+        table, stiffness = analyze(path, args.settle, args.fraction,
+                                   args.min_contrast)
+        report(path, table, stiffness)
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
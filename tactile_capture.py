@@ -0,0 +1,309 @@
+#! /usr/bin/env python3
+
+
+### Tactile Image Capture ###
+
+# Captures tactile imaging sensor (TIS) frames alongside the arm steps.
+# Every camera has its own producer thread that reads frames as fast as
+# the source delivers them and copies each one, with its host timestamp
+# and the protocol step, phantom and depth offset active when it arrived,
+# into a preallocated ring of frame slots. A writer thread per camera
+# drains the ring to one file per camera and session.
+#
+# Nothing here waits on the motion loop or makes it wait: tagging a step
+# is a plain attribute update, and producers never block on the writer.
+# If a ring is full when a frame arrives, the frame is counted in
+# `dropped` and its sequence number is skipped in the file, so a loss is
+# always visible.
+#
+# Sources are pluggable: OpenCVSource reads a V4L2/OpenCV device and
+# SyntheticSource generates contact images for offline runs. Anything
+# with open(), read() -> ndarray, close() and a `shape` works.
+#
+# Frame files are a 64-byte header followed by raw frame records and can
+# be opened as a read-only memory map with load_frames().
+
+import time
+import threading
+
+import numpy as np
+
+from telemetry_recorder import PHANTOM_CODES
+
+# File header: magic string, format version and frame shape
+MAGIC = b"CSNAPTIS"
+VERSION = 1
+HEADER_SIZE = 64
+
+# Frame slots in each camera's ring. At 30 fps this is ~4 s of slack for
+# the writer.
+RING_SLOTS = 128
+
+# Default synthetic source settings
+SYNTHETIC_SHAPE = (240, 320)
+SYNTHETIC_RATE = 30          # (frames/second)
+SYNTHETIC_GAIN = 4.0         # blob radius growth (pixels/N)
+
+def frame_dtype(shape):
+    """Record dtype of one tagged frame of a given shape (uint8 pixels)
+    """
+    return np.dtype([
+        ("timestamp", "<f8"),           # host perf_counter (s)
+        ("sequence", "<u4"),            # source frame number
+        ("step", "<i4"),                # protocol step, -1 outside
+        ("phantom", "u1"),              # PHANTOM_CODES
+        ("depth", "<f4"),               # depth offset (cm)
+        ("frame", "u1", tuple(shape)),
+    ])
+
+def _header(shape):
+    dims = list(shape) + [0] * (3 - len(shape))
+    header = MAGIC + np.array([VERSION, len(shape)] + dims,
+                              dtype = "<u4").tobytes()
+    return header.ljust(HEADER_SIZE, b"\0")
+
+def load_frames(path):
+    """Open a frame file as a read-only structured memory map
+    """
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError("{} is not a tactile frame file".format(path))
+    values = np.frombuffer(header, dtype = "<u4", count = 5,
+                           offset = len(MAGIC))
+    if values[0] != VERSION:
+        raise ValueError("{} has unsupported format version {}".format(
+            path, values[0]))
+    shape = tuple(int(value) for value in values[2:2 + values[1]])
+    return np.memmap(path, dtype = frame_dtype(shape), mode = "r",
+                     offset = HEADER_SIZE)
+
+class OpenCVSource:
+    """Frames from a V4L2/OpenCV capture device
+    Arguments:
+    device -- device index or path, e.g. 0 or "/dev/video0"
+    width, height -- requested resolution, None for the device default
+    gray   -- convert frames to a single channel
+    """
+    def __init__(self, device = 0, width = None, height = None,
+                 gray = True):
+        self.device = device
+        self.width = width
+        self.height = height
+        self.gray = gray
+        self.shape = None
+        self._capture = None
+
+    def open(self):
+        try:
+            import cv2
+        except ImportError:
+            raise RuntimeError("OpenCV (cv2) is required for camera capture")
+        self._cv2 = cv2
+        self._capture = cv2.VideoCapture(self.device)
+        if not self._capture.isOpened():
+            raise RuntimeError("Cannot open camera {}".format(self.device))
+        if self.width is not None:
+            self._capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        if self.height is not None:
+            self._capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        self.shape = self.read().shape
+
+    def read(self):
+        ok, frame = self._capture.read()
+        if not ok:
+            raise RuntimeError("Camera {} stopped delivering frames".format(
+                self.device))
+        if self.gray and frame.ndim == 3:
+            frame = self._cv2.cvtColor(frame, self._cv2.COLOR_BGR2GRAY)
+        return frame
+
+    def close(self):
+        if self._capture is not None:
+            self._capture.release()
+            self._capture = None
+
+class SyntheticSource:
+    """Generated contact images for runs without a sensor
+    Arguments:
+    shape   -- (height, width) of the frames
+    rate    -- frame rate (frames/second)
+    sampler -- optional FeedbackSampler; the contact blob grows with the
+               measured tool force, so simulated surfaces show up
+    gain    -- blob radius per newton of force (pixels/N)
+    """
+    def __init__(self, shape = SYNTHETIC_SHAPE, rate = SYNTHETIC_RATE,
+                 sampler = None, gain = SYNTHETIC_GAIN, seed = 0):
+        self.shape = tuple(shape)
+        self.rate = rate
+        self.sampler = sampler
+        self.gain = gain
+        self._random = np.random.default_rng(seed)
+        rows, columns = np.indices(self.shape)
+        self._distance = np.hypot(rows - self.shape[0] / 2,
+                                  columns - self.shape[1] / 2)
+        self._next_time = None
+
+    def open(self):
+        self._next_time = time.perf_counter()
+
+    def read(self):
+        self._next_time += 1.0 / self.rate
+        delay = self._next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        force = 0.0
+        if self.sampler is not None:
+            snapshot = self.sampler.latest()
+            if snapshot is not None:
+                force = abs(snapshot.tool_wrench[2])
+        radius = self.gain * force
+        frame = 20.0 + self._random.normal(0.0, 3.0, self.shape)
+        if radius > 0:
+            frame += 200.0 * np.exp(-(self._distance / radius) ** 2)
+        return np.clip(frame, 0, 255).astype(np.uint8)
+
+    def close(self):
+        pass
+
+class _Camera:
+    """Producer thread, frame ring and writer thread of one source"""
+    def __init__(self, capture, index, source, path, slots):
+        self.capture = capture
+        self.index = index
+        self.source = source
+        self.path = path
+        self.frames = 0
+        self.dropped = 0
+        self.error = None
+
+        source.open()
+        self._ring = np.zeros(slots, dtype = frame_dtype(source.shape))
+        self._head = 0          # slots filled by the producer
+        self._tail = 0          # slots written by the writer
+        self._condition = threading.Condition()
+        self._running = True    # producer should keep reading
+        self._producing = True  # producer thread still alive
+
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(_header(source.shape))
+            self._file.flush()
+        self._producer = threading.Thread(
+            target = self._produce, name = "TactileCamera{}".format(index),
+            daemon = True)
+        self._writer = threading.Thread(
+            target = self._write, name = "TactileWriter{}".format(index),
+            daemon = True)
+        self._writer.start()
+        self._producer.start()
+
+    def _produce(self):
+        sequence = 0
+        try:
+            while self._running:
+                frame = self.source.read()
+                timestamp = time.perf_counter()
+                step, phantom, depth = self.capture._tags
+                with self._condition:
+                    if self._head - self._tail >= len(self._ring):
+                        self.dropped += 1
+                    else:
+                        slot = self._ring[self._head % len(self._ring)]
+                        slot["timestamp"] = timestamp
+                        slot["sequence"] = sequence
+                        slot["step"] = step
+                        slot["phantom"] = phantom
+                        slot["depth"] = depth
+                        slot["frame"] = frame
+                        self._head += 1
+                        self.frames += 1
+                        self._condition.notify()
+                sequence += 1
+        except Exception as error:
+            self.error = error
+            print("Camera {} stopped: {}".format(self.index, error))
+        finally:
+            with self._condition:
+                self._producing = False
+                self._condition.notify()
+
+    def _write(self):
+        while True:
+            with self._condition:
+                while self._tail == self._head and self._producing:
+                    self._condition.wait()
+                head = self._head
+                if self._tail == head:
+                    return
+            # Slots between tail and head are not touched by the producer
+            # until the tail moves past them.
+            start = self._tail % len(self._ring)
+            count = min(head - self._tail, len(self._ring) - start)
+            self._file.write(self._ring[start:start + count].tobytes())
+            self._file.flush()
+            with self._condition:
+                self._tail += count
+
+    def close(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._producer.join()
+        self._writer.join()
+        self.source.close()
+        self._file.close()
+
+class TactileCapture:
+    """Tagged frame capture from one or more tactile cameras
+
+    Cameras start when the capture is created. Tag steps as the protocol
+    runs, like TelemetryRecorder:
+
+        with TactileCapture("session", [OpenCVSource(0)]) as capture:
+            run_steps(dispatcher, compiled, on_step = capture.begin_step)
+
+    Camera i is written to "<prefix>.cam<i>.tis".
+    """
+    def __init__(self, prefix, sources, slots = RING_SLOTS):
+        self.prefix = prefix
+        self._tags = (-1, PHANTOM_CODES[None], 0.0)
+        self.cameras = []
+        try:
+            for index, source in enumerate(sources):
+                self.cameras.append(_Camera(
+                    self, index, source,
+                    "{}.cam{}.tis".format(prefix, index), slots))
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def begin_step(self, index, compiled_step):
+        """Tag the frames that follow with a compiled protocol step
+        """
+        self._tags = (index, PHANTOM_CODES[compiled_step.step.phantom],
+                      compiled_step.offset)
+
+    def end_steps(self):
+        """Tag the frames that follow as outside the protocol
+        """
+        self._tags = (-1, PHANTOM_CODES[None], 0.0)
+
+    @property
+    def dropped(self):
+        return sum(camera.dropped for camera in self.cameras)
+
+    def close(self):
+        """Stop all cameras and write out every frame still in the rings
+        """
+        for camera in self.cameras:
+            camera.close()
+            print("Camera {}: {} frames, {} dropped".format(
+                camera.index, camera.frames, camera.dropped))
+        self.cameras = []
@@ -0,0 +1,266 @@
+#! /usr/bin/env python3
+
+
+### Columnar Telemetry Recorder ###
+
+# Records cyclic feedback during a session as fixed-dtype rows: measured
+# and commanded tool pose, external tool wrench and joint torques, each
+# tagged with the arm, protocol step, phantom and depth offset that was
+# active. Several arms can share one recorder through stream(), which
+# merges their rows into one file told apart by the "arm" column.
+#
+# Rows are written into a fixed pool of preallocated NumPy chunks. Full
+# chunks go to a writer thread that appends them to one file per session,
+# so memory stays constant however long the session runs and the thread
+# that records never waits on the disk. If the writer ever falls so far
+# behind that no free chunk is left, rows are counted in `dropped` rather
+# than blocking.
+#
+# The file is a 64-byte header followed by raw RECORD_DTYPE rows, so it
+# can be opened as a read-only memory map with load_recording() while it
+# is still being written.
+
+import queue
+import threading
+
+import numpy as np
+
+# File header: magic string and format version, padded to HEADER_SIZE
+MAGIC = b"CSNAPTEL"
+VERSION = 2
+HEADER_SIZE = 64
+
+# Rows per chunk and number of chunks in the pool. At 1 kHz one chunk
+# holds ~4 s of data and the pool gives the writer ~16 s of slack.
+CHUNK_ROWS = 4096
+CHUNK_COUNT = 4
+
+ACTUATOR_COUNT = 7
+
+# Phantom tags stored in the "phantom" column
+PHANTOM_CODES = {None: 0, "soft": 1, "hard": 2}
+PHANTOM_NAMES = {code: name for name, code in PHANTOM_CODES.items()}
+
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<f8"),                       # host perf_counter (s)
+    ("arm", "u1"),                              # stream(), 0 by default
+    ("step", "<i4"),                            # protocol step, -1 outside
+    ("phantom", "u1"),                          # PHANTOM_CODES
+    ("depth", "<f4"),                           # depth offset (cm)
+    ("tool_pose", "<f8", (6,)),                 # (meters / degrees)
+    ("commanded_tool_pose", "<f8", (6,)),       # (meters / degrees)
+    ("tool_wrench", "<f4", (6,)),               # (N / Nm)
+    ("joint_torques", "<f4", (ACTUATOR_COUNT,)),  # (Nm)
+])
+
+def _header():
+    header = MAGIC + np.array([VERSION, RECORD_DTYPE.itemsize],
+                              dtype = "<u4").tobytes()
+    return header.ljust(HEADER_SIZE, b"\0")
+
+def _check_header(path):
+    """Raise ValueError unless a file starts with this format's header
+    """
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+        raise ValueError("{} is not a telemetry recording".format(path))
+    version, itemsize = np.frombuffer(header, dtype = "<u4", count = 2,
+                                      offset = len(MAGIC))
+    if version != VERSION or itemsize != RECORD_DTYPE.itemsize:
+        raise ValueError("{} has unsupported format version {}".format(
+            path, version))
+
+def load_recording(path):
+    """Open a recording as a read-only structured memory map
+    """
+    _check_header(path)
+    return np.memmap(path, dtype = RECORD_DTYPE, mode = "r",
+                     offset = HEADER_SIZE)
+
+class TelemetryStream:
+    """Rows of one arm in a TelemetryRecorder, with their own step tags
+    """
+    def __init__(self, recorder, arm):
+        self.recorder = recorder
+        self.arm = arm
+        self.step = -1
+        self.phantom = PHANTOM_CODES[None]
+        self.depth = 0.0
+
+    def begin_step(self, index, compiled_step):
+        """Tag the rows that follow with a compiled protocol step
+        """
+        self.step = index
+        self.phantom = PHANTOM_CODES[compiled_step.step.phantom]
+        self.depth = compiled_step.offset
+
+    def end_steps(self):
+        """Tag the rows that follow as outside the protocol
+        """
+        self.step = -1
+        self.phantom = PHANTOM_CODES[None]
+        self.depth = 0.0
+
+    def record_feedback(self, snapshot, feedback):
+        """FeedbackSampler listener: record one feedback sample
+        """
+        base = feedback.base
+        self.record(
+            snapshot.timestamp, snapshot.tool_pose,
+            (base.commanded_tool_pose_x, base.commanded_tool_pose_y,
+             base.commanded_tool_pose_z, base.commanded_tool_pose_theta_x,
+             base.commanded_tool_pose_theta_y,
+             base.commanded_tool_pose_theta_z),
+            snapshot.tool_wrench, snapshot.joint_torques)
+
+    def record(self, timestamp, tool_pose, commanded_tool_pose,
+               tool_wrench, joint_torques):
+        """Append one row tagged with this stream's arm and step
+        """
+        self.recorder._append(self, timestamp, tool_pose,
+                              commanded_tool_pose, tool_wrench,
+                              joint_torques)
+
+class TelemetryRecorder:
+    """Append-only per-session telemetry file fed from cyclic feedback
+
+    Attach it to a FeedbackSampler and tag steps as the protocol runs:
+
+        with TelemetryRecorder("session.tel") as recorder:
+            sampler.add_listener(recorder.record_feedback)
+            run_steps(dispatcher, compiled, on_step = recorder.begin_step)
+
+    With several arms, give each its own stream() and use that in place
+    of the recorder.
+    """
+    def __init__(self, path, chunk_rows = CHUNK_ROWS,
+                 chunk_count = CHUNK_COUNT):
+        self.path = path
+        self.rows = 0
+        self.dropped = 0
+        self._streams = {}
+        self._default = self.stream(0)
+
+        self._free = queue.Queue()
+        for index in range(chunk_count):
+            self._free.put(np.zeros(chunk_rows, dtype = RECORD_DTYPE))
+        self._full = queue.Queue()
+        self._chunk = None
+        self._fill = 0
+        self._lock = threading.Lock()
+
+        # Rows are only appended to a recording of the same format, and
+        # only after whole rows, so the file stays one memory map
+        self._file = open(path, "ab")
+        try:
+            size = self._file.tell()
+            if size == 0:
+                self._file.write(_header())
+                self._file.flush()
+            else:
+                _check_header(path)
+                if (size - HEADER_SIZE) % RECORD_DTYPE.itemsize:
+                    raise ValueError("{} ends in a partial row".format(path))
+        except:
+            self._file.close()
+            raise
+        self._writer = threading.Thread(
+            target = self._write_chunks, name = "TelemetryWriter",
+            daemon = True)
+        self._writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def stream(self, arm):
+        """Return the TelemetryStream for an arm number (0-255)
+        """
+        if arm not in self._streams:
+            self._streams[arm] = TelemetryStream(self, arm)
+        return self._streams[arm]
+
+    def begin_step(self, index, compiled_step):
+        """Tag the rows that follow with a compiled protocol step
+        """
+        self._default.begin_step(index, compiled_step)
+
+    def end_steps(self):
+        """Tag the rows that follow as outside the protocol
+        """
+        self._default.end_steps()
+
+    def record_feedback(self, snapshot, feedback):
+        """FeedbackSampler listener: record one feedback sample
+        """
+        self._default.record_feedback(snapshot, feedback)
+
+    def record(self, timestamp, tool_pose, commanded_tool_pose,
+               tool_wrench, joint_torques):
+        """Append one row tagged with the current step
+        """
+        self._default.record(timestamp, tool_pose, commanded_tool_pose,
+                             tool_wrench, joint_torques)
+
+    def _append(self, stream, timestamp, tool_pose, commanded_tool_pose,
+                tool_wrench, joint_torques):
+        with self._lock:
+            if self._chunk is None:
+                try:
+                    self._chunk = self._free.get_nowait()
+                except queue.Empty:
+                    self.dropped += 1
+                    return
+                self._fill = 0
+            row = self._chunk[self._fill]
+            row["timestamp"] = timestamp
+            row["arm"] = stream.arm
+            row["step"] = stream.step
+            row["phantom"] = stream.phantom
+            row["depth"] = stream.depth
+            row["tool_pose"] = tool_pose
+            row["commanded_tool_pose"] = commanded_tool_pose
+            row["tool_wrench"] = tool_wrench
+            # Arms with fewer actuators leave the last columns at NaN
+            torques = tuple(joint_torques[:ACTUATOR_COUNT])
+            row["joint_torques"] = torques + (np.nan,) \
+                * (ACTUATOR_COUNT - len(torques))
+            self._fill += 1
+            self.rows += 1
+            if self._fill == len(self._chunk):
+                self._full.put((self._chunk, self._fill))
+                self._chunk = None
+
+    def flush(self):
+        """Hand the partly filled chunk to the writer
+        """
+        with self._lock:
+            if self._chunk is not None and self._fill:
+                self._full.put((self._chunk, self._fill))
+                self._chunk = None
+
+    def close(self):
+        """Write everything recorded so far and close the file
+        """
+        if self._file is None:
+            return
+        self.flush()
+        self._full.put(None)
+        self._writer.join()
+        self._file.close()
+        self._file = None
+        if self.dropped:
+            print("Telemetry recorder dropped {} rows".format(self.dropped))
+
+    def _write_chunks(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                return
+            chunk, fill = item
+            self._file.write(chunk[:fill].tobytes())
+            self._file.flush()
+            self._free.put(chunk)
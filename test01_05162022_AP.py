@@ -28,6 +28,10 @@ from kortex_api.autogen.client_stubs.BaseCyclicClientRpc import BaseCyclicClient
 
 from kortex_api.autogen.messages import Base_pb2, BaseCyclic_pb2, Common_pb2
 
+import kortex_sim
+from feedback_sampler import FeedbackSampler
+from gripper_control import GripperController
+
 # Maximum allowed waiting time during actions (in seconds)
 TIMEOUT_DURATION = 20
 
@@ -120,122 +124,49 @@ def example_move_to_home_position(base):
         print("Timeout on action notification wait")
     return finished
 class GripperCommandExample:
-    def __init__(self, router, proportional_gain = 2.0):
+    def __init__(self, base, sampler = None, proportional_gain = 2.0):
 
         self.proportional_gain = proportional_gain
-        self.router = router
+        self.base = base
 
-        # Create base client using TCP router
-        self.base = BaseClient(self.router)
+        # Waits read the gripper from the cyclic feedback when a sampler
+        # is running, and poll GetMeasuredGripperMovement at a limited
+        # rate otherwise
+        self.gripper = GripperController(
+            base, sampler, proportional_gain = proportional_gain)
 
     def ExampleSendGripperCommands(self):
 
-        # Create the GripperCommand we will send
-        gripper_command = Base_pb2.GripperCommand()
-        finger = gripper_command.gripper.finger.add()
-
-        # Close the gripper with position increments
+        # Close the gripper with closed-loop position moves
         print("Performing gripper test in position...")
-        gripper_command.mode = Base_pb2.GRIPPER_POSITION
         position = 0.00
-        finger.finger_identifier = 1
         while position < 1.0:
-            finger.value = position
-            print("Going to position {:0.2f}...".format(finger.value))
-            self.base.SendGripperCommand(gripper_command)
+            print("Going to position {:0.2f}...".format(position))
+            if self.gripper.move_to(position) is None:
+                return False
             position += 0.1
-            time.sleep(1)
 
-        # Set speed to open gripper
+        # Set speed to open gripper and wait for reported position to be
+        # opened
         print ("Opening gripper using speed command...")
-        gripper_command.mode = Base_pb2.GRIPPER_SPEED
-        finger.value = 0.1
-        self.base.SendGripperCommand(gripper_command)
-        gripper_request = Base_pb2.GripperRequest()
-
-        # Wait for reported position to be opened
-        gripper_request.mode = Base_pb2.GRIPPER_POSITION
-        while True:
-            gripper_measure = self.base.GetMeasuredGripperMovement(gripper_request)
-            if len (gripper_measure.finger):
-                print("Current position is : {0}".format(gripper_measure.finger[0].value))
-                if gripper_measure.finger[0].value < 0.01:
-                    break
-            else: # Else, no finger present in answer, end loop
-                break
-
-        # Set speed to close gripper
-        print ("Closing gripper using speed command...")
-        gripper_command.mode = Base_pb2.GRIPPER_SPEED
-        finger.value = -0.1
-        self.base.SendGripperCommand(gripper_command)
-        class GripperCommandExample:
-    def __init__(self, router, proportional_gain = 2.0):
-
-        self.proportional_gain = proportional_gain
-        self.router = router
-
-        # Create base client using TCP router
-        self.base = BaseClient(self.router)
-
-    def ExampleSendGripperCommands(self):
-
-        # Create the GripperCommand we will send
-        gripper_command = Base_pb2.GripperCommand()
-        finger = gripper_command.gripper.finger.add()
+        state = self.gripper.release(speed = 0.1)
+        if state is None:
+            return False
+        print("Current position is : {0}".format(state.position))
 
-        # Close the gripper with position increments
-        print("Performing gripper test in position...")
-        gripper_command.mode = Base_pb2.GRIPPER_POSITION
-        position = 0.00
-        finger.finger_identifier = 1
-        while position < 1.0:
-            finger.value = position
-            print("Going to position {:0.2f}...".format(finger.value))
-            self.base.SendGripperCommand(gripper_command)
-            position += 0.1
-            time.sleep(1)
-
-        # Set speed to open gripper
-        print ("Opening gripper using speed command...")
-        gripper_command.mode = Base_pb2.GRIPPER_SPEED
-        finger.value = 0.1
-        self.base.SendGripperCommand(gripper_command)
-        gripper_request = Base_pb2.GripperRequest()
-
-        # Wait for reported position to be opened
-        gripper_request.mode = Base_pb2.GRIPPER_POSITION
-        while True:
-            gripper_measure = self.base.GetMeasuredGripperMovement(gripper_request)
-            if len (gripper_measure.finger):
-                print("Current position is : {0}".format(gripper_measure.finger[0].value))
-                if gripper_measure.finger[0].value < 0.01:
-                    break
-            else: # Else, no finger present in answer, end loop
-                break
-
-        # Set speed to close gripper
+        # Set speed to close gripper and wait for the fingers to stop
         print ("Closing gripper using speed command...")
-        gripper_command.mode = Base_pb2.GRIPPER_SPEED
-        finger.value = -0.1
-        self.base.SendGripperCommand(gripper_command)
-
-        # Wait for reported speed to be 0
-        gripper_request.mode = Base_pb2.GRIPPER_SPEED
-        while True:
-            gripper_measure = self.base.GetMeasuredGripperMovement(gripper_request)
-            if len (gripper_measure.finger):
-                print("Current speed is : {0}".format(gripper_measure.finger[0].value))
-                if gripper_measure.finger[0].value == 0.0:
-                    break
-            else: # Else, no finger present in answer, end loop
-                break
-
+        state = self.gripper.grasp(speed = 0.1)
+        if state is None:
+            return False
+        print("Current speed is : {0}".format(state.speed))
+        return True
 
 def main():
-    # Import the utilities helper module
+    # Import the utilities helper module, or the offline simulator when
+    # run with --simulate
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
+    utilities, BaseClient, BaseCyclicClient = kortex_sim.select_backend()
 
     # Parse arguments
     args = utilities.parseConnectionArguments()
@@ -245,17 +176,26 @@ def main():
 
         # Create required services
         base = BaseClient(router)
-        base_cyclic = BaseCyclicClient(router)
 
-        # Example core
-        success = True
-        success &= example_move_to_home_position(base)
+        # Cyclic feedback is polled over UDP by a background sampler,
+        # which the gripper waits listen to
+        with utilities.DeviceConnection.createUdpConnection(args) \
+                as router_real_time, \
+             FeedbackSampler(BaseCyclicClient(router_real_time)) as sampler:
+
+            # Example core
+            success = True
+            success &= example_move_to_home_position(base)
+            example = GripperCommandExample(base, sampler)
+            try:
+                success &= example.ExampleSendGripperCommands()
+            finally:
+                example.gripper.close()
 
-        #Uncheck this command when you are done and run one more time to return robot to packaging position
-        #success &= example_move_to_pack_position(base)
+            #Uncheck this command when you are done and run one more time to return robot to packaging position
+            #success &= example_move_to_pack_position(base)
 
         return 0 if success else 1
 
 if __name__ == "__main__":
   exit(main())
- 
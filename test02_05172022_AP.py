@@ -24,6 +24,16 @@ from kortex_api.autogen.client_stubs.BaseCyclicClientRpc import BaseCyclicClient
 
 from kortex_api.autogen.messages import Base_pb2, BaseCyclic_pb2, Common_pb2
 
+import kortex_sim
+from feedback_sampler import FeedbackSampler
+from twist_motion import twist_move
+
+# Maximum allowed waiting time during actions (in seconds)
+TIMEOUT_DURATION = 20
+
+# Cyclic feedback rate for the twist stop (Hz)
+SAMPLE_RATE = 1000
+
 # Create closure to set an event after an END or an ABORT
 #
 def check_for_end_or_abort(e):
@@ -77,39 +87,31 @@ def example_move_to_home_position(base):
         print("Timeout on action notification wait")
     return finished
 
-def example_twist_command(base):
-
-    command = Base_pb2.TwistCommand()
-
-    command.reference_frame = Base_pb2.CARTESIAN_REFERENCE_FRAME_TOOL
-    command.duration = 0
-
-    twist = command.twist
-    twist.linear_x = 0
-    twist.linear_y = 0.03
-    twist.linear_z = 0
-    twist.angular_x = 0
-    twist.angular_y = 0
-    twist.angular_z = 5
-
-    print ("Sending the twist command for 5 seconds...")
-    base.SendTwistCommand(command)
-
-    # Let time for twist to be executed
-    time.sleep(5)
+def example_twist_command(base, sampler):
 
-    print ("Stopping the robot...")
-    base.Stop()
-    time.sleep(1)
+    # Slide and turn the tool as far as the old 5 second twist did, but
+    # stop on the displacement measured from the cyclic feedback
+    print ("Sending the twist command for 15 cm or 25 degrees...")
+    motion = twist_move(base, sampler, linear = (0, 0.03, 0),
+                        angular = (0, 0, 5), distance = 0.15, angle = 25)
+    if motion is None:
+        return False
 
-    return True
+    print ("Robot stopped after {:.2f} cm and {:.2f} degrees".format(
+        motion.distance * 100, motion.angle))
+    print ("Tool delta: x {:.2f} cm, y {:.2f} cm, z {:.2f} cm, "
+           "theta_z {:.2f} degrees".format(
+               motion.delta[0] * 100, motion.delta[1] * 100,
+               motion.delta[2] * 100, motion.delta[5]))
+    return motion.reached
 
 def main():
     
-    # Import the utilities helper module
+    # Import the utilities helper module, or the offline simulator when
+    # run with --simulate
     #
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
+    utilities, BaseClient, BaseCyclicClient = kortex_sim.select_backend()
 
     # Parse arguments
     #
@@ -117,12 +119,14 @@ def main():
     
     # Create connection to the device and get the router
     #
-    with utilities.DeviceConnection.createTcpConnection(args) as router:
+    with utilities.DeviceConnection.createTcpConnection(args) as router, \
+         utilities.DeviceConnection.createUdpConnection(args) \
+            as router_real_time:
 
         # Create required services
         #
         base = BaseClient(router)
-        base_cyclic = BaseCyclicClient(router)
+        base_cyclic = BaseCyclicClient(router_real_time)
 
         # Example core
         #
@@ -132,7 +136,8 @@ def main():
         #
        
         success &= example_move_to_home_position(base)
-        success &= example_twist_command(base)
+        with FeedbackSampler(base_cyclic, SAMPLE_RATE) as sampler:
+            success &= example_twist_command(base, sampler)
 
         #Uncheck this command when you are done and run one more time to return robot to packaging position
         #success &= example_move_to_pack_position(base)
@@ -0,0 +1,185 @@
+#! /usr/bin/env python3
+
+
+### Closed-Loop Twist Motion ###
+
+# Moves the tool with a twist command for a measured displacement
+# instead of a fixed time. A FeedbackSampler listener measures the tool
+# displacement and rotation from the start pose in every cyclic sample
+# and calls Stop() from the sampler thread as soon as the target
+# distance or angle is reached, so the travel no longer depends on sleep
+# and RPC timing jitter. Both are net values from the start pose, so
+# sensor noise does not add up over a long move. The achieved delta is
+# measured once the arm has settled after the stop.
+#
+# Example (slide 5 cm along the tool y axis):
+#   with FeedbackSampler(base_cyclic, rate = 1000) as sampler:
+#       motion = twist_move(base, sampler, linear = (0, 0.02, 0),
+#                           distance = 0.05)
+
+import math
+import threading
+import collections
+
+from kortex_api.autogen.messages import Base_pb2
+
+# The arm counts as settled after a stop once its speed, measured over
+# SPEED_WINDOW to average out feedback noise, stays below these for
+# SETTLE_TIME (meters/second, degrees/second, seconds)
+STOPPED_SPEED = 0.002
+STOPPED_RATE = 0.2
+SPEED_WINDOW = 0.1
+SETTLE_TIME = 0.1
+SETTLE_TIMEOUT = 2
+
+# Result of a twist move
+#   delta    -- final minus start tool pose in the base frame
+#               (dx, dy, dz, dtheta_x, dtheta_y, dtheta_z) (meters / degrees)
+#   distance -- straight-line tool displacement (meters)
+#   angle    -- tool rotation from the start orientation (degrees)
+#   reached  -- whether the target distance or angle was reached
+TwistMotion = collections.namedtuple(
+    "TwistMotion", ["delta", "distance", "angle", "reached"])
+
+def _quaternion(theta_x, theta_y, theta_z):
+    """Unit quaternion (w, x, y, z) of a Kortex tool orientation, which
+    rotates about the fixed x, then y, then z axes
+    """
+    cx, sx = math.cos(math.radians(theta_x) / 2), \
+             math.sin(math.radians(theta_x) / 2)
+    cy, sy = math.cos(math.radians(theta_y) / 2), \
+             math.sin(math.radians(theta_y) / 2)
+    cz, sz = math.cos(math.radians(theta_z) / 2), \
+             math.sin(math.radians(theta_z) / 2)
+    return (cz * cy * cx + sz * sy * sx,
+            cz * cy * sx - sz * sy * cx,
+            cz * sy * cx + sz * cy * sx,
+            sz * cy * cx - cz * sy * sx)
+
+def rotation_angle(start, end):
+    """Angle of the rotation between two tool orientations
+    (theta_x, theta_y, theta_z) (degrees)
+    """
+    w1, x1, y1, z1 = _quaternion(*start)
+    w2, x2, y2, z2 = _quaternion(*end)
+    # Relative rotation start^-1 * end
+    w = w1 * w2 + x1 * x2 + y1 * y2 + z1 * z2
+    x = w1 * x2 - x1 * w2 - y1 * z2 + z1 * y2
+    y = w1 * y2 + x1 * z2 - y1 * w2 - z1 * x2
+    z = w1 * z2 - x1 * y2 + y1 * x2 - z1 * w2
+    return math.degrees(2 * math.atan2(math.sqrt(x * x + y * y + z * z),
+                                       abs(w)))
+
+def _angle_delta(a, b):
+    """Shortest signed difference b - a between two angles (degrees)"""
+    return (b - a + 180.0) % 360.0 - 180.0
+
+def twist_move(base, sampler, linear = (0, 0, 0), angular = (0, 0, 0),
+               distance = None, angle = None,
+               reference_frame = Base_pb2.CARTESIAN_REFERENCE_FRAME_TOOL,
+               timeout = None, timeout_margin = 5):
+    """Twist the tool until it has moved a distance or turned an
+    angle, then stop
+    Arguments:
+    base     -- BaseClient connected to the arm
+    sampler  -- running FeedbackSampler (ideally at 1 kHz)
+    linear   -- (x, y, z) velocity (meters/second)
+    angular  -- (x, y, z) angular velocity (degrees/second)
+    distance -- tool displacement from the start (meters), None for no
+                limit
+    angle    -- tool rotation from the start (degrees), None for no limit
+    reference_frame -- frame of the twist, the tool frame by default
+    timeout  -- maximum duration of the motion (seconds), None to predict
+                it from the speeds plus timeout_margin
+
+    Stops at whichever of distance and angle is reached first. Returns a
+    TwistMotion, or None if no cyclic feedback arrives.
+    """
+    if distance is None and angle is None:
+        raise ValueError("A twist move needs a distance or an angle")
+    if timeout is None:
+        durations = []
+        speed = math.sqrt(sum(value * value for value in linear))
+        rate = math.sqrt(sum(value * value for value in angular))
+        if distance is not None and speed > 0:
+            durations.append(distance / speed)
+        if angle is not None and rate > 0:
+            durations.append(angle / rate)
+        if not durations:
+            raise ValueError("The twist does not move towards its target")
+        timeout = min(durations) + timeout_margin
+
+    start = sampler.wait_for_sample(1)
+    if start is None:
+        print("No cyclic feedback received")
+        return None
+
+    latest = start
+    window = collections.deque()
+    still_since = None
+    done = threading.Event()
+    settled = threading.Event()
+
+    def watch(snapshot, feedback):
+        nonlocal latest, still_since
+        if settled.is_set():
+            return
+        latest = snapshot
+        pose = snapshot.tool_pose
+        if not done.is_set():
+            if (distance is not None and
+                math.dist(start.tool_pose[:3], pose[:3]) >= distance) \
+            or (angle is not None and
+                rotation_angle(start.tool_pose[3:], pose[3:]) >= angle):
+                base.Stop()
+                done.set()
+            return
+
+        # After the stop: speed over the last SPEED_WINDOW
+        window.append(snapshot)
+        while len(window) > 1 \
+        and snapshot.timestamp - window[1].timestamp >= SPEED_WINDOW:
+            window.popleft()
+        oldest = window[0]
+        dt = snapshot.timestamp - oldest.timestamp
+        if dt < SPEED_WINDOW:
+            return
+        if math.dist(oldest.tool_pose[:3], pose[:3]) / dt < STOPPED_SPEED \
+        and rotation_angle(oldest.tool_pose[3:], pose[3:]) / dt \
+            < STOPPED_RATE:
+            if still_since is None:
+                still_since = snapshot.timestamp
+            elif snapshot.timestamp - still_since >= SETTLE_TIME:
+                settled.set()
+        else:
+            still_since = None
+
+    command = Base_pb2.TwistCommand()
+    command.reference_frame = reference_frame
+    command.duration = 0
+    twist = command.twist
+    twist.linear_x, twist.linear_y, twist.linear_z = linear
+    twist.angular_x, twist.angular_y, twist.angular_z = angular
+
+    sampler.add_listener(watch)
+    try:
+        base.SendTwistCommand(command)
+        reached = done.wait(timeout)
+        if not reached:
+            print("Timeout on twist move")
+            base.Stop()
+            done.set()
+        if not settled.wait(SETTLE_TIMEOUT):
+            print("Arm still moving after the twist stopped")
+    finally:
+        sampler.remove_listener(watch)
+        if not done.is_set():
+            base.Stop()
+
+    end = latest.tool_pose
+    delta = tuple(e - s for s, e in zip(start.tool_pose[:3], end[:3])) \
+          + tuple(_angle_delta(s, e) for s, e in
+                  zip(start.tool_pose[3:], end[3:]))
+    return TwistMotion(delta, math.dist(start.tool_pose[:3], end[:3]),
+                       rotation_angle(start.tool_pose[3:], end[3:]),
+                       reached)